@@ -0,0 +1,91 @@
+"""Runs the lookups of a typical configure-device session through both
+backends and compares their wall time.
+
+The az backend runs against the stubbed az CLI (whose latency models CLI
+startup plus the round-trip), the REST backend against the local ARM / IoT
+Hub stand-in (whose latency models the round-trip alone). Usage:
+
+    python benchmarks/bench_backends.py [--az-startup 1.0] [--latency 0.05]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_az
+import fake_azure
+import iot
+import iot_backends
+import iot_rest
+import iot_session
+
+RGROUP = 'benchrg'
+HUB = 'benchhub'
+DEVICE = 'benchdevice'
+REGISTRY = 'benchregistry'
+
+
+def session(backend):
+    """The backend calls made by 'iot configure-device' for existing resources"""
+    steps = [
+        ('group_exists', lambda: backend.group_exists(RGROUP)),
+        ('show_hub', lambda: backend.show_hub(RGROUP, HUB)),
+        ('list_devices', lambda: backend.list_devices(RGROUP, HUB)),
+        ('show_device', lambda: backend.show_device(RGROUP, HUB, DEVICE)),
+        ('device_connection_string', lambda: backend.device_connection_string(RGROUP, HUB, DEVICE)),
+        ('hub_connection_string', lambda: backend.hub_connection_string(RGROUP, HUB)),
+        ('list_registries', lambda: backend.list_registries(RGROUP)),
+        ('registry_credentials', lambda: backend.registry_credentials(RGROUP, REGISTRY)),
+        ('update_device_tags', lambda: backend.update_device_tags(
+            RGROUP, HUB, DEVICE, {'id': DEVICE, 'description': iot_session.DEVICE_DESCRIPTION})),
+    ]
+    start = time.time()
+    for name, step in steps:
+        out, err = step()
+        if out is None:
+            raise SystemExit("%s backend: %s failed: %s" % (backend.name, name, err))
+    return time.time() - start, len(steps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--az-startup', type=float, default=1.0, help='Seconds of az CLI startup per call.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of network round-trip per call.')
+    args = parser.parse_args()
+
+    server = fake_azure.FakeAzure(latency=args.latency).start()
+    server.state.add_group(RGROUP)
+    server.state.add_hub(RGROUP, HUB)
+    server.state.add_device(DEVICE, edge_enabled=True)
+    server.state.add_registry(RGROUP, REGISTRY)
+    rest = iot_rest.RestBackend(subscription=fake_azure.SUBSCRIPTION, token='fake',
+                                arm_endpoint=server.url, hub_endpoint=server.url)
+
+    stub_dir = tempfile.mkdtemp()
+    iot.query_cache.enabled = False
+    try:
+        fake_az.install(stub_dir)
+        os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_AZ_LATENCY'] = str(args.az_startup + args.latency)
+        az_time, calls = session(iot_backends.AzCliBackend(iot.run_command_with_stderr_json_out))
+        rest_time, _ = session(rest)
+    finally:
+        shutil.rmtree(stub_dir)
+        rest.close()
+        server.stop()
+
+    print("calls per session:  %d" % calls)
+    print("HTTP requests:      %d" % server.state.requests)
+    print("az backend:         %.3fs" % az_time)
+    print("rest backend:       %.3fs" % rest_time)
+    print("speedup:            %.2fx" % (az_time / rest_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Registers and tags a fleet of device identities against the local IoT Hub
+stand-in, one device at a time and through the bulk path, and reports the
+throughput of each in devices per second.
+
+One device at a time is what provisioning each device on its own costs: a
+create followed by a twin update. The bulk path is what configure-fleet does:
+RestBackend.ensure_devices creates the missing identities with bulk registry
+requests and update_devices_tags patches the twins concurrently. The
+stand-in never throttles, so the client side rate limits are lifted unless
+--rate-limits asks for the default (S1 hub) ones. Usage:
+
+    python benchmarks/bench_bulk.py [--devices 500] [--latency 0.05] [--rate-limits]
+"""
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_azure
+import iot_rest
+import iot_scheduler
+import iot_session
+
+RGROUP = 'benchrg'
+HUB = 'benchhub'
+
+
+def tags(device):
+    return {'id': device, 'description': iot_session.DEVICE_DESCRIPTION,
+            'credentials': {'user': 'pi', 'password': 'raspberry'}}
+
+
+def one_at_a_time(backend, devices):
+    for device in devices:
+        for _, err in (backend.create_device(RGROUP, HUB, device, edge_enabled=True),
+                       backend.update_device_tags(RGROUP, HUB, device, tags(device))):
+            if err:
+                raise SystemExit("%s: %s" % (device, err))
+
+
+def bulk(backend, devices):
+    identities = backend.ensure_devices(RGROUP, HUB, devices, edge_enabled=True)
+    twins = backend.update_devices_tags(RGROUP, HUB, dict((d, tags(d)) for d in devices))
+    for device, (_, err) in list(identities.items()) + list(twins.items()):
+        if err:
+            raise SystemExit("%s: %s" % (device, err))
+    return identities
+
+
+def check(server, identities, devices):
+    """Every device exists, is tagged, and the bulk path returned its real key"""
+    for device in devices:
+        registered = server.state.devices[device]
+        if registered['tags'] != tags(device):
+            raise SystemExit("%s was not tagged" % device)
+        key = registered['authentication']['symmetricKey']['primaryKey']
+        if identities is not None and identities[device][0]['authentication']['symmetricKey']['primaryKey'] != key:
+            raise SystemExit("%s: the returned key does not match the registered one" % device)
+
+
+def run(name, fn, devices, latency, limits):
+    server = fake_azure.FakeAzure(latency=latency).start()
+    server.state.add_group(RGROUP)
+    server.state.add_hub(RGROUP, HUB)
+    backend = iot_rest.RestBackend(subscription=fake_azure.SUBSCRIPTION, token='fake',
+                                   arm_endpoint=server.url, hub_endpoint=server.url,
+                                   scheduler=iot_scheduler.Scheduler(limits))
+    try:
+        start = time.time()
+        identities = fn(backend, devices)
+        elapsed = time.time() - start
+        check(server, identities, devices)
+    finally:
+        backend.close()
+        server.stop()
+    requests = server.state.requests
+    print("%-16s %7.2fs  %5d requests  %8.1f devices/second" % (name, elapsed, requests, len(devices) / elapsed))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=500, help='Number of device identities to register.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of network round-trip per call.')
+    parser.add_argument('--rate-limits', action='store_true', help='Apply the default rate limits of the client.')
+    args = parser.parse_args()
+    limits = None if args.rate_limits else {}
+
+    devices = ['device%05d' % i for i in range(args.devices)]
+    single = run('one at a time', one_at_a_time, devices, args.latency, limits)
+    batched = run('bulk', bulk, devices, args.latency, limits)
+    print("speedup:         %.1fx" % (single / batched))
+
+
+if __name__ == '__main__':
+    main()
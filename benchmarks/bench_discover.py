@@ -0,0 +1,87 @@
+"""Offline benchmark of iot discover.
+
+Starts fake Raspberry Pis (fake_device) and IoT buttons (fake_button) on
+addresses of the 127.0.0.0/24 loopback block, all Pis sharing one port and
+all buttons another, points the scanner at those ports and runs
+`iot discover 127.0.0.0/24`. Reports how long the scan took and checks that
+exactly the fake Pis end up in the inventory. Linux routes the whole
+127.0.0.0/8 block to the loopback interface; other platforms may not.
+Usage:
+
+    python benchmarks/bench_discover.py [--devices 20] [--buttons 5]
+"""
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_button
+import fake_device
+
+# Fakes are placed on 127.0.0.FIRST_HOST and up
+FIRST_HOST = 10
+
+
+def start_fakes(root, devices, buttons):
+    """Returns the started fakes, Pis first, on consecutive loopback addresses"""
+    fakes = []
+    ssh_port = http_port = 0
+    for number in range(devices + buttons):
+        address = '127.0.0.%d' % (FIRST_HOST + number)
+        if number < devices:
+            home = os.path.join(root, address)
+            os.mkdir(home)
+            fake = fake_device.FakeDevice(home, address=address, port=ssh_port).start()
+            ssh_port = fake.port
+        else:
+            fake = fake_button.FakeButton(address=address, port=http_port).start()
+            http_port = fake.port
+        fakes.append(fake)
+    return fakes, ssh_port, http_port
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=20, help='Fake Raspberry Pis to start.')
+    parser.add_argument('--buttons', type=int, default=5, help='Fake IoT buttons to start.')
+    args = parser.parse_args()
+    if args.devices < 1 or args.buttons < 0 or FIRST_HOST + args.devices + args.buttons > 254:
+        parser.error('between 1 and %d fakes fit in the block' % (254 - FIRST_HOST))
+
+    from click.testing import CliRunner
+    import iot
+    import iot_reachability
+
+    tmp = tempfile.mkdtemp()
+    fakes, iot_reachability.SSH_PORT, iot_reachability.HTTP_PORT = start_fakes(tmp, args.devices, args.buttons)
+    try:
+        inventory = os.path.join(tmp, 'inventory.csv')
+        start = time.time()
+        result = CliRunner().invoke(iot.cli, ['discover', '127.0.0.0/24', '--output', inventory])
+        seconds = time.time() - start
+        if result.exit_code != 0 or result.exception:
+            raise RuntimeError("discover failed (exit status %s):\n%s%r" % (result.exit_code, result.output, result.exception))
+        with open(inventory) as f:
+            found = sorted(row['ip'] for row in csv.DictReader(f))
+        buttons = [line for line in result.output.splitlines() if ' button ' in line]
+    finally:
+        for fake in fakes:
+            fake.stop()
+        shutil.rmtree(tmp)
+
+    expected = sorted('127.0.0.%d' % (FIRST_HOST + number) for number in range(args.devices))
+    print('scanned:         254 addresses in %.3fs' % seconds)
+    print('grove kits:      %d of %d in the inventory' % (len(set(found) & set(expected)), len(expected)))
+    print('buttons:         %d of %d listed' % (len(buttons), args.buttons))
+    sys.exit(0 if found == expected and len(buttons) == args.buttons else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Offline end-to-end benchmark of configure-device and configure-button.
+
+Runs the real commands in-process against local stand-ins: the stubbed az
+CLI (fake_az) with a configurable latency, an SSH/SFTP server playing the
+Raspberry Pi (fake_device) and an HTTP server playing the IoT button's access
+point (fake_button). configure-device is run twice, first against an empty
+device and then again against the provisioned one. For every run the wall
+time, the number of az processes started, SSH commands run and bytes sent to
+the device or button are reported and compared with e2e_baseline.json; the
+script exits with status 1 on a regression. Usage:
+
+    python benchmarks/bench_e2e.py [--az-latency 0.3] [--files 50] [--update]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_az
+import fake_button
+import fake_device
+
+BASELINE_PATH = os.path.join(HERE, 'e2e_baseline.json')
+
+# Metrics compared with the baseline; counts may not grow at all, times by --tolerance
+COUNT_METRICS = ('az_calls', 'ssh_commands', 'bytes_to_device', 'bytes_to_button')
+TIME_METRICS = ('seconds',)
+
+COMMON_ARGS = ['--resource-group', 'benchrg', '--iothub', 'benchhub', '--device', 'benchdevice',
+               '--container-registry', 'benchregistry', '--wifi-ssid', 'benchwifi', '--wifi-password', 'benchpass',
+               '--device-ip', '127.0.0.1']
+
+
+def build_scripts(path, files, size):
+    """Writes a scripts archive shaped like the real one: runner.sh plus support files"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('runner.sh', '#!/bin/sh\necho provisioning\n')
+        for number in range(files):
+            archive.writestr('lib/file%03d.sh' % number, os.urandom(size))
+
+
+def runner_handler(started):
+    """Records runner.sh invocations instead of running them; anything else
+    (the file manifest) falls through to the fake device's shell"""
+    def handle(channel, command):
+        if command.startswith('sudo nohup') and './scripts/runner.sh' in command:
+            started.append(command)
+            return 0
+        return None
+    return handle
+
+
+class Harness(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp()
+        self.az_log = os.path.join(self.tmp, 'az.log')
+        self.scripts = os.path.join(self.tmp, 'scripts.zip')
+        self.home = os.path.join(self.tmp, 'home')
+        self.runners = []
+        os.mkdir(self.home)
+        build_scripts(self.scripts, args.files, args.file_size)
+
+        stub_dir = os.path.join(self.tmp, 'bin')
+        os.mkdir(stub_dir)
+        fake_az.install(stub_dir)
+        os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_AZ_LATENCY'] = str(args.az_latency)
+        os.environ['FAKE_AZ_LOG'] = self.az_log
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
+        open(self.az_log, 'w').close()
+
+        self.device = fake_device.FakeDevice(self.home, handler=runner_handler(self.runners)).start()
+        self.button = fake_button.FakeButton(latency=args.button_latency).start()
+
+    def point_cli_at_fakes(self, iot):
+        import iot_reachability
+
+        iot_reachability.SSH_PORT = self.device.port
+        # the internet check and the button's access point are both answered by the fake button
+        iot_reachability.HTTP_PORT = self.button.port
+        iot.INTERNET_CHECK_HOST = '127.0.0.1'
+        iot.DEFAULT_WIFI_AP_ADDRESS = '127.0.0.1'
+        iot.WIFI_SETTLE_TIME = self.args.settle
+
+    def counters(self):
+        with open(self.az_log) as f:
+            az_calls = len(f.readlines())
+        return {
+            'az_calls': az_calls,
+            'ssh_commands': self.device.counters['commands'],
+            'bytes_to_device': self.device.counters['bytes_written'],
+            'bytes_to_button': self.button.counters['bytes_received'],
+        }
+
+    def run(self, cli, name, args, stdin=None):
+        from click.testing import CliRunner
+
+        before = self.counters()
+        start = time.time()
+        result = CliRunner().invoke(cli, args, input=stdin)
+        seconds = time.time() - start
+        if result.exit_code != 0 or result.exception:
+            raise RuntimeError('%s failed (exit status %s):\n%s' % (name, result.exit_code, result.output))
+        after = self.counters()
+        metrics = dict((key, after[key] - before[key]) for key in after)
+        metrics['seconds'] = seconds
+        return metrics
+
+    def close(self):
+        self.device.stop()
+        self.button.stop()
+        shutil.rmtree(self.tmp)
+
+
+def run_scenarios(harness):
+    import iot
+
+    harness.point_cli_at_fakes(iot)
+    device_args = COMMON_ARGS + ['--scripts-path', harness.scripts, 'configure-device']
+    results = {}
+    results['configure-device (new device)'] = harness.run(iot.cli, 'configure-device', device_args)
+    if len(harness.runners) != 1 or not os.path.exists(os.path.join(harness.home, 'scripts', 'runner.sh')):
+        raise RuntimeError('configure-device did not install and start the scripts')
+    results['configure-device (provisioned)'] = harness.run(iot.cli, 'configure-device', device_args)
+    # decline the sample function app
+    results['configure-button'] = harness.run(iot.cli, 'configure-button', COMMON_ARGS + ['configure-button'],
+                                              stdin='n\n')
+    if not harness.button.configured:
+        raise RuntimeError('configure-button did not switch the button to client mode')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressed = []
+    for scenario in sorted(results):
+        metrics = results[scenario]
+        base = baseline.get(scenario, {})
+        print(scenario)
+        for key in TIME_METRICS + COUNT_METRICS:
+            value = metrics[key]
+            if key in TIME_METRICS:
+                limit = base.get(key, value) * (1 + tolerance)
+                text = '%.3fs (baseline %.3fs)' % (value, base.get(key, value))
+            else:
+                limit = base.get(key, value)
+                text = '%d (baseline %d)' % (value, base.get(key, value))
+            status = 'ok' if value <= limit else 'REGRESSED'
+            if status != 'ok':
+                regressed.append('%s %s' % (scenario, key))
+            print('  %-16s %-32s %s' % (key + ':', text, status))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--az-latency', type=float, default=0.3, help='Seconds each az call takes.')
+    parser.add_argument('--button-latency', type=float, default=0.05, help='Seconds each button request takes.')
+    parser.add_argument('--settle', type=float, default=0, help='Seconds to wait for the device WiFi to settle.')
+    parser.add_argument('--files', type=int, default=50, help='Support files in the scripts archive.')
+    parser.add_argument('--file-size', type=int, default=4096, help='Size of each support file in bytes.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed slowdown relative to the baseline (0.5 = 50%%).')
+    parser.add_argument('--update', action='store_true', help='Record the results as the new baseline.')
+    args = parser.parse_args()
+
+    harness = Harness(args)
+    try:
+        results = run_scenarios(harness)
+    finally:
+        harness.close()
+
+    if args.update or not os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(dict((scenario, dict((k, round(v, 3)) for k, v in metrics.items()))
+                           for scenario, metrics in results.items()), f, indent=2, sort_keys=True)
+            f.write('\n')
+        baseline = results
+    else:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    regressed = compare(results, baseline, args.tolerance)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
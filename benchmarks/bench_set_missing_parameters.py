@@ -0,0 +1,66 @@
+"""Benchmarks set_missing_parameters against the stubbed az CLI.
+
+Compares dispatching the hub/device lookups one at a time with dispatching
+them concurrently. Usage:
+
+    python benchmarks/bench_set_missing_parameters.py [--latency 0.5] [--rounds 3]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_az
+import iot
+import iot_session
+
+
+def new_context():
+    ctx = iot.Iot()
+    ctx.set_config('rgroup', 'benchrg')
+    ctx.set_config('iothub', 'benchhub')
+    ctx.set_config('device', 'benchdevice')
+    return ctx
+
+
+def timed(max_workers, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        iot.set_missing_parameters(new_context(), max_workers=max_workers)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds each az call takes.')
+    parser.add_argument('--rounds', type=int, default=3, help='Rounds per mode; the best is reported.')
+    args = parser.parse_args()
+
+    stub_dir = tempfile.mkdtemp()
+    try:
+        fake_az.install(stub_dir)
+        os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_AZ_LATENCY'] = str(args.latency)
+
+        sequential = timed(1, args.rounds)
+        concurrent = timed(iot_session.MAX_CONCURRENT_LOOKUPS, args.rounds)
+    finally:
+        shutil.rmtree(stub_dir)
+
+    print("az latency:  %.3fs" % args.latency)
+    print("sequential:  %.3fs" % sequential)
+    print("concurrent:  %.3fs" % concurrent)
+    print("speedup:     %.2fx" % (sequential / concurrent))
+
+
+if __name__ == '__main__':
+    main()
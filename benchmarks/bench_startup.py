@@ -0,0 +1,137 @@
+"""Benchmarks how quickly the CLI starts.
+
+Measures, in fresh interpreters, the time to import the iot module, to print
+--help, and to reach the first interactive prompt of configure-device (with
+the stubbed az CLI on PATH and the internet check answered locally). Each
+figure is the best of several runs with bare interpreter startup subtracted.
+The results are compared with startup_baseline.json, and the script exits
+with status 1 if any of them regressed by more than the tolerance. Usage:
+
+    python benchmarks/bench_startup.py [--runs 5] [--tolerance 0.5] [--update]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import fake_az
+
+BASELINE_PATH = os.path.join(HERE, 'startup_baseline.json')
+
+# Printed by prompt_for_resource_group when no --resource-group is given
+FIRST_PROMPT = b'Enter a Resource Group name'
+
+# Runs the CLI with the internet check short-circuited, so the benchmark works offline
+LAUNCHER = """
+import sys
+import iot_reachability
+
+def reachable(host, port, deadline=None):
+    result = iot_reachability.ProbeResult(host, port)
+    result.reachable = True
+    result.elapsed = 0.0
+    return result
+
+iot_reachability.wait_until_reachable = reachable
+import iot
+sys.argv[0] = 'iot'
+iot.cli()
+"""
+
+
+def time_command(args, env):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call(args, cwd=ROOT, env=env, stdout=devnull)
+        return time.time() - start
+
+
+def time_to_prompt(env):
+    """Starts configure-device and returns the seconds until the first prompt is printed"""
+    start = time.time()
+    args = [sys.executable, '-c', LAUNCHER, '--wifi-ssid', 'bench', '--wifi-password', 'bench', 'configure-device']
+    process = subprocess.Popen(args, cwd=ROOT, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        output = b''
+        while FIRST_PROMPT not in output:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError('CLI exited before prompting:\n' + output.decode('utf-8', 'replace'))
+            output += chunk
+        return time.time() - start
+    finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stdin.close()
+
+
+def measure(runs):
+    stub_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        fake_az.install(stub_dir)
+        env = dict(os.environ)
+        env['PATH'] = stub_dir + os.pathsep + env['PATH']
+        env['PYTHONPATH'] = ROOT
+        env['XDG_CACHE_HOME'] = cache_dir
+        env['FAKE_AZ_LATENCY'] = '0'
+
+        measurements = {
+            'interpreter': lambda: time_command([sys.executable, '-c', 'pass'], env),
+            'import': lambda: time_command([sys.executable, '-c', 'import iot'], env),
+            'help': lambda: time_command([sys.executable, '-c', LAUNCHER, '--help'], env),
+            'first_prompt': lambda: time_to_prompt(env),
+        }
+        # interleave the measurements so that system noise affects them all alike
+        results = {}
+        for _ in range(runs):
+            for name, run in measurements.items():
+                results[name] = min(results.get(name, float('inf')), run())
+    finally:
+        shutil.rmtree(stub_dir)
+        shutil.rmtree(cache_dir)
+    interpreter = results.pop('interpreter')
+    return dict((name, max(0.0, seconds - interpreter)) for name, seconds in results.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Runs per measurement; the best is reported.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed slowdown relative to the baseline (0.5 = 50%%).')
+    parser.add_argument('--update', action='store_true', help='Record the results as the new baseline.')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+
+    if args.update or not os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(dict((k, round(v, 4)) for k, v in results.items()), f, indent=2, sort_keys=True)
+            f.write('\n')
+        baseline = results
+    else:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    regressed = []
+    for name in sorted(results):
+        limit = baseline.get(name, results[name]) * (1 + args.tolerance)
+        status = 'ok' if results[name] <= limit else 'REGRESSED'
+        if status != 'ok':
+            regressed.append(name)
+        print("%-13s %.3fs  (baseline %.3fs)  %s" % (name + ':', results[name], baseline.get(name, 0), status))
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
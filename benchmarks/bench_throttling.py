@@ -0,0 +1,68 @@
+"""Updates device twins concurrently against a local IoT Hub stand-in that
+answers every n-th request with 429 and a Retry-After, once without retries
+and once through the default scheduler, and reports how many updates went
+through and what the scheduler counted. Usage:
+
+    python benchmarks/bench_throttling.py [--devices 200] [--throttle-every 10] [--retry-after 1]
+"""
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_azure
+import iot_rest
+import iot_scheduler
+
+RGROUP = 'benchrg'
+HUB = 'benchhub'
+
+
+def run(name, scheduler, devices, args):
+    server = fake_azure.FakeAzure(latency=args.latency).start()
+    server.state.add_group(RGROUP)
+    server.state.add_hub(RGROUP, HUB)
+    for device in devices:
+        server.state.add_device(device)
+    backend = iot_rest.RestBackend(subscription=fake_azure.SUBSCRIPTION, token='fake',
+                                   arm_endpoint=server.url, hub_endpoint=server.url, scheduler=scheduler)
+    try:
+        # resolve the hub before throttling starts, as a real run would have
+        backend.hub_connection_string(RGROUP, HUB)
+        server.state.throttle(args.throttle_every, args.retry_after)
+        start = time.time()
+        results = backend.update_devices_tags(RGROUP, HUB, dict((d, {'id': d}) for d in devices))
+        elapsed = time.time() - start
+    finally:
+        backend.close()
+        server.stop()
+    failed = len([err for _, err in results.values() if err])
+    print("%-16s %6.2fs  %4d updated  %4d failed  %4d answered with 429" %
+          (name, elapsed, len(devices) - failed, failed, server.state.throttled))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=200, help='Number of twins to update.')
+    parser.add_argument('--throttle-every', type=int, default=10, help='Answer every n-th request with 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with each 429.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds of network round-trip per call.')
+    args = parser.parse_args()
+
+    devices = ['device%05d' % i for i in range(args.devices)]
+    run('no retries', iot_scheduler.Scheduler(limits={}, max_attempts=1), devices, args)
+    scheduler = iot_scheduler.Scheduler()
+    failed = run('scheduler', scheduler, devices, args)
+    print("")
+    print(scheduler.summary())
+    if failed:
+        raise SystemExit("%d updates failed despite retries" % failed)
+
+
+if __name__ == '__main__':
+    main()
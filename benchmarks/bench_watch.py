@@ -0,0 +1,113 @@
+"""Offline benchmark of iot watch.
+
+Starts fake Raspberry Pis (fake_device) on addresses of the 127.0.0.0/24
+loopback block, all sharing one port, whose `tail` of connect.log replays a
+setup log: the start marker, --lines lines (some of them progress meters
+redrawn with carriage returns) at random intervals and the exit marker,
+failing on every --fail-every-th device. Runs `iot watch` on an inventory of
+them and reports how long following every log took and how many lines per
+second were printed, and checks the status each device ended with. Linux
+routes the whole 127.0.0.0/8 block to the loopback interface; other
+platforms may not. Usage:
+
+    python benchmarks/bench_watch.py [--devices 100] [--lines 50] [--interval 0.02] [--fail-every 10]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fake_device
+
+# Fakes are placed on 127.0.0.FIRST_HOST and up
+FIRST_HOST = 10
+
+
+def replay_handler(lines, interval, status):
+    """Answers the tail of connect.log with a setup log ending in exit status"""
+    import iot_watch
+
+    def handle(channel, command):
+        if not command.startswith('tail '):
+            return None
+        try:
+            channel.sendall(('%s %d\n' % (iot_watch.STARTED_MARKER, time.time())).encode('utf-8'))
+            for number in range(lines):
+                time.sleep(random.uniform(0, 2 * interval))
+                if number % 10 == 5:
+                    line = ''.join('\r%3d%% downloaded' % percent for percent in range(0, 101, 5)) + '\n'
+                else:
+                    line = 'setup step %d\n' % number
+                channel.sendall(line.encode('utf-8'))
+            channel.sendall(('%s %d at %d\n' % (iot_watch.EXITED_MARKER, status, time.time())).encode('utf-8'))
+        except EOFError:
+            pass
+        return 0
+    return handle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=100, help='Fake Raspberry Pis to start.')
+    parser.add_argument('--lines', type=int, default=50, help='Lines of setup log per device.')
+    parser.add_argument('--interval', type=float, default=0.02, help='Average seconds between two lines.')
+    parser.add_argument('--fail-every', type=int, default=10, help='Every n-th device fails its setup.')
+    args = parser.parse_args()
+    if args.devices < 1 or FIRST_HOST + args.devices > 254:
+        parser.error('between 1 and %d fakes fit in the block' % (254 - FIRST_HOST))
+
+    from click.testing import CliRunner
+
+    import iot
+    import iot_reachability
+
+    tmp = tempfile.mkdtemp()
+    fakes = []
+    expected = {}
+    try:
+        port = 0
+        inventory = os.path.join(tmp, 'inventory.csv')
+        with open(inventory, 'w') as f:
+            f.write('ip,device\n')
+            for number in range(args.devices):
+                address = '127.0.0.%d' % (FIRST_HOST + number)
+                device = 'grove-%03d' % number
+                status = 1 if args.fail_every and (number + 1) % args.fail_every == 0 else 0
+                expected[device] = 'failed' if status else 'done'
+                fake = fake_device.FakeDevice(tmp, address=address, port=port,
+                                              handler=replay_handler(args.lines, args.interval, status)).start()
+                port = fake.port
+                fakes.append(fake)
+                f.write('%s,%s\n' % (address, device))
+        iot_reachability.SSH_PORT = port
+
+        start = time.time()
+        result = CliRunner().invoke(iot.cli, ['watch', inventory])
+        seconds = time.time() - start
+    finally:
+        for fake in fakes:
+            fake.stop()
+        shutil.rmtree(tmp)
+
+    output = result.output.splitlines()
+    statuses = {}
+    for line in output:
+        words = line.split()
+        if len(words) >= 2 and words[0] in expected and words[1] in ('done', 'failed', 'disconnected'):
+            statuses[words[0]] = words[1]
+    printed = len([line for line in output if ' | ' in line])
+    print("%d devices  %6.2fs  %6d lines  %8.1f lines/second" % (args.devices, seconds, printed, printed / seconds))
+    if statuses != expected:
+        wrong = sorted(d for d in expected if statuses.get(d) != expected[d])
+        raise SystemExit("Unexpected status for %d devices, e.g. %s:\n%s" % (len(wrong), wrong[0], result.output))
+
+
+if __name__ == '__main__':
+    main()
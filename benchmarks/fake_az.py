@@ -0,0 +1,116 @@
+"""Stand-in for the Azure CLI used by the offline benchmarks.
+
+install() writes an executable named 'az' into a directory which can then be
+put in front of PATH. Each invocation sleeps for FAKE_AZ_LATENCY seconds (to
+model interpreter startup plus the ARM round-trip), optionally appends its
+arguments to FAKE_AZ_LOG, and prints the canned JSON response registered for
+its subcommand. Responses can be overridden with a JSON file named by
+FAKE_AZ_RESPONSES that maps subcommands (e.g. "iot hub show") to output.
+"""
+import json
+import os
+import stat
+import sys
+
+HUB_HOSTNAME = 'benchhub.azure-devices.net'
+DEVICE_KEY = 'ZGV2aWNla2V5ZGV2aWNla2V5ZGV2aWNla2V5MDA='
+HUB_KEY = 'aHVia2V5aHVia2V5aHVia2V5aHVia2V5aHVia2V5MDA='
+
+DEFAULT_RESPONSES = {
+    'group exists': True,
+    'group create': {'name': 'benchrg', 'location': 'westus'},
+    'iot hub show': {
+        'name': 'benchhub',
+        'properties': {
+            'hostName': HUB_HOSTNAME,
+            'eventHubEndpoints': {
+                'events': {
+                    'endpoint': 'sb://benchhub-ns.servicebus.windows.net/',
+                    'path': 'benchhub'
+                }
+            }
+        }
+    },
+    'iot hub create': {'name': 'benchhub', 'properties': {'hostName': HUB_HOSTNAME}},
+    'iot hub show-connection-string': {
+        'cs': 'HostName=%s;SharedAccessKeyName=iothubowner;SharedAccessKey=%s' % (HUB_HOSTNAME, HUB_KEY)
+    },
+    'iot hub device-identity show': {
+        'deviceId': 'benchdevice',
+        'authentication': {'symmetricKey': {'primaryKey': DEVICE_KEY, 'secondaryKey': DEVICE_KEY}}
+    },
+    'iot hub device-identity create': {
+        'deviceId': 'benchdevice',
+        'authentication': {'symmetricKey': {'primaryKey': DEVICE_KEY, 'secondaryKey': DEVICE_KEY}}
+    },
+    'iot hub device-identity list': [{'deviceId': 'benchdevice'}],
+    'iot hub query': [{'deviceId': 'benchdevice'}],
+    'iot hub device-identity show-connection-string': {
+        'cs': 'HostName=%s;DeviceId=benchdevice;SharedAccessKey=%s' % (HUB_HOSTNAME, DEVICE_KEY)
+    },
+    'iot hub device-twin update': {'deviceId': 'benchdevice', 'tags': {}},
+    'acr list': [{'name': 'benchregistry'}],
+    'acr create': {'name': 'benchregistry'},
+    'acr credential show': {'username': 'benchregistry', 'passwords': [{'name': 'password', 'value': 'crpassword'}]},
+    'storage account list': [{'name': 'benchstorage'}],
+    'storage account create': {'name': 'benchstorage', 'provisioningState': 'Succeeded'},
+    'functionapp create': {'name': 'benchfunction', 'state': 'Running'},
+    'functionapp config appsettings set': [{'name': 'AzureIoTHubConnectionString', 'value': None}],
+    'functionapp deployment source config-zip': {'status': 4, 'complete': True},
+}
+
+STUB_TEMPLATE = """#!%(python)s
+import sys
+sys.path.insert(0, %(path)r)
+import fake_az
+sys.exit(fake_az.main(sys.argv[1:]))
+"""
+
+
+def install(directory):
+    """Writes the 'az' stub into directory and returns its path"""
+    path = os.path.join(directory, 'az')
+    with open(path, 'w') as f:
+        f.write(STUB_TEMPLATE % {'python': sys.executable, 'path': os.path.dirname(os.path.abspath(__file__))})
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def subcommand(args):
+    """Returns the positional words of an az command line, e.g. 'iot hub show'"""
+    words = []
+    for arg in args:
+        if arg.startswith('-'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+
+def main(args):
+    import time
+
+    latency = float(os.environ.get('FAKE_AZ_LATENCY', '0'))
+    if latency:
+        time.sleep(latency)
+
+    log = os.environ.get('FAKE_AZ_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(' '.join(args) + '\n')
+
+    responses = dict(DEFAULT_RESPONSES)
+    overrides = os.environ.get('FAKE_AZ_RESPONSES')
+    if overrides:
+        with open(overrides) as f:
+            responses.update(json.load(f))
+
+    name = subcommand(args)
+    if name not in responses:
+        sys.stderr.write("az: '%s' is not in the list of canned responses\n" % name)
+        return 2
+    sys.stdout.write(json.dumps(responses[name]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,327 @@
+"""Local HTTP stand-in for the parts of Azure Resource Manager and the IoT Hub
+service API used by iot_rest.RestBackend.
+
+    server = FakeAzure(latency=0.05)
+    server.start()
+    backend = iot_rest.RestBackend(subscription=fake_azure.SUBSCRIPTION, token='fake',
+                                   arm_endpoint=server.url, hub_endpoint=server.url)
+
+State is kept in memory. Every request sleeps for `latency` seconds to model
+the network round-trip, and the server speaks HTTP/1.1 so clients can keep
+their connections alive.
+"""
+import base64
+import json
+import os
+import re
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+SUBSCRIPTION = '00000000-0000-0000-0000-000000000000'
+HUB_KEY = base64.b64encode(b'h' * 32).decode('utf-8')
+
+# Page size used for device queries, small enough to exercise continuations
+QUERY_PAGE_SIZE = 100
+
+# Most identities accepted by one bulk registry request
+BULK_REGISTRY_LIMIT = 100
+
+GROUP = r'/subscriptions/[^/]+/resourcegroups/(?P<rgroup>[^/]+)'
+HUB = GROUP + r'/providers/microsoft\.devices/iothubs/(?P<hub>[^/]+)'
+REGISTRIES = GROUP + r'/providers/microsoft\.containerregistry/registries'
+REGISTRY = REGISTRIES + r'/(?P<registry>[^/]+)'
+STORAGE_ACCOUNTS = GROUP + r'/providers/microsoft\.storage/storageaccounts'
+STORAGE_ACCOUNT = STORAGE_ACCOUNTS + r'/(?P<account>[^/]+)'
+
+
+class State(object):
+    """Resources known to the stand-in"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.hubs = {}
+        self.devices = {}
+        self.registries = {}
+        self.storage_accounts = {}
+        self.requests = 0
+        self.throttled = 0
+        self.throttle_every = 0
+        self.retry_after = 1
+
+    def throttle(self, every, retry_after=1):
+        """Answers every n-th request with 429 Too Many Requests and a
+        Retry-After of retry_after seconds, like a hub over its quota"""
+        self.throttle_every = every
+        self.retry_after = retry_after
+
+    def add_group(self, rgroup, location='westus'):
+        self.groups[rgroup.lower()] = {'name': rgroup, 'location': location,
+                                       'properties': {'provisioningState': 'Succeeded'}}
+
+    def add_hub(self, rgroup, hub):
+        self.hubs[(rgroup.lower(), hub.lower())] = {
+            'name': hub,
+            'location': self.groups[rgroup.lower()]['location'],
+            'properties': {
+                'provisioningState': 'Succeeded',
+                'hostName': '%s.azure-devices.net' % hub,
+                'eventHubEndpoints': {'events': {'endpoint': 'sb://%s-ns.servicebus.windows.net/' % hub,
+                                                 'path': hub}}
+            }
+        }
+
+    def add_device(self, device, edge_enabled=False, key=None):
+        key = key or base64.b64encode(os.urandom(32)).decode('utf-8')
+        self.devices[device] = {
+            'deviceId': device,
+            'status': 'enabled',
+            'capabilities': {'iotEdge': edge_enabled},
+            'authentication': {'type': 'sas', 'symmetricKey': {'primaryKey': key, 'secondaryKey': key}},
+            'tags': {}
+        }
+        return self.devices[device]
+
+    def add_registry(self, rgroup, registry):
+        self.registries[(rgroup.lower(), registry.lower())] = {
+            'name': registry,
+            'properties': {'provisioningState': 'Succeeded', 'adminUserEnabled': True,
+                           'loginServer': '%s.azurecr.io' % registry}
+        }
+
+    def add_storage_account(self, rgroup, account):
+        self.storage_accounts[(rgroup.lower(), account.lower())] = {
+            'name': account,
+            'kind': 'Storage',
+            'properties': {'provisioningState': 'Succeeded'}
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        payload = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+    def _dispatch(self):
+        state = self.server.state
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = self.path.split('?', 1)[0]
+        body = self._body()
+        with state.lock:
+            state.requests += 1
+            if state.throttle_every and state.requests % state.throttle_every == 0:
+                state.throttled += 1
+                return self._send(429, {'Message': 'ThrottlingException'},
+                                  {'Retry-After': str(state.retry_after)})
+            for method, pattern, handler in ROUTES:
+                match = re.match(pattern + '$', path, re.I)
+                if match and method == self.command:
+                    status, response, headers = handler(self, state, body, **match.groupdict())
+                    return self._send(status, response, headers)
+        self._send(404, {'error': {'code': 'NotFound', 'message': path}})
+
+    do_GET = do_PUT = do_POST = do_PATCH = do_HEAD = do_DELETE = _dispatch
+
+
+def _not_found(what):
+    return 404, {'error': {'code': 'ResourceNotFound', 'message': '%s not found' % what}}, None
+
+
+def head_group(handler, state, body, rgroup):
+    return (204 if rgroup.lower() in state.groups else 404), None, None
+
+
+def get_group(handler, state, body, rgroup):
+    if rgroup.lower() not in state.groups:
+        return _not_found(rgroup)
+    return 200, state.groups[rgroup.lower()], None
+
+
+def put_group(handler, state, body, rgroup):
+    state.add_group(rgroup, body['location'])
+    return 201, state.groups[rgroup.lower()], None
+
+
+def get_hub(handler, state, body, rgroup, hub):
+    if (rgroup.lower(), hub.lower()) not in state.hubs:
+        return _not_found(hub)
+    return 200, state.hubs[(rgroup.lower(), hub.lower())], None
+
+
+def put_hub(handler, state, body, rgroup, hub):
+    if rgroup.lower() not in state.groups:
+        return _not_found(rgroup)
+    state.add_hub(rgroup, hub)
+    return 201, state.hubs[(rgroup.lower(), hub.lower())], None
+
+
+def list_hub_keys(handler, state, body, rgroup, hub):
+    if (rgroup.lower(), hub.lower()) not in state.hubs:
+        return _not_found(hub)
+    return 200, {'value': [{'keyName': 'iothubowner', 'primaryKey': HUB_KEY, 'secondaryKey': HUB_KEY,
+                            'rights': 'RegistryWrite, ServiceConnect, DeviceConnect'}]}, None
+
+
+def list_registries(handler, state, body, rgroup):
+    return 200, {'value': [r for (g, _), r in sorted(state.registries.items()) if g == rgroup.lower()]}, None
+
+
+def get_registry(handler, state, body, rgroup, registry):
+    if (rgroup.lower(), registry.lower()) not in state.registries:
+        return _not_found(registry)
+    return 200, state.registries[(rgroup.lower(), registry.lower())], None
+
+
+def put_registry(handler, state, body, rgroup, registry):
+    state.add_registry(rgroup, registry)
+    return 200, state.registries[(rgroup.lower(), registry.lower())], None
+
+
+def list_registry_credentials(handler, state, body, rgroup, registry):
+    if (rgroup.lower(), registry.lower()) not in state.registries:
+        return _not_found(registry)
+    return 200, {'username': registry, 'passwords': [{'name': 'password', 'value': 'crpassword'},
+                                                     {'name': 'password2', 'value': 'crpassword2'}]}, None
+
+
+def list_storage_accounts(handler, state, body, rgroup):
+    return 200, {'value': [a for (g, _), a in sorted(state.storage_accounts.items()) if g == rgroup.lower()]}, None
+
+
+def get_storage_account(handler, state, body, rgroup, account):
+    if (rgroup.lower(), account.lower()) not in state.storage_accounts:
+        return _not_found(account)
+    return 200, state.storage_accounts[(rgroup.lower(), account.lower())], None
+
+
+def put_storage_account(handler, state, body, rgroup, account):
+    # like ARM, storage accounts are created asynchronously
+    state.add_storage_account(rgroup, account)
+    return 202, None, None
+
+
+def query_devices(handler, state, body):
+    ids = sorted(state.devices)
+    start = int(handler.headers.get('x-ms-continuation') or 0)
+    size = min(int(handler.headers.get('x-ms-max-item-count') or QUERY_PAGE_SIZE), QUERY_PAGE_SIZE)
+    page = ids[start:start + size]
+    if body['query'].upper().startswith('SELECT DEVICEID '):
+        twins = [{'deviceId': i} for i in page]
+    else:
+        twins = [dict((k, v) for k, v in state.devices[i].items() if k != 'authentication') for i in page]
+    headers = {}
+    if start + size < len(ids):
+        headers['x-ms-continuation'] = str(start + size)
+    return 200, twins, headers
+
+
+def get_device(handler, state, body, device):
+    if device not in state.devices:
+        return _not_found(device)
+    return 200, state.devices[device], None
+
+
+def put_device(handler, state, body, device):
+    if device in state.devices:
+        return 409, {'Message': 'DeviceAlreadyExists'}, None
+    key = body.get('authentication', {}).get('symmetricKey', {}).get('primaryKey')
+    return 200, state.add_device(device, body.get('capabilities', {}).get('iotEdge', False), key), None
+
+
+def bulk_devices(handler, state, body):
+    if not isinstance(body, list) or len(body) > BULK_REGISTRY_LIMIT:
+        return 400, {'Message': 'TooManyDevices'}, None
+    errors = []
+    for entry in body:
+        if entry.get('importMode') != 'create':
+            errors.append({'deviceId': entry['id'], 'errorCode': 'ArgumentInvalid',
+                           'errorStatus': 'Unsupported import mode %s' % entry.get('importMode')})
+        elif entry['id'] in state.devices:
+            errors.append({'deviceId': entry['id'], 'errorCode': 'DeviceAlreadyExists',
+                           'errorStatus': 'A device with ID %s is already registered.' % entry['id']})
+        else:
+            key = entry.get('authentication', {}).get('symmetricKey', {}).get('primaryKey')
+            state.add_device(entry['id'], entry.get('capabilities', {}).get('iotEdge', False), key)
+    # like IoT Hub, a request with failed devices is answered with 400 and still creates the others
+    return (400 if errors else 200), {'isSuccessful': not errors, 'errors': errors, 'warnings': []}, None
+
+
+def patch_twin(handler, state, body, device):
+    if device not in state.devices:
+        return _not_found(device)
+    state.devices[device]['tags'].update(body.get('tags', {}))
+    return 200, state.devices[device], None
+
+
+ROUTES = [
+    ('HEAD', GROUP, head_group),
+    ('GET', GROUP, get_group),
+    ('PUT', GROUP, put_group),
+    ('GET', HUB, get_hub),
+    ('PUT', HUB, put_hub),
+    ('POST', HUB + '/listkeys', list_hub_keys),
+    ('GET', REGISTRIES, list_registries),
+    ('GET', REGISTRY, get_registry),
+    ('PUT', REGISTRY, put_registry),
+    ('POST', REGISTRY + '/listCredentials', list_registry_credentials),
+    ('GET', STORAGE_ACCOUNTS, list_storage_accounts),
+    ('GET', STORAGE_ACCOUNT, get_storage_account),
+    ('PUT', STORAGE_ACCOUNT, put_storage_account),
+    ('POST', r'/devices', bulk_devices),
+    ('POST', r'/devices/query', query_devices),
+    ('GET', r'/devices/(?P<device>[^/]+)', get_device),
+    ('PUT', r'/devices/(?P<device>[^/]+)', put_device),
+    ('PATCH', r'/twins/(?P<device>[^/]+)', patch_twin),
+]
+
+
+class FakeAzureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeAzure(object):
+    """Runs the stand-in on a background thread bound to 127.0.0.1"""
+
+    def __init__(self, latency=0.0, port=0, state=None):
+        self.state = state or State()
+        self.server = FakeAzureServer(('127.0.0.1', port), Handler)
+        self.server.state = self.state
+        self.server.latency = latency
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,132 @@
+"""Local HTTP stand-in for the configuration access point of the teXXmo IoT
+button, used by the offline end-to-end benchmarks.
+
+    button = FakeButton(latency=0.05).start()
+    ... POST to button.url + '/config/wifi' ...
+    button.stop()
+
+Like the real button it serves a configuration page at / with a form for
+each of its /config/ endpoints (what iot discover recognises it by), accepts
+the Wi-Fi, IoT Hub and operation mode settings as JSON posts, and drops the connection without answering once it
+is switched to client mode. Every accepted setting is kept in `settings`.
+"""
+import json
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+WIFI_PATH = '/config/wifi'
+IOTHUB_PATH = '/config/iothub'
+OPSMODE_PATH = '/config/opsmode'
+
+CONFIG_PAGE_PATH = '/'
+
+REQUIRED_FIELDS = {
+    WIFI_PATH: ('ssid', 'password'),
+    IOTHUB_PATH: ('iothub', 'iotdevicename', 'iotdevicesecret'),
+    OPSMODE_PATH: ('opsmode',),
+}
+
+
+CONFIG_PAGE = ''.join(
+    ['<html><head><title>IoT Button</title></head><body>'] +
+    ['<form method="post" action="%s">%s</form>' % (path, ''.join('<input name="%s">' % field for field in fields))
+     for path, fields in sorted(REQUIRED_FIELDS.items())] +
+    ['</body></html>'])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        payload = (json.dumps(body) if content_type == 'application/json' else body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != CONFIG_PAGE_PATH:
+            return self._send(404, {'error': 'not found'})
+        self._send(200, CONFIG_PAGE, 'text/html')
+
+    def do_POST(self):
+        button = self.server.button
+        if button.latency:
+            time.sleep(button.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        with button.lock:
+            button.counters['requests'] += 1
+            button.counters['bytes_received'] += length
+
+        if self.path not in REQUIRED_FIELDS:
+            return self._send(404, {'error': 'not found'})
+        try:
+            # the CLI sends the operation mode with single quotes, which the button tolerates
+            settings = json.loads(data.decode('utf-8').replace("'", '"'))
+        except ValueError:
+            return self._send(400, {'error': 'invalid json'})
+        missing = [field for field in REQUIRED_FIELDS[self.path] if field not in settings]
+        if missing:
+            return self._send(400, {'error': 'missing ' + ', '.join(missing)})
+
+        with button.lock:
+            button.settings[self.path] = settings
+        if self.path == OPSMODE_PATH:
+            # the button leaves access point mode without answering
+            self.close_connection = True
+            return
+        self._send(200, {'result': 'ok'})
+
+
+class FakeButtonServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeButton(object):
+    """Runs the stand-in on a background thread bound to 127.0.0.1"""
+
+    def __init__(self, latency=0.0, port=0, address='127.0.0.1'):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.settings = {}
+        self.counters = {'requests': 0, 'bytes_received': 0}
+        self.server = FakeButtonServer((address, port), Handler)
+        self.server.button = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def address(self):
+        return self.server.server_address[0]
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.address, self.port)
+
+    @property
+    def configured(self):
+        return self.settings.get(OPSMODE_PATH, {}).get('opsmode') == 'client'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,235 @@
+"""In-process SSH/SFTP server standing in for the Raspberry Pi of a Grove
+Starter Kit, used by the offline end-to-end benchmarks.
+
+    device = FakeDevice(home_directory).start()
+    ... connect to 127.0.0.1:device.port as pi / raspberry ...
+    device.stop()
+
+SFTP paths resolve inside the home directory. Commands are first offered to
+handler(channel, command), if one is given, which sends any output itself
+and returns the exit status; commands it returns None for run in a local
+shell from the home directory. `counters` tracks
+connections, commands, files opened and bytes written over SFTP.
+"""
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+# Identification string sent on connect, as iot discover fingerprints Raspberry Pis by it
+BANNER = 'SSH-2.0-OpenSSH_7.4p1 Raspbian-10+deb9u7'
+
+# Probes that hang up after the banner make paramiko log a traceback per connection
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+_host_key = []
+
+
+def host_key():
+    """Generated on first use, as RSA key generation takes a moment"""
+    if not _host_key:
+        _host_key.append(paramiko.RSAKey.generate(2048))
+    return _host_key[0]
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def __init__(self, flags, counters):
+        super(_SFTPHandle, self).__init__(flags)
+        self.counters = counters
+
+    def write(self, offset, data):
+        self.counters['bytes_written'] += len(data)
+        return super(_SFTPHandle, self).write(offset, data)
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+
+    def __init__(self, server, *args, **kwargs):
+        super(_SFTPServer, self).__init__(server, *args, **kwargs)
+        self.server = server
+        self.root = server.root
+
+    def _path(self, path):
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def _error(self, e):
+        return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(self._path(path), n)), n)
+                    for n in os.listdir(self._path(path))]
+        except OSError as e:
+            return self._error(e)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return self._error(e)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return self._error(e)
+        mode = 'wb' if flags & os.O_WRONLY else ('r+b' if flags & os.O_RDWR else 'rb')
+        handle = _SFTPHandle(flags, self.server.counters)
+        f = os.fdopen(fd, mode)
+        handle.readfile = f
+        handle.writefile = f
+        self.server.counters['sftp_files'] += 1
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return self._error(e)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        os.rename(self._path(oldpath), self._path(newpath))
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return self._error(e)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return self._error(e)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        if attr.st_mode is not None:
+            os.chmod(self._path(path), attr.st_mode & 0o7777)
+        return paramiko.SFTP_OK
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.root = fake.root
+        self.counters = fake.counters
+        # commands of exec requests whose reply has not been sent yet, by channel id
+        self.queued = {}
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.fake.user, self.fake.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_exec_request(self, channel, command):
+        self.counters['commands'] += 1
+        command = command.decode('utf-8') if isinstance(command, bytes) else command
+        self.fake.commands.append(command)
+        self.queued[channel.get_id()] = command
+        return True
+
+    def handle_request(self, channel, m):
+        """Channel._handle_request, then the command an exec request queued. The
+        command only starts once the request was acknowledged, or its exit
+        status and close could overtake the reply and fail exec_command."""
+        paramiko.Channel._handle_request(channel, m)
+        command = self.queued.pop(channel.get_id(), None)
+        if command is not None:
+            threading.Thread(target=self.fake._exec, args=(channel, command)).start()
+
+
+class FakeDevice(object):
+    """SSH server on a free port of 127.0.0.1 (or of address, on port if one is
+    given) whose home directory is root. It introduces itself with the banner
+    of Raspbian's OpenSSH."""
+
+    def __init__(self, root, user='pi', password='raspberry', handler=None, address='127.0.0.1', port=0):
+        self.root = root
+        self.user = user
+        self.password = password
+        self.handler = handler
+        self.commands = []
+        self.counters = {'connections': 0, 'commands': 0, 'sftp_files': 0, 'bytes_written': 0}
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((address, port))
+        self.sock.listen(50)
+        self.transports = []
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def start(self):
+        host_key()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            self.counters['connections'] += 1
+            # negotiation blocks, so each connection gets its own thread (reachability probes hang up early)
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.local_version = BANNER
+        transport.add_server_key(host_key())
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPServer)
+        self.transports.append(transport)
+        server = _Server(self)
+        transport._channel_handler_table = dict(transport._channel_handler_table)
+        transport._channel_handler_table[paramiko.common.MSG_CHANNEL_REQUEST] = server.handle_request
+        try:
+            transport.start_server(server=server)
+        except (paramiko.SSHException, EOFError, socket.error):
+            transport.close()
+
+    def _exec(self, channel, command):
+        status = self.handler(channel, command) if self.handler else None
+        if status is None:
+            p = subprocess.Popen(command, shell=True, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            channel.sendall(out)
+            channel.sendall_stderr(err)
+            status = p.returncode
+        channel.send_exit_status(status)
+        channel.close()
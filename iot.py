@@ -1,34 +1,41 @@
+import functools
 import json
 import os
 import subprocess
 import sys
-import tempfile
 import time
-try:
-    from urllib import urlretrieve
-except ImportError:
-    from urllib.request import urlretrieve
-
-import zipfile
 
 import click
-import paramiko
-import requests
-import platform
+import iot_backends
+import iot_cache
+import iot_credentials
+import iot_discovery
+import iot_fleet
+import iot_journal
+import iot_operations
+import iot_profile
+import iot_reachability
+import iot_scheduler
+import iot_session
+import iot_ssh
+import iot_tasks
+import iot_watch
+
+# requests, tempfile, concurrent.futures, iot_artifacts, iot_button and iot_rest (and paramiko,
+# by iot_session) are imported by the functions that need them so that starting the CLI (and
+# printing --help) does not pay for loading them.
 
-from scp import SCPClient
+DEFAULT_WIFI_AP_ADDRESS = '192.168.4.1'
 
-osPlat = platform.system()
+# Host used to check for internet access
+INTERNET_CHECK_HOST = 'www.microsoft.com'
 
-BUTTON_WIFI_URI = 'http://192.168.4.1/config/wifi'
-BUTTON_HUB_URI = 'http://192.168.4.1/config/iothub'
-BUTTON_CONFIG_URI = 'http://192.168.4.1/config/opsmode'
-BUTTON_HEADERS = {'Content-type':'application/json', 'Accept':'application/json'}
-BUTTON_WIFI_PAYLOAD = '{"ssid":"%s","password":"%s"}'
-BUTTON_HUB_PAYLOAD = '{"iothub":"%s","iotdevicename":"%s","iotdevicesecret":"%s"}'
-BUTTON_CONFIG_PAYLOAD = "{'opsmode':'client'}"
+# Seconds to wait for a host to become reachable before asking the user to check the network
+INTERNET_PROBE_DEADLINE = 10
+DEVICE_PROBE_DEADLINE = 30
 
-DEFAULT_WIFI_AP_ADDRESS = '192.168.4.1'
+# Seconds to let the device's WiFi connection settle once it is reachable
+WIFI_SETTLE_TIME = 5
 
 FUNCTION_APP_INDEX_JS_FILE = """module.exports = function (context, IoTHubMessages) {
     context.log(`JavaScript eventhub trigger function called for message array ${IoTHubMessages}`);
@@ -55,7 +62,11 @@ FUNCTION_APP_JSON_FILE = """{
     ]
     }"""
 
-SCRIPTS_ZIP_URI = 'http://iotcompanionapp.blob.core.windows.net/scripts/scripts.zip'
+# Default number of buttons configure-buttons configures at the same time
+MAX_BUTTON_WORKERS = 4
+
+# Virtual devices simulate connects per second, as many as one S1 IoT Hub unit accepts
+SIMULATE_CONNECT_RATE = 100
 LOCATION_OPTIONS = [
     'eastus', 'eastus2', 'centralus', 'southcentralus', 'westcentralus', 'westus',
     'westus2', 'canadaeast', 'canadacentral', 'brazilsouth', 'northeurope',
@@ -66,83 +77,152 @@ LOCATION_OPTIONS = [
 
 CONTAINER_REGISTRY_SKUS = ['Basic', 'Standard', 'Premium', 'Classic']
 
-DEVICE_TAGS_JSON = """{'id': '%s','description': 'Raspberry Pi 3','credentials': {'user': '%s','password': '%s'}}"""
+# What to ask for when the session needs a setting that was not given, or cannot use the one given
+INPUT_PROMPTS = {
+    'rgroup': ("Enter a Resource Group name", None),
+    'location': ("Please select a location from the list above", click.Choice(LOCATION_OPTIONS)),
+    'iothub': ("Enter an IoT Hub name", None),
+    'iothub_sku': ("Please choose a different SKU. e.g. S1, S2, or S3", click.Choice(['S1', 'S2', 'S3'])),
+    'device': ("Enter an IoT Hub Edge Device name", None),
+    'container_registry': ("Enter a Container Registry name", None),
+    'container_registry_sku': ("Specify the sku of the container registry (e.g. Basic)",
+                               click.Choice(CONTAINER_REGISTRY_SKUS)),
+}
 
-class Iot(object):
-    """Context for IoT settings."""
+BACKENDS = ['az', 'rest']
 
-    def __init__(self):
-        self.config = {}
+# Subcommands that work on many devices (listed in an inventory file, or simulated) instead of one
+FLEET_COMMANDS = ('configure-fleet', 'configure-buttons', 'simulate')
 
-    def set_config(self, key, value):
-        self.config[key] = value
+class Iot(iot_session.Session):
+    """Context for IoT settings: the session of the command being run, which
+    reports its progress on the terminal and talks to Azure through the az
+    CLI unless --backend rest is given."""
 
-    def __repr__(self):
-        return '<IoT %r>' % self.config
+    def __init__(self, backend=None):
+        super(Iot, self).__init__(backend or iot_backends.AzCliBackend(run_command_with_stderr_json_out),
+                                  ssh_connections, click.secho)
 
 pass_iot = click.make_pass_decorator(Iot)
 
+# Cache for read-only az queries, shared by every command run in this process
+query_cache = iot_cache.QueryCache()
+
+def run_command_with_status(command):
+    """Runs a command in a shell using subprocess.Popen.
+    Returns stdout, stderr and the exit status."""
+    subcommand, scope = iot_cache.parse_command(command)
+    # profile by subcommand and resource names only, command lines can hold secrets
+    with iot_profile.span('az %s' % subcommand if subcommand else command.split()[0],
+                          iot_profile.SUBPROCESS, **scope) as span:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        (stdout, stderr) = p.communicate()
+        span['exit_status'] = p.returncode
+    return stdout, stderr, p.returncode
+
 def run_command_with_stderr(command):
     """Runs a command in a shell using subprocess.Popen.
     Returns stdout and stderr as outputs."""
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    (stdout, stderr) = p.communicate()
+    stdout, stderr, _ = run_command_with_status(command)
     return stdout, stderr
 
+def _run_scheduled(command, run):
+    # throttled (and failed read-only) commands are retried by the scheduler
+    subcommand, _ = iot_cache.parse_command(command)
+    idempotent = bool(subcommand) and subcommand.split()[-1] not in iot_cache.MUTATING_VERBS
+    result = iot_scheduler.scheduler.call(
+        iot_scheduler.az_family(subcommand), lambda: run(command),
+        lambda result, error: iot_scheduler.classify_az(result, error, idempotent))
+    query_cache.invalidate(command)
+    return result
+
 def run_command_with_stderr_json_out(command):
     """Runs a command in a shell using subprocess.Popen.
-    Loads stdout (JSON) into a python dict, and decodes stderr to a UTF-8 string"""
-    out, err = run_command_with_stderr(command)
+    Loads stdout (JSON) into a python dict, and decodes stderr to a UTF-8 string.
+    Read-only queries are answered from query_cache when possible, and commands
+    that change Azure state invalidate the cached queries they affect. Every
+    command runs under the rate limits and retries of iot_scheduler."""
+    cached = query_cache.get(command)
+    if cached is not None:
+        if iot_profile.profiler.enabled:
+            subcommand, scope = iot_cache.parse_command(command)
+            iot_profile.profiler.record('az %s' % subcommand, iot_profile.CACHE, time.time(), 0.0, **scope)
+        return cached
+
+    out, err = _run_scheduled(command, run_command_with_stderr)
     if out == b'' or out == '' or out is None:
         return None, err.decode("utf-8")
-    return json.loads(out), err.decode("utf-8")
+    out, err = json.loads(out), err.decode("utf-8")
+    query_cache.put(command, out, err)
+    return out, err
+
+def run_command_checked(command):
+    """Runs an az command for its effect, under the same rate limits and
+    retries as run_command_with_stderr_json_out. Returns (output, err) where
+    err is '' if the command exited with status 0, and its stderr (or the
+    exit status, if it printed nothing) otherwise."""
+    out, err, status = _run_scheduled(command, run_command_with_status)
+    if status != 0:
+        err = err.decode("utf-8", "replace").strip()
+        # name the subcommand only, command lines can hold secrets
+        subcommand, _ = iot_cache.parse_command(command)
+        name = 'az %s' % subcommand if subcommand else command.split()[0]
+        return None, err or "'%s' exited with status %d" % (name, status)
+    try:
+        return (json.loads(out) if out.strip() else None), ''
+    except ValueError:
+        return out.decode("utf-8", "replace"), ''
 
-def set_missing_parameters(iot):
-    """Queries Azure for mising parameters like iothub hostname, keys,
-    and connection_string"""
-    if 'hostname' not in iot.config:
-        click.secho("Checking for IoT Hub Host Name")
-        hub_info, err = run_command_with_stderr_json_out(
-            "az iot hub show --resource-group %s --name %s" %
-            (iot.config['rgroup'], iot.config['iothub']))
-        if err:
-            click.secho(err)
-            sys.exit(1)
-        iot.set_config("hostname", hub_info["properties"]["hostName"])
-
-    if 'key' not in iot.config:
-        click.secho("Checking for Device Identity with name '%s'" % iot.config['device'])
-        existingDevice, err = run_command_with_stderr_json_out(
-            "az iot hub device-identity show --resource-group %s --hub-name %s --device-id %s " %
-            (iot.config['rgroup'], iot.config['iothub'], iot.config['device']))
-        if err:
-            click.secho(err)
+def run_step(iot, step, *args):
+    """Calls a step of the session, prompting for any input it asks for and
+    calling it again, and exits if the step fails"""
+    while True:
+        try:
+            return step(*args)
+        except iot_session.InputRequired as e:
+            if e.reason:
+                click.secho(e.reason)
+            prompt_for_input(iot, e.key)
+        except iot_fleet.ProvisioningError as e:
+            click.secho(str(e))
             sys.exit(1)
-        iot.set_config("key", existingDevice["authentication"]["symmetricKey"]["primaryKey"])
-
-    click.secho("Checking for Connection String for device with name '%s'" % iot.config['device'])
-    device_info, err = run_command_with_stderr_json_out(
-        'az iot hub device-identity show-connection-string --resource-group %s --hub-name %s '
-        '--device-id %s' % (iot.config['rgroup'], iot.config['iothub'],
-                            iot.config['device']))
-    if err:
-        click.secho(err)
-        sys.exit(1)
 
-    iot.set_config("cs", device_info["cs"])
+def prompt_for_input(iot, key):
+    """Asks for the setting key of iot.config"""
+    if key == 'location':
+        click.secho("Specify the location (e.g. 'westus') where the Resouce Group should be created.")
+        for location in LOCATION_OPTIONS:
+            click.secho(" %s" % location)
+    text, choices = INPUT_PROMPTS[key]
+    iot.set_config(key, click.prompt(text, type=choices))
+
+def prompt_on_failure(iot, pending, retry):
+    """Wraps the iot_operations.Pending of a resource the session started
+    creating, so that if the resource cannot be created the setting at fault
+    (e.g. its name) is asked for and retry(iot) starts over"""
+    if pending is None:
+        return None
 
-    click.secho("Checking for Connection string for IoT Hub with name '%s'" % iot.config['iothub'])
-    hub_info, err = run_command_with_stderr_json_out(
-        'az iot hub show-connection-string --resource-group %s --hub-name %s' %
-        (iot.config['rgroup'], iot.config['iothub']))
+    def finish(output, err):
+        try:
+            return prompt_on_failure(iot, pending.finish(output, err), retry)
+        except iot_session.InputRequired as e:
+            if e.reason:
+                click.secho(e.reason)
+            prompt_for_input(iot, e.key)
+            return retry(iot)
+        except iot_fleet.ProvisioningError as e:
+            click.secho(str(e))
+            sys.exit(1)
+    return iot_operations.Pending(pending.label, pending.operation, finish)
 
-    # stderr actually contains something here on success so check in opposite order
-    if hub_info and "cs" in hub_info:
-        iot.set_config("hub_cs", hub_info["cs"])
-    else:
-        click.secho(err)
-        sys.exit(1)
+@iot_profile.timed()
+def set_missing_parameters(iot, max_workers=iot_session.MAX_CONCURRENT_LOOKUPS):
+    """Queries Azure for mising parameters like iothub hostname, keys,
+    and the hub connection string (see Session.resolve_connection_strings)"""
+    run_step(iot, iot.resolve_connection_strings, max_workers)
 
+@iot_profile.timed()
 def prompt_for_wifi_setting(iot):
      """Prompts the user for a wifi setting if one isn't passed in"""
      click.secho("\nProcessing network setting")
@@ -160,190 +240,76 @@ def prompt_for_wifi_setting(iot):
 
             iot.set_config("wifi_password", passPhase)               
 
+@iot_profile.timed()
 def prompt_for_resource_group(iot):
-    """Prompts the user for a Resource Group if one isn't passed in"""
-
+    """Prompts the user for a Resource Group if one isn't passed in, and for
+    its location if it has to be created"""
     click.secho("\nProcessing Resource Group")
     if not iot.config['rgroup']:
-        name = click.prompt("Enter a Resource Group name")
-    else:
-        name = iot.config['rgroup']
-
-    # check for existence of group
-    click.secho("Checking for Resource Group with name '%s'" % name)
-    exists = os.popen('az group exists -n '+ name).read().rstrip()
-
-    if exists == 'false':
-        click.secho("Resource Group with name '%s' does not exist. Creating a new Resource Group..." % name)
-        click.secho("Specify the location (e.g. 'westus') where the Resouce Group should be created.")
-        for location in LOCATION_OPTIONS:
-            click.secho(" %s" % location)
-        location = click.prompt(
-            "Please select a location from the list above",
-            type=click.Choice(LOCATION_OPTIONS))
-        _, err = run_command_with_stderr('az group create -n %s -l %s' % (name, location))
-        if err:
-            click.secho(err)
-            sys.exit(1)
-        else:
-            iot.set_config("location", location)
-            click.secho("Created a new Resource Group '%s'" % name)
-
-    elif exists == 'true':
-        click.secho("Using existing Resource Group with name '%s'." % name)
-
-    else:
-        click.secho("Error checking for resource group existence")
-        sys.exit(1)
-
-    iot.set_config("rgroup", name)
+        prompt_for_input(iot, 'rgroup')
+    run_step(iot, iot.ensure_resource_group)
 
+@iot_profile.timed()
 def prompt_for_iothub(iot):
-    """Prompts the user for an IoT Hub if one isn't passed in"""
-    #TODO: deal with clashes both in terms of globally unique names, sku clashes etc
-    # right now any error will result in retries
-    name = None
+    """Prompts the user for an IoT Hub if one isn't passed in. An existing hub
+    is used right away; a new one is only started, and the returned
+    iot_operations.Pending must be passed to create_resources."""
     click.secho("\nProcessing IoT Hub")
-    while True:
-        if not name:
-            if not iot.config['iothub']:
-                name = click.prompt("Enter an IoT Hub name")
-            else:
-                name = iot.config['iothub']
-
-        click.secho("Checking for IoT Hub with name '%s'" % name)
-        exists, err = run_command_with_stderr_json_out(
-            "az iot hub show --resource-group %s --name %s" %
-            (iot.config['rgroup'], name))
-        if not exists:
-            click.secho("IoT Hub with name '%s' does not exist. Creating a new IoT Hub..." % name)
-            output, err = run_command_with_stderr_json_out(
-                "az iot hub create --resource-group %s --name %s --sku %s" %
-                (iot.config['rgroup'], name, iot.config['iothub_sku']))
-            
-            if output and "properties" in output and "hostName" in output["properties"]:
-                click.secho("Created a new IoTHub '%s'" % name)
-                hostName = output["properties"]["hostName"]
-                break
-            elif 'Bad Request' in err and '400 Client Error' in err and iot.config['iothub_sku'] == 'F1':
-                sku = click.prompt('Unable to use the Free Tier (F1) IoT Hub SKU.\n'
-                                   'Please choose a different SKU. e.g. S1, S2, or S3', type=click.Choice(['S1', 'S2', 'S3']))
-                iot.set_config("iothub_sku", sku)
-            else:
-                click.secho(err)
-                iot.set_config("iothub", None)
-                name = None
-        elif "properties" in exists and "hostName" in exists["properties"]:
-            click.secho("Using existing IoT Hub with name '%s'" % name)
-            hostName = exists["properties"]["hostName"]
-            break
-
-    iot.set_config("hostname", hostName)
-    iot.set_config("iothub", name)
+    if not iot.config['iothub']:
+        prompt_for_input(iot, 'iothub')
+    return prompt_on_failure(iot, run_step(iot, iot.begin_iothub), prompt_for_iothub)
 
+@iot_profile.timed()
 def prompt_for_device(iot, subcommand):
     """Prompts the user for an IoT Hub Device if one isn't passed in"""
-    #TODO: deal with specific errors right now any error will result in retries
-
     click.secho("\nProcessing IoT Hub Edge Device")
-    existingDevice = None
-    while existingDevice is None:
-        if not iot.config['device']:
-            name = click.prompt("Enter an IoT Hub Edge Device name")
-        else:
-            name = iot.config['device']
-
-        click.secho("Checking for IoT Hub Edge Device with name '%s'" % name)
-        existingDevices, err = run_command_with_stderr_json_out("az iot hub device-identity list -g %s --hub-name %s" % (iot.config['rgroup'], iot.config['iothub']))
-
-        for d in existingDevices:
-            if d["deviceId"] == name:
-                existingDevice = d
-                click.secho("Using existing IoT Hub Edge Device with name '%s'" % name)
-
-        if existingDevice is None:
-            click.secho("IoT Hub Edge Device with name '%s' does not exist. Creating a new IoT Hub Edge Device..." % name)
-            edgeArg = "--edge-enabled" if subcommand == "configure-device" else ""
-            existingDevice, err = run_command_with_stderr_json_out(
-                "az iot hub device-identity create %s --resource-group %s "
-                "--hub-name %s --device-id %s" %
-                (edgeArg, iot.config['rgroup'], iot.config['iothub'], name))
-            if err:
-                click.secho(err)
-            else:
-                iot.set_config("key", existingDevice["authentication"]["symmetricKey"]["primaryKey"])
-
-    iot.set_config("device", name)
+    if not iot.config['device']:
+        prompt_for_input(iot, 'device')
+    run_step(iot, iot.ensure_device, None, subcommand == "configure-device")
 
+@iot_profile.timed()
 def prompt_for_container_registry(iot):
-    """Prompts the user for an Azure Container Registry if one isn't passed in"""
-
+    """Prompts the user for an Azure Container Registry if one isn't passed in.
+    Like prompt_for_iothub it returns an iot_operations.Pending if the
+    registry has to be created."""
     click.secho("\nProcessing Azure Container Registry")
-    name = None
-    existingRegistry = None
-    while existingRegistry is None:
-        if not name:
-            if not iot.config['container_registry']:
-                name = click.prompt("Enter a Container Registry name")
-                iot.set_config("container_registry", name)
-            else:
-                name = iot.config['container_registry']
-
-        click.secho("Checking for Container Registry " + name)
-        existingRegistries, err = run_command_with_stderr_json_out("az acr list -g %s" % iot.config['rgroup'])
-        for r in existingRegistries:
-            if r["name"].lower() == name.lower():
-                existingRegistry = r
-                click.secho("Using existing Container Registry with name '%s'" % name)
-
-        if existingRegistry is None:
-            click.secho("Container Registry with name '%s' does not exist. Creating a new Container Registry..." % name)
-            # we need to create it, prompt for sku if not specified
-            if not iot.config['container_registry_sku']:
-                sku = click.prompt("Specify the sku of the container registry (e.g. Basic)", type=click.Choice(CONTAINER_REGISTRY_SKUS))
-                iot.set_config("container_registry_sku", sku)
-            existingRegistry, err = run_command_with_stderr_json_out(
-                "az acr create --name %s --resource-group %s --sku %s --admin-enabled true" %
-                (name, iot.config['rgroup'], iot.config['container_registry_sku']))
-            if err:
-                click.secho(err)
-                iot.set_config("container_registry", None)
-                name = None
-
-    click.secho("Checking for Azure Container Registry credential")
-    creds, err = run_command_with_stderr_json_out("az acr credential show --name %s --resource-group %s" % (name, iot.config['rgroup']))
-    if not err:
-        iot.set_config("container_registry", name)
-        iot.set_config("cr_user", creds["username"])
-        iot.set_config("cr_pwd", creds["passwords"][0]['value'])
-        click.secho("")
-    else:
-        click.secho(err)
-        sys.exit(1)
+    if not iot.config['container_registry']:
+        prompt_for_input(iot, 'container_registry')
+    return prompt_on_failure(iot, run_step(iot, iot.begin_container_registry), prompt_for_container_registry)
+
+@iot_profile.timed()
+def get_container_registry_credentials(iot):
+    """Looks up the admin credentials of the container registry in iot.config"""
+    run_step(iot, iot.registry_credentials)
+    click.secho("")
+
+@iot_profile.timed()
+def create_resources(pending):
+    """Waits for resources started by the prompt_for_* functions, showing the
+    progress of each one on a single status display"""
+    pending = [p for p in pending if p is not None]
+    if pending:
+        click.secho("\nWaiting for %d new resources to be created" % len(pending))
+        iot_operations.complete(pending)
+
+def runSSHCommand(client, command, on_output=None):
+    """Run a command over SSH using a paramiko SSHClient.
+    Returns an iot_ssh.CommandResult with the exit status and captured output"""
+    return iot_ssh.run_command(client, command, on_output)
+
+# Authenticated SSH clients, one per device, shared by every step that talks to it
+ssh_connections = iot_ssh.SSHConnections(iot_session.create_ssh_client)
 
-def createSSHClient(server, port, user, password):
-    """Helper function to wrap paramiko's SSHClient"""
+
+def install_scripts(iot, scripts, wait=None):
+    """Syncs the scripts archive to the device and starts runner.sh (see
+    Session.install_scripts). Returns an error message, or None on success."""
     try:
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(server, port, user, password)
-    except paramiko.AuthenticationException:
-        return None
-    return client
-
-def runSSHCommand(client, command):
-    """Run a command over SSH using a paramiko SSHClient"""
-    _, stdout, _ = client.exec_command(command)
-    while not stdout.channel.exit_status_ready():
-        if stdout.channel.recv_ready():
-            data = stdout.channel.recv(1024)
-            while stdout.channel.recv_ready():
-                data += stdout.channel.recv(1024)
-            return data
+        iot.install_scripts(scripts, wait)
+    except iot_fleet.ProvisioningError as e:
+        return str(e)
     return None
 
-
 @click.group()
 @click.option('--wifi-ssid', help='SSID of the WiFi Network that the device will connect to.', default="")
 @click.option('--wifi-password', help='Password for the WiFi Network that the device will connect to.', hide_input=True, default="")
@@ -357,36 +323,41 @@ def runSSHCommand(client, command):
 @click.option('--device-user', help='Username to use to connect to the device.', default='pi')
 @click.option('--device-password', help='Password to use to connect to the device.', default='raspberry')
 @click.option('--fn-name', help='Name for the Azure IoT Sample Function', default='sampleiotfunction')
+@click.option('--scripts-path', type=click.Path(exists=True, dir_okay=False),
+              help='Local copy of the device scripts archive to use instead of downloading it.')
+@click.option('--no-cache', is_flag=True,
+              help='Always query Azure and download the device scripts instead of reusing recent results.')
+@click.option('--backend', default='az', type=click.Choice(BACKENDS), envvar='IOT_BACKEND',
+              help='Use the az CLI or call the Azure REST APIs directly.')
+@click.option('--profile', type=click.Path(dir_okay=False, writable=True),
+              help='Time each phase of the run, print a summary and write a Chrome trace (JSON) to this file.')
+@click.option('--restart', is_flag=True, help='Redo every provisioning step, ignoring progress recorded by earlier runs.')
 @click.version_option('1.1')
 @click.pass_context
 
 def cli(ctx, wifi_ssid, wifi_password, resource_group, iothub, iothub_sku, device, container_registry, container_registry_sku,
-        device_ip, device_user, device_password, fn_name):
+        device_ip, device_user, device_password, fn_name, scripts_path, no_cache, backend, profile, restart):
     """Iot is a command line tool that showcases how to configure the Azure
     teXXmo IoT button and the Grove Starter Kit for Azure IoT Edge.
     """
 
-    if osPlat.lower() == "windows":
-        pingCmd = "ping -n 1 www.microsoft.com >nul 2>&1"
-    else:
-        pingCmd = "ping -c 1 www.microsoft.com >/dev/null 2>&1"
+    query_cache.enabled = not no_cache
+    ctx.call_on_close(report_throttling)
+    if profile:
+        start_profiling(profile)
 
-    click.secho("\nChecking internet connection")
-    response = 1 
-    while response == 1:
-        response = os.system(pingCmd)
-        # check if we can access the device.  If not, prompt user 
-        if response == 1:
-            click.secho("")
-            click.secho("Please ensure you are connected to a network with internet access now.")
-            click.pause("Press any key to continue...")
-            click.secho("")
+    if backend == 'rest':
+        import iot_rest
+        backend = iot_rest.RestBackend()
+    else:
+        backend = None
 
-    click.secho("Internet connection confirmed")
     # Create an Iot object and remember it as as the context object.  From
     # this point onwards other commands can refer to it by using the
-    # @pass_iot decorator.
-    ctx.obj = Iot()
+    # @pass_iot decorator. The network checks and prompts run once a
+    # subcommand actually starts (see preflight), so --help stays instant.
+    ctx.obj = Iot(backend)
+    ctx.call_on_close(ctx.obj.close)
     ctx.obj.set_config('wifi_ssid', wifi_ssid)
     ctx.obj.set_config('wifi_password', wifi_password)
     ctx.obj.set_config('rgroup', resource_group)
@@ -399,19 +370,115 @@ def cli(ctx, wifi_ssid, wifi_password, resource_group, iothub, iothub_sku, devic
     ctx.obj.set_config('username', device_user)
     ctx.obj.set_config('password', device_password)
     ctx.obj.set_config('fn_name', fn_name)
+    ctx.obj.set_config('scripts_path', scripts_path)
+    ctx.obj.set_config('no_cache', no_cache)
+    ctx.obj.set_config('restart', restart)
+
+def report_throttling():
+    """Prints the scheduler's counters if calls were throttled or retried"""
+    scheduler = iot_scheduler.scheduler
+    if scheduler.total(iot_scheduler.THROTTLED) or scheduler.total(iot_scheduler.RETRIES):
+        click.secho("\nAzure calls were throttled or retried\n")
+        click.secho(scheduler.summary())
+
+def report_result(result):
+    """Prints the outcome of one device of configure-fleet or configure-buttons as it finishes"""
+    click.secho("[%s] %s %s" % (result['device'], result['status'], result['error']))
+
+def start_profiling(path):
+    """Records spans for the rest of the run and reports them when the CLI exits"""
+    profiler = iot_profile.profiler
+    profiler.enabled = True
+    start = time.time()
+
+    def report():
+        profiler.record('cli', iot_profile.PHASE, start, time.time() - start)
+        profiler.enabled = False
+        click.secho("\nProfile\n")
+        click.secho(profiler.summary())
+        try:
+            profiler.write_trace(path)
+            click.secho("\nWrote trace to '%s'" % path)
+        except (IOError, OSError) as e:
+            click.secho("Unable to write trace to '%s': %s" % (path, e))
+
+    click.get_current_context().call_on_close(report)
+
+@iot_profile.timed()
+def run_preflight(iot, subcommand):
+    """Checks for internet access and resolves the Azure resources every
+    subcommand needs, prompting for anything not given on the command line"""
+    click.secho("\nChecking internet connection")
+    with iot_profile.span('wait for internet', iot_profile.WAIT):
+        while not iot_reachability.wait_until_reachable(
+                INTERNET_CHECK_HOST, iot_reachability.HTTP_PORT, INTERNET_PROBE_DEADLINE).reachable:
+            click.secho("")
+            click.secho("Please ensure you are connected to a network with internet access now.")
+            click.pause("Press any key to continue...")
+            click.secho("")
 
-    prompt_for_wifi_setting(ctx.obj)
-
-    prompt_for_resource_group(ctx.obj)
-
-    prompt_for_iothub(ctx.obj)
-
-    prompt_for_device(ctx.obj, ctx.invoked_subcommand)
+    click.secho("Internet connection confirmed")
 
-    set_missing_parameters(ctx.obj)
+    # configure-fleet and configure-buttons take their devices (and their network settings) from an inventory
+    # file, simulate creates its own
+    fleet = subcommand in FLEET_COMMANDS
+
+    if not fleet:
+        prompt_for_wifi_setting(iot)
+        if iot.config['iothub'] and iot.config['device']:
+            # known up front, so even the resource group and hub checks can be resumed
+            open_journal(iot)
+
+    prompt_for_resource_group(iot)
+
+    # resources that do not exist yet are created side by side
+    pending = [prompt_for_iothub(iot)]
+    if subcommand in ('configure-device', 'configure-fleet'):
+        pending.append(prompt_for_container_registry(iot))
+    create_resources(pending)
+
+    if not fleet:
+        if iot.journal.path is None:
+            # the journal is kept per device, so the device has to be known before it is opened
+            if not iot.config['device']:
+                prompt_for_input(iot, 'device')
+            open_journal(iot)
+        prompt_for_device(iot, subcommand)
+
+        set_missing_parameters(iot)
+
+def open_journal(iot):
+    """Switches iot.journal to the persistent journal of the hub and device in
+    iot.config, keeping the steps this run has completed so far"""
+    try:
+        journal = iot_journal.Journal.for_device(iot.config['iothub'], iot.config['device'])
+    except iot_journal.JournalLocked as e:
+        click.secho(str(e))
+        sys.exit(1)
+    click.get_current_context().call_on_close(journal.close)
+    if iot.config.get('restart'):
+        journal.reset()
+    elif journal.steps:
+        resume = journal.resume_point()
+        click.secho("Resuming the provisioning of '%s' from an earlier run%s" %
+                    (iot.config['device'], " at step '%s'" % resume if resume else ""))
+    journal.adopt(iot.journal)
+    iot.journal = journal
+
+def preflight(f):
+    """Decorator for subcommands that runs run_preflight before the command
+    body. It is applied below the command's click options, so it only runs
+    once argument parsing (and --help handling) is done."""
+    @functools.wraps(f)
+    def wrapper(iot, *args, **kwargs):
+        run_preflight(iot, click.get_current_context().info_name)
+        return f(iot, *args, **kwargs)
+    return wrapper
 
 @cli.command()
 @pass_iot
+@preflight
+@iot_profile.timed()
 def configure_device(iot):
     """Configures the Grove Starter Kit for Azure IoT Edge.
     This will connect to the device, discover information about it, and
@@ -419,173 +486,460 @@ def configure_device(iot):
     in Azure IoT Hub.
     """
 
-    # Select or create container registry for pushing private modules, otherwise get creds for selected CR
-    # This is only required in the "configure device" scenario (not "configure button")
-    prompt_for_container_registry(iot)
+    # The cloud side (registry, twin, scripts download) and waiting for the Raspberry Pi
+    # are independent, so they run concurrently and the install starts once all are done.
+    iot_tasks.run_tasks([
+        # The container registry for pushing private modules was selected or created before the command ran
+        # This is only required in the "configure device" scenario (not "configure button")
+        iot_tasks.Task('container registry', lambda results: get_container_registry_credentials(iot)),
+        iot_tasks.Task('device twin', lambda results: update_device_twin(iot)),
+        iot_tasks.Task('scripts', lambda results: download_scripts(iot)),
+        # waiting may ask the user to switch networks, so it stays on the main thread
+        # unless an earlier run already started the scripts, in which case install waits if it has to
+        iot_tasks.Task('device', lambda results: wait_for_device_unless_installed(iot), main_thread=True),
+        iot_tasks.Task('install', lambda results: install_scripts_and_report(iot, results['scripts'], results['device']),
+                       requires=['container registry', 'scripts', 'device'], main_thread=True),
+    ])
+
+def update_device_twin(iot):
+    """Tags the device twin with the device's description and credentials.
+    Returns an error message, or None on success."""
+    try:
+        iot.tag_device()
+    except iot_fleet.ProvisioningError as e:
+        click.secho(str(e))
+        return str(e)
+    return None
+
+def download_scripts(iot):
+    """Returns the scripts archive, exiting if it cannot be downloaded"""
+    scripts = run_step(iot, iot.scripts)
+    click.secho("Script file downloaded\n")
+    return scripts
+
+def wait_for_device(iot):
+    """Waits for the Raspberry Pi to accept SSH connections, asking the user to
+    join its network whenever it cannot be reached"""
+    with iot_profile.span('wait for device', iot_profile.WAIT):
+        while True:
+            click.secho("Connecting to Raspberry Pi")
+            probe = iot_reachability.wait_until_reachable(iot.config['ip'], iot_reachability.SSH_PORT,
+                                                          DEVICE_PROBE_DEADLINE)
+            if probe.reachable:
+                break
+            # we can't reach the device, prompt user
+            click.secho("Please connect to SeeedGroveKit SSID now.")
+            click.pause("Press any key to continue...")
+            click.secho("")
+
+    click.secho("Connected to Raspberry Pi (reachable after %.1fs)" % probe.elapsed)
+    with iot_profile.span('wifi settle', iot_profile.WAIT):
+        time.sleep(WIFI_SETTLE_TIME) # Give the WiFi connection a few seconds to stabilize.
+
+def wait_for_device_unless_installed(iot):
+    """Waits for the Raspberry Pi unless the journal shows runner.sh was
+    started by an earlier run. Returns True if it waited."""
+    if iot.journal.recorded(iot_journal.STEP_RUNNER):
+        return False
+    wait_for_device(iot)
+    return True
 
-    # Update the device twin
-    device_tags = DEVICE_TAGS_JSON % (iot.config['device'], iot.config['username'], iot.config['password'])
-    _, err = run_command_with_stderr_json_out('az iot hub device-twin update --resource-group %s --hub-name %s --device-id %s --set tags="%s"' %
-                                              (iot.config['rgroup'], iot.config['iothub'], iot.config['device'], device_tags))
+def install_scripts_and_report(iot, scripts, device_ready):
+    err = install_scripts(iot, scripts, None if device_ready else lambda: wait_for_device(iot))
     if err:
         click.secho(err)
 
-    # Download scripts to be run on device
-    # TODO: Scripts need to be updated to detect hostmanager vs hostapd on target device (and update workflow accordingly)
-    click.secho("\nDownloading script file : " + SCRIPTS_ZIP_URI)
+@cli.command()
+@click.argument('inventory', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=iot_fleet.MAX_FLEET_WORKERS, type=click.IntRange(1, None),
+              help='Number of devices to provision at the same time.')
+@click.option('--ssh-timeout', default=iot_session.DEVICE_SSH_TIMEOUT, type=click.IntRange(1, None),
+              help='Seconds to wait for each device to accept SSH connections.')
+@pass_iot
+@preflight
+@iot_profile.timed()
+def configure_fleet(iot, inventory, workers, ssh_timeout):
+    """Configures every Grove Starter Kit listed in INVENTORY.
+    INVENTORY is a CSV or YAML file with an 'ip' and 'device' per board and
+    optionally 'user', 'password', 'wifi_ssid' and 'wifi_password'. The
+    resource group, IoT Hub and container registry are resolved once and
+    shared by all devices, whose identities are then registered and tagged in
+    bulk before the boards are provisioned concurrently. A rerun skips the
+    steps each device already completed.
+    """
+    defaults = {
+        'user': iot.config['username'],
+        'password': iot.config['password'],
+        'wifi_ssid': iot.config['wifi_ssid'],
+        'wifi_password': iot.config['wifi_password'],
+    }
     try:
-        urlretrieve(SCRIPTS_ZIP_URI, "scripts.zip")
-    except BaseException as e:
-        click.secho("Error in downloading scripts. Error message: " + str(e))
+        devices = iot_fleet.load_inventory(inventory, defaults)
+    except (iot_fleet.InventoryError, IOError) as e:
+        click.secho(str(e))
+        sys.exit(1)
+
+    results = run_step(iot, iot.provision_fleet, devices, workers, ssh_timeout, report_result)
+
+    click.secho("")
+    click.secho(iot_fleet.format_summary(results))
+    if any(r['status'] != iot_fleet.STATUS_OK for r in results):
+        sys.exit(1)
+
+@cli.command()
+@click.argument('cidr')
+@click.option('--output', '-o', default='inventory.csv', type=click.Path(dir_okay=False, writable=True),
+              help='Inventory file (CSV, or YAML for .yaml/.yml) to write the Grove Starter Kits found to.')
+@click.option('--prefix', default='grove', help='Discovered devices are named PREFIX-<ip address>.')
+@click.option('--timeout', default=iot_discovery.PROBE_TIMEOUT, type=click.FloatRange(0.1, None),
+              help='Seconds each host gets to accept a connection and answer.')
+@click.option('--any-ssh', is_flag=True,
+              help='Add every SSH server to the inventory, not only those identifying as Raspbian.')
+@iot_profile.timed()
+def discover(cidr, output, prefix, timeout, any_ssh):
+    """Finds Grove Starter Kits and IoT Buttons on a network.
+    Every address in CIDR (e.g. 192.168.1.0/24) is probed on the SSH and
+    HTTP ports at once. Raspberry Pis are written to an inventory file for
+    configure-fleet; buttons and other hosts found are listed.
+    """
+    try:
+        addresses = iot_discovery.parse_cidr(cidr)
+    except iot_discovery.DiscoveryError as e:
+        click.secho(str(e))
+        sys.exit(1)
+
+    click.secho("Scanning %d addresses in %s" % (len(addresses), cidr))
+    start = time.time()
+    with iot_profile.span('scan %s' % cidr, iot_profile.WAIT, addresses=len(addresses)):
+        hosts = iot_discovery.scan(addresses, timeout)
+    click.secho("Found %d hosts in %.1fs" % (len(hosts), time.time() - start))
+    if hosts:
+        click.secho("")
+    for host in hosts:
+        click.secho("%-15s  %-6s  %s" % (host.ip, host.kind, host.description))
+
+    kinds = (iot_discovery.KIND_GROVE, iot_discovery.KIND_SSH) if any_ssh else (iot_discovery.KIND_GROVE,)
+    devices = [{'ip': host.ip, 'device': iot_discovery.device_name(prefix, host.ip)}
+               for host in hosts if host.kind in kinds]
+    if not devices:
+        click.secho("\nNo Grove Starter Kits found, '%s' was not written" % output)
         return
+    try:
+        iot_fleet.write_inventory(output, devices)
+    except (iot_fleet.InventoryError, IOError, OSError) as e:
+        click.secho(str(e))
+        sys.exit(1)
+    click.secho("\nWrote %d devices to '%s'. Provision them with: iot configure-fleet %s" %
+                (len(devices), output, output))
 
-    click.secho("Script file downloaded\n")
-    unzip_scripts = 'unzip -o scripts.zip -d scripts && rm scripts.zip && chmod +x ./scripts/*.sh'
-    run_script = (
-        "sudo nohup ./scripts/runner.sh '%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s' </dev/null >/home/pi/connect.log 2>&1 &" %
-        (iot.config['wifi_ssid'], iot.config['wifi_password'], iot.config['hub_cs'], iot.config['device'],
-         iot.config['cs'], iot.config['container_registry'], iot.config['cr_user'], iot.config['cr_pwd']))
-
-    # Check connection to Rapberry Pi.
-    if osPlat.lower() == "windows":
-        pingCmd = "ping -n 1 " + iot.config['ip'] + " >nul 2>&1"
+@cli.command()
+@click.option('--devices', default=100, type=click.IntRange(1, None), help='Number of virtual devices.')
+@click.option('--rate', default=1.0, type=click.FloatRange(0.001, None), help='Messages per second each device sends.')
+@click.option('--duration', default=30.0, type=click.FloatRange(1, None), help='Seconds to send messages for.')
+@click.option('--prefix', default='simulated', help='Virtual devices are named PREFIX-00000, PREFIX-00001 and so on.')
+@click.option('--connect-rate', type=click.IntRange(1, None),
+              help='Devices connecting per second (default %d, all within a second with --local).' % SIMULATE_CONNECT_RATE)
+@click.option('--local', is_flag=True, help='Send to a local MQTT stand-in for IoT Hub instead of Azure.')
+@click.option('--local-latency', default=0.0, type=click.FloatRange(0, None),
+              help='Seconds the local stand-in waits before acknowledging a message.')
+@pass_iot
+@iot_profile.timed()
+def simulate(iot, devices, rate, duration, prefix, connect_rate, local, local_latency):
+    """Load tests the IoT Hub with many virtual buttons.
+    Every virtual device gets an IoT Hub identity, connects over MQTT and
+    sends --rate messages per second, like a button being pressed, for
+    --duration seconds. Reports the messages per second achieved
+    and percentiles of the time the hub took to acknowledge a message. With
+    --local the devices send to a stand-in for IoT Hub on this machine, so no
+    Azure resources are needed. Requires Python 3.5 or later.
+    """
+    if sys.version_info < (3, 5):
+        click.secho("simulate requires Python 3.5 or later")
+        sys.exit(1)
+    import iot_simulate
+
+    names = ['%s-%05d' % (prefix, number) for number in range(devices)]
+    connect_rate = connect_rate or (devices if local else SIMULATE_CONNECT_RATE)
+    if local:
+        hostname = 'localhost'
+        keys = dict((name, iot_credentials.generate_key()) for name in names)
     else:
-        pingCmd = "ping -c 1 " + iot.config['ip'] + " >/dev/null 2>&1"
+        run_preflight(iot, 'simulate')
+        hostname = iot.config['hostname']
+        click.secho("\nRegistering %d virtual devices" % devices)
+        # the same lookup or create as prompt_for_device, in bulk
+        identities = iot.backend.ensure_devices(iot.config['rgroup'], iot.config['iothub'], names, edge_enabled=False)
+        keys = {}
+        for name, (identity, err) in identities.items():
+            if identity is None:
+                click.secho("Unable to register '%s': %s" % (name, err))
+                continue
+            keys[name] = identity["authentication"]["symmetricKey"]["primaryKey"]
+        if not keys:
+            sys.exit(1)
 
-    while True:
-        response = os.system(pingCmd)
-        # check if we can access the device.  If not, prompt user 
-        if response == 1:
-            click.secho("Please connect to SeeedGroveKit SSID now.")
-            click.pause("Press any key to continue...")
-            click.secho("")
-        else:
-            break
+    def on_connected(report):
+        click.secho("Connected %d of %d devices in %.1fs, sending for %ds" %
+                    (report.connected, report.devices, report.connect_seconds, duration))
 
-    click.secho("Connecting to Raspberry Pi", nl=False)
+    def on_progress(elapsed, sent, failed, achieved):
+        click.secho("%6.1fs  %8d sent  %6d failed  %9.1f messages/second" % (elapsed, sent, failed, achieved))
 
-    while True:
-        response = os.system(pingCmd)
-        if response == 0:
-            click.secho(".")
-            break
-        else :
-            click.secho(".", nl=False)
-            continue
-
-    click.secho("Connected to Raspberry Pi")
-    time.sleep(5) # Give 5 seconds for WiFi connection to stablize.
-    # Copy scripts to device
+    click.secho("\nConnecting %d devices to %s" % (len(keys), 'a local stand-in for IoT Hub' if local else hostname))
     try:
-        click.secho("\nCopying scripts to Raspberry Pi")
-        ssh = createSSHClient(iot.config['ip'], 22, iot.config['username'], iot.config['password'])
-        if not ssh:
-            click.secho("Failed to SSH to the Device. Please check the device-user and device-password and try again")
-            return
+        report = iot_simulate.run(keys, hostname, rate, duration, local=local, local_latency=local_latency,
+                                  connect_rate=connect_rate, on_connected=on_connected, on_progress=on_progress)
+    except KeyboardInterrupt:
+        click.secho("Stopped")
+        sys.exit(1)
+    click.secho("")
+    click.secho(iot_simulate.format_report(report))
+    if not report.stats.sent:
+        sys.exit(1)
 
-        scp_client = SCPClient(ssh.get_transport())
-        scp_client.put("scripts.zip", "scripts.zip")
-        os.remove("scripts.zip")
-    except BaseException as e:
-        click.secho("Error in copying scripts to device. Error message: " + str(e))
-        return
-    try:
-        click.secho("\nConnecting to your device and installing pre-requisites (Step 1 of 2).")
-        runSSHCommand(ssh, unzip_scripts)
-        click.secho("Installing the required software now (Step 2 of 2). This script will exit shortly, but setup on your ")
-        click.secho("device will take several minutes. Execute 'tail -f ~/connect.log' on the device to view setup progress.")
-        runSSHCommand(ssh, run_script)
-    except BaseException as e:
-        click.secho("Failed to SSH to the Device. Please check the device-user and device-password and try again. "
-                    "Error message: " + str(e))
-        return
+@cli.command()
+@click.argument('inventory', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--timeout', type=click.IntRange(1, None), help='Stop following the logs after this many seconds.')
+@pass_iot
+@iot_profile.timed()
+def watch(iot, inventory, timeout):
+    """Follows the setup of configured Grove Starter Kits.
+    Tails /home/pi/connect.log on every board listed in INVENTORY (as given
+    to configure-fleet), or on the board at --device-ip, printing each line
+    prefixed with its device until runner.sh has finished on all of them,
+    then reports how long each device took to set up.
+    """
+    defaults = {'user': iot.config['username'], 'password': iot.config['password']}
+    if inventory:
+        try:
+            devices = iot_fleet.load_inventory(inventory, defaults)
+        except (iot_fleet.InventoryError, IOError) as e:
+            click.secho(str(e))
+            sys.exit(1)
+    else:
+        devices = [dict(defaults, ip=iot.config['ip'], device=iot.config['device'] or iot.config['ip'])]
+
+    def connect(device):
+        client = ssh_connections.get(device['ip'], iot_reachability.SSH_PORT, device['user'], device['password'])
+        if client is None:
+            raise IOError("authentication failed, check the device user and password")
+        return iot_watch.open_log(device['device'], client)
+
+    # connecting takes a thread each; once connected, every log is read from this thread
+    opened = iot_session.run_concurrently([(device['device'], functools.partial(connect, device))
+                                           for device in devices], iot_fleet.MAX_FLEET_WORKERS)
+    logs = []
+    for device in devices:
+        log = opened[device['device']]
+        if isinstance(log, Exception):
+            error, log = log, iot_watch.DeviceLog(device['device'])
+            log.disconnected("unable to connect to %s: %s" % (device['ip'], str(error) or error.__class__.__name__))
+        logs.append(log)
+
+    width = max(len(log.name) for log in logs)
+
+    def on_line(log, line):
+        click.secho("%s | %s" % (log.name.ljust(width), line))
+
+    def on_finished(log):
+        if log.status == iot_watch.STATUS_DISCONNECTED:
+            click.secho("%s | %s" % (log.name.ljust(width), log.error))
+        else:
+            click.secho("%s | setup %s after %s" % (log.name.ljust(width), log.status,
+                                                   iot_watch.format_duration(log.duration)))
 
-def createSampleFunctionApp(iot):
-    """Helper function to create an Azure Sample Function Application once
-    the button is configured"""
-    existingAccount = None
-    while existingAccount is None:
-        name = click.prompt("Enter a Storage Account for the Sample Function")
-        existingAccounts, err = run_command_with_stderr_json_out(
-            "az storage account list -g %s" % iot.config['rgroup'])
-
-        for a in existingAccounts:
-            if a["name"] == name:
-                existingAccount = a
-                click.secho("Using existing Storage Account with name '%s'" % name)
-
-        if existingAccount is None:
-            click.secho("Storage Account with name '%s' does not exist. Creating a new Storage Account..." % name)
-            existingAccount, err = run_command_with_stderr_json_out(
-                "az storage account create --name %s --resource-group %s --sku Standard_LRS" %
-                (name, iot.config['rgroup']))
-            if err:
-                click.secho(err)
+    click.secho("Following the setup of %d devices, press Ctrl+C to stop\n" % len(logs))
+    try:
+        iot_watch.follow(logs, on_line, on_finished, timeout)
+    except KeyboardInterrupt:
+        click.secho("")
 
     click.secho("")
-    click.secho("Creating a new Sample Azure Function Application...")
-    fnName = iot.config['fn_name']
-    _, err = run_command_with_stderr_json_out(
-        "az functionapp create -g %s -n %s -s %s -c %s" %
-        (iot.config['rgroup'], fnName, name, iot.config['location'] if 'location' in iot.config else 'westus'))
+    click.secho(iot_watch.format_summary(logs))
+    if any(log.status in (iot_watch.STATUS_FAILED, iot_watch.STATUS_DISCONNECTED) for log in logs):
+        sys.exit(1)
 
-    iothub, err = run_command_with_stderr_json_out("az iot hub show -n %s" % iot.config['iothub'])
-    eventHubEndpoint = iothub['properties']['eventHubEndpoints']['events']['endpoint']
-    eventHubPath = iothub['properties']['eventHubEndpoints']['events']['path']
-    hubSubstring = iot.config['hub_cs'].split(";", 1)[1]
-    settings = ("AzureIoTHubConnectionString='%s' AzureIoTHubEventHubConnectionString='Endpoint=%s;%s'" %
-                (iot.config['hub_cs'], eventHubEndpoint, hubSubstring))
+def prompt_for_storage_account(iot):
+    """Prompts the user for the Storage Account of the Sample Function. Like
+    prompt_for_iothub it returns an iot_operations.Pending if the account has
+    to be created."""
+    name = click.prompt("Enter a Storage Account for the Sample Function")
+    existingAccounts, err = iot.backend.list_storage_accounts(iot.config['rgroup'])
+    if existingAccounts is None and err:
+        click.secho(err)
+        sys.exit(1)
+    iot.set_config("storage_account", name)
+    if name in set(a["name"] for a in existingAccounts or []):
+        click.secho("Using existing Storage Account with name '%s'" % name)
+        return None
 
-    cmd = ("az functionapp config appsettings set --name %s --resource-group %s --settings %s" %
-           (fnName, iot.config['rgroup'], settings))
-    _ = os.popen(cmd).read()
+    click.secho("Storage Account with name '%s' does not exist. Creating a new Storage Account..." % name)
+    operation = iot.backend.begin_create_storage_account(iot.config['rgroup'], name)
+    return iot_operations.Pending("Storage Account '%s'" % name, operation,
+                                  lambda output, err: _storage_account_created(iot, output, err))
 
-    tmpFile = os.path.join(tempfile.mkdtemp(), 'iotbuttonmyfunction.zip')
-    with zipfile.ZipFile(tmpFile, 'w') as myzip:
-        myzip.writestr('iotbuttonmyfunction/index.js', FUNCTION_APP_INDEX_JS_FILE)
-        myzip.writestr('iotbuttonmyfunction/function.json', FUNCTION_APP_JSON_FILE % eventHubPath)
+def _storage_account_created(iot, output, err):
+    if err:
+        click.secho(err)
+    if output is None:
+        return prompt_for_storage_account(iot)
+    return None
 
-    cmd = ("az functionapp deployment source config-zip -g %s --name %s --src %s" %
-           (iot.config['rgroup'], fnName, tmpFile))
-    _ = os.popen(cmd).read()
+def function_app_journal(iot):
+    """The journal of the Sample Function App, or an in-memory one if another
+    run holds it (every step is then redone)"""
+    try:
+        journal = iot_journal.Journal.for_function_app(iot.config['rgroup'], iot.config['fn_name'])
+    except iot_journal.JournalLocked as e:
+        click.secho("%s, deploying without it" % e)
+        return iot_journal.Journal()
+    click.get_current_context().call_on_close(journal.close)
+    if iot.config.get('restart'):
+        journal.reset()
+    return journal
+
+def function_app_step_done(journal, step, inputs):
+    """True (and says so) if an earlier run completed step with the same inputs"""
+    if journal.done(step, inputs) is None:
+        return False
+    click.secho("Skipping the %s step, unchanged since an earlier run" % step)
+    return True
+
+def run_function_app_step(journal, step, inputs, command):
+    """Runs an az command for step and records it in journal. Exits if the command fails."""
+    _, err = run_command_checked(command)
+    if err:
+        click.secho("Unable to complete the %s step: %s" % (step, err))
+        sys.exit(1)
+    journal.record(step, inputs)
 
-    click.secho("Deployed a Sample Azure Function Application: '%s' in Resource Group: '%s'" %
-                (fnName, iot.config['rgroup']))
+@iot_profile.timed()
+def createSampleFunctionApp(iot):
+    """Helper function to create an Azure Sample Function Application once
+    the button is configured. The storage account is created while the Event
+    Hub settings are resolved, and every step an earlier run completed with
+    the same inputs (the function package by its hash) is skipped."""
+    import hashlib
+    import tempfile
 
+    import iot_artifacts
+
+    rgroup = iot.config['rgroup']
+    fnName = iot.config['fn_name']
+    location = iot.config['location'] if 'location' in iot.config else 'westus'
+    journal = function_app_journal(iot)
+
+    def storage_account(results):
+        create_resources([prompt_for_storage_account(iot)])
+        click.secho("")
+        click.secho("Creating a new Sample Azure Function Application...")
+        return iot.config['storage_account']
+
+    def function_app(results):
+        step = iot_journal.STEP_FUNCTION_APP
+        inputs = [rgroup, fnName, results['storage account'], location]
+        if not function_app_step_done(journal, step, inputs):
+            run_function_app_step(journal, step, inputs, "az functionapp create -g %s -n %s -s %s -c %s" %
+                                  (rgroup, fnName, results['storage account'], location))
+
+    def app_settings(results):
+        step = iot_journal.STEP_FUNCTION_SETTINGS
+        eventHubEndpoint, _ = results['event hub']
+        hubSubstring = iot.config['hub_cs'].split(";", 1)[1]
+        settings = ("AzureIoTHubConnectionString='%s' AzureIoTHubEventHubConnectionString='Endpoint=%s;%s'" %
+                    (iot.config['hub_cs'], eventHubEndpoint, hubSubstring))
+        inputs = [rgroup, fnName, settings]
+        if not function_app_step_done(journal, step, inputs):
+            run_function_app_step(journal, step, inputs,
+                                  "az functionapp config appsettings set --name %s --resource-group %s --settings %s" %
+                                  (fnName, rgroup, settings))
+
+    def deploy(results):
+        step = iot_journal.STEP_FUNCTION_PACKAGE
+        _, eventHubPath = results['event hub']
+        package = iot_artifacts.zip_bytes({
+            'iotbuttonmyfunction/index.js': FUNCTION_APP_INDEX_JS_FILE,
+            'iotbuttonmyfunction/function.json': FUNCTION_APP_JSON_FILE % eventHubPath,
+        })
+        # the archive is deterministic, so its hash only changes with the function's files
+        inputs = [rgroup, fnName, hashlib.sha256(package).hexdigest()]
+        if function_app_step_done(journal, step, inputs):
+            return
+
+        # the package is built in memory; az only takes a file, which is removed right after the upload
+        with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as f:
+            f.write(package)
+        try:
+            run_function_app_step(journal, step, inputs,
+                                  "az functionapp deployment source config-zip -g %s --name %s --src %s" %
+                                  (rgroup, fnName, f.name))
+        finally:
+            os.remove(f.name)
+
+    iot_tasks.run_tasks([
+        iot_tasks.Task('storage account', storage_account, main_thread=True),
+        iot_tasks.Task('event hub', lambda results: run_step(iot, iot.event_hub_settings)),
+        iot_tasks.Task('function app', function_app, requires=['storage account']),
+        iot_tasks.Task('app settings', app_settings, requires=['function app', 'event hub']),
+        iot_tasks.Task('function package', deploy, requires=['app settings']),
+    ])
+
+    click.secho("Deployed a Sample Azure Function Application: '%s' in Resource Group: '%s'" % (fnName, rgroup))
 
 @cli.command()
 @pass_iot
+@preflight
+@iot_profile.timed()
 def configure_button(iot):
     """Configures the Azure teXXmo IoT button.
     This will connect to the Button, and set it up so that it can be used with
     Microsoft Azure. It can also optionally deploy an Azure Function to run when
     the Button is pressed.
     """
-
     click.secho("Please connect to the SSID of your IoT Button now.")
     click.pause("Press any key to continue...")
     click.secho("")
+    with iot_profile.span('wait for button', iot_profile.WAIT):
+        while not iot_reachability.wait_until_reachable(
+                DEFAULT_WIFI_AP_ADDRESS, iot_reachability.HTTP_PORT, DEVICE_PROBE_DEADLINE).reachable:
+            click.secho("Unable to reach the IoT Button at %s. Please connect to its SSID now." % DEFAULT_WIFI_AP_ADDRESS)
+            click.pause("Press any key to continue...")
+            click.secho("")
 
-    # First POST call sets the Wi-fi parameters
-    data = BUTTON_WIFI_PAYLOAD % (iot.config['wifi_ssid'], iot.config['wifi_password'])
-    requests.post(BUTTON_WIFI_URI, headers=BUTTON_HEADERS, data=data)
-
-    # Second POST call sets up the button as an IoT Device
-    data = BUTTON_HUB_PAYLOAD % (iot.config['hostname'], iot.config['device'], iot.config['key'])
-    requests.post(BUTTON_HUB_URI, headers=BUTTON_HEADERS, data=data)
-
-    # Third POST call puts the button into client mode
-    data = BUTTON_CONFIG_PAYLOAD
-    try:
-        # Note: On this POST call, the button does not send any response. It just turns off AP mode.
-        # This will result in an exception, but it should be safe to ignore. Learned this the hard way.
-        requests.post(BUTTON_CONFIG_URI, headers=BUTTON_HEADERS, data=data)
-    except BaseException as e:
-        pass
+    # Set the Wi-Fi parameters, then the IoT Hub device, then put the button into client mode
+    run_step(iot, iot.configure_button, DEFAULT_WIFI_AP_ADDRESS)
 
     click.secho("Your Button is now connected to Azure!")
     if click.confirm('Would you like to set up a Sample Azure Function Application for the Button? (This may result in charges)'):
         click.secho("")
         createSampleFunctionApp(iot)
 
+@cli.command()
+@click.argument('inventory', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=MAX_BUTTON_WORKERS, type=click.IntRange(1, None),
+              help='Number of buttons to configure at the same time.')
+@pass_iot
+@preflight
+@iot_profile.timed()
+def configure_buttons(iot, inventory, workers):
+    """Configures every Azure teXXmo IoT button listed in INVENTORY.
+    INVENTORY is a CSV or YAML file with an 'ip' and 'device' per button, the
+    'ip' being the address at which this machine reaches the button's access
+    point, and optionally 'wifi_ssid' and 'wifi_password'. The device
+    identities are looked up or created together, then buttons on distinct
+    addresses (e.g. each behind its own WiFi adapter) are configured
+    concurrently.
+    """
+    defaults = {'wifi_ssid': iot.config['wifi_ssid'], 'wifi_password': iot.config['wifi_password']}
+    try:
+        buttons = iot_fleet.load_inventory(inventory, defaults)
+    except (iot_fleet.InventoryError, IOError) as e:
+        click.secho(str(e))
+        sys.exit(1)
+
+    results = run_step(iot, iot.configure_buttons, buttons, workers, report_result, DEVICE_PROBE_DEADLINE)
 
+    click.secho("")
+    click.secho(iot_fleet.format_summary(results))
+    if any(r['status'] != iot_fleet.STATUS_OK for r in results):
+        sys.exit(1)
@@ -0,0 +1,250 @@
+"""Local cache of downloaded artifacts such as the device scripts archive,
+and the in-memory archives handed to the steps that use them.
+
+Archives are stored once per content hash under the per-user cache
+directory, next to a small metadata file per URL recording the ETag,
+Last-Modified and hash of the latest copy. A fetch revalidates with a
+conditional request and only downloads (in chunks, verifying the hash and
+zip structure) when the server has something new. Files are written to a
+temporary name and renamed into place, so concurrent runs can share the
+cache safely.
+
+An Archive holds a zip in memory, up to MAX_ARCHIVE_SIZE bytes, together with
+its hash and the hashes of its members, computed once. Every device of a run
+syncs from the same Archive instead of reading and hashing the file again,
+download_archive streams an archive straight into one without touching the
+disk, and zip_bytes builds a package such as the sample function in memory.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
+
+import requests
+
+import iot_cache
+
+# Bytes read per chunk while downloading
+CHUNK_SIZE = 65536
+
+# Seconds to wait for the artifact server to connect / send data
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# Largest archive held in memory; the device scripts are a few kilobytes
+MAX_ARCHIVE_SIZE = 64 * 1024 * 1024
+
+
+class ArtifactError(Exception):
+    """Raised when an artifact can neither be downloaded nor found in the cache"""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_zip(path):
+    """Raises ArtifactError unless path is a readable zip archive"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad = archive.testzip()
+    except (zipfile.BadZipfile, IOError, OSError) as e:
+        raise ArtifactError("'%s' is not a valid zip archive: %s" % (path, e))
+    if bad is not None:
+        raise ArtifactError("'%s' is corrupt (bad member '%s')" % (path, bad))
+
+
+class Archive(object):
+    """A zip archive held in memory. open() gives each caller its own
+    ZipFile, so threads can read the same Archive at once."""
+
+    def __init__(self, data, name=None):
+        if len(data) > MAX_ARCHIVE_SIZE:
+            raise ArtifactError("'%s' is larger than %d bytes" % (name, MAX_ARCHIVE_SIZE))
+        self.data = data
+        self.name = name
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self._manifest = None
+        self._lock = threading.Lock()
+        try:
+            with self.open() as archive:
+                bad = archive.testzip()
+        except zipfile.BadZipfile as e:
+            raise ArtifactError("'%s' is not a valid zip archive: %s" % (name, e))
+        if bad is not None:
+            raise ArtifactError("'%s' is corrupt (bad member '%s')" % (name, bad))
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            if os.path.getsize(path) > MAX_ARCHIVE_SIZE:
+                raise ArtifactError("'%s' is larger than %d bytes" % (path, MAX_ARCHIVE_SIZE))
+            with open(path, 'rb') as f:
+                return cls(f.read(), path)
+        except (IOError, OSError) as e:
+            raise ArtifactError("Unable to read '%s': %s" % (path, e))
+
+    def open(self):
+        return zipfile.ZipFile(io.BytesIO(self.data))
+
+    def manifest(self, compute):
+        """Returns compute(ZipFile), e.g. the hashes of the members, computing
+        it on first use only"""
+        with self._lock:
+            if self._manifest is None:
+                with self.open() as archive:
+                    self._manifest = compute(archive)
+            return self._manifest
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<Archive %s %d bytes sha256=%s>' % (self.name, len(self.data), self.sha256[:12])
+
+
+def download_archive(url, session=None):
+    """Streams url into an Archive in memory, without writing it to disk"""
+    session = session or requests
+    buf = io.BytesIO()
+    try:
+        response = session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if buf.tell() + len(chunk) > MAX_ARCHIVE_SIZE:
+                    raise ArtifactError("'%s' is larger than %d bytes" % (url, MAX_ARCHIVE_SIZE))
+                buf.write(chunk)
+            expected = response.headers.get('Content-Length')
+            if expected is not None and int(expected) != buf.tell() and not response.headers.get('Content-Encoding'):
+                raise ArtifactError("Download truncated: got %d of %s bytes" % (buf.tell(), expected))
+        finally:
+            response.close()
+    except requests.RequestException as e:
+        raise ArtifactError("Unable to download '%s': %s" % (url, e))
+    return Archive(buf.getvalue(), url)
+
+
+def zip_bytes(files):
+    """Builds a zip archive in memory from a {name: text} dict and returns its bytes"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(files):
+            # a fixed timestamp keeps the archive, and so its hash, the same for the same files
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, files[name])
+    return buf.getvalue()
+
+
+class ArtifactCache(object):
+    """Content addressed store of downloaded archives"""
+
+    def __init__(self, path=None, session=None):
+        self._path = path
+        self.session = session or requests
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = iot_cache.cache_dir('artifacts')
+        return self._path
+
+    def _metadata_path(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.path, sha256 + '.zip')
+
+    def _read_metadata(self, url):
+        try:
+            with open(self._metadata_path(url)) as f:
+                metadata = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        blob = self._blob_path(metadata.get('sha256', ''))
+        if metadata.get('url') != url or not os.path.exists(blob):
+            return None
+        return metadata
+
+    def _write_metadata(self, url, metadata):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metadata, f)
+        iot_cache.replace_file(tmp, self._metadata_path(url))
+
+    def cached(self, url):
+        """Returns the path of the cached copy of url without revalidating, or None"""
+        metadata = self._read_metadata(url)
+        return self._blob_path(metadata['sha256']) if metadata else None
+
+    def fetch(self, url):
+        """Returns the path of an up to date, verified local copy of url.
+        Falls back to the cached copy if the server cannot be reached."""
+        metadata = self._read_metadata(url)
+        headers = {}
+        if metadata:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        except requests.RequestException as e:
+            if metadata:
+                return self._blob_path(metadata['sha256'])
+            raise ArtifactError("Unable to download '%s': %s" % (url, e))
+
+        try:
+            if response.status_code == 304 and metadata:
+                blob = self._blob_path(metadata['sha256'])
+                if file_sha256(blob) == metadata['sha256']:
+                    return blob
+                # the cached copy was damaged, download it again
+                response.close()
+                response = self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            sha256 = self._download(response)
+        except requests.RequestException as e:
+            raise ArtifactError("Unable to download '%s': %s" % (url, e))
+        finally:
+            response.close()
+
+        self._write_metadata(url, {
+            'url': url,
+            'sha256': sha256,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        })
+        return self._blob_path(sha256)
+
+    def _download(self, response):
+        """Streams a response body into the store and returns its sha256"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            expected = response.headers.get('Content-Length')
+            if expected is not None and int(expected) != size and not response.headers.get('Content-Encoding'):
+                raise ArtifactError("Download truncated: got %d of %s bytes" % (size, expected))
+            check_zip(tmp)
+            sha256 = digest.hexdigest()
+            iot_cache.replace_file(tmp, self._blob_path(sha256))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return sha256
@@ -0,0 +1,248 @@
+"""Backends used to query and provision Azure resources.
+
+Every backend method returns an (output, err) pair in the same shape as the
+az CLI: output is the JSON document az would print (or None), and err is the
+error text ('' on success). AzCliBackend shells out to az for each call;
+iot_rest.RestBackend talks to Azure Resource Manager and the IoT Hub service
+API directly over one pooled HTTP session.
+
+Creating a hub, registry or storage account can take minutes, so those can
+also be started with begin_create_*, which returns an
+iot_operations.Operation to poll instead of blocking, and fleets of devices
+are registered and tagged through ensure_devices and update_devices_tags,
+which a backend may implement with bulk APIs.
+"""
+import json
+import re
+
+import iot_operations
+
+# Upper bound on the device identities (or twins) looked up, created or updated at once
+MAX_IDENTITY_WORKERS = 8
+
+
+_NOT_FOUND = re.compile(r'not ?found|\b404\b', re.I)
+
+
+def is_not_found(err):
+    """True if the err of a lookup says the resource does not exist, rather
+    than that the lookup itself failed"""
+    return bool(err) and _NOT_FOUND.search(err) is not None
+
+
+class DeviceListError(Exception):
+    """Raised when a device registry cannot be listed"""
+
+
+class DeviceIndex(object):
+    """Set of the device ids in a hub, filled page by page on demand.
+
+    Membership checks only read as far into the registry as needed to find
+    the id, and ids already seen are never fetched again."""
+
+    def __init__(self, backend, rgroup, hub):
+        self._ids = set()
+        self._pending = backend.iter_device_ids(rgroup, hub)
+
+    def _read_until(self, device):
+        if self._pending is None:
+            return False
+        for device_id in self._pending:
+            self._ids.add(device_id)
+            if device_id == device:
+                return True
+        self._pending = None
+        return False
+
+    def __contains__(self, device):
+        return device in self._ids or self._read_until(device)
+
+    def missing(self, devices):
+        """Returns the devices (in order) that are not in the hub"""
+        return [d for d in devices if d not in self]
+
+
+def run_each(fn, items, max_workers):
+    """Calls fn(item), which returns (output, err), for every item on up to
+    max_workers threads. Returns a dict mapping each item to its result, with
+    an exception raised by fn turned into its err."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            return None, str(e) or e.__class__.__name__
+
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return dict(zip(items, executor.map(call, items)))
+
+
+class Backend(object):
+    """Operations the CLI needs from Azure. See the module docstring for the
+    (output, err) convention shared by every method."""
+
+    name = None
+
+    def group_exists(self, rgroup):
+        raise NotImplementedError
+
+    def create_group(self, rgroup, location):
+        raise NotImplementedError
+
+    def show_hub(self, rgroup, hub):
+        raise NotImplementedError
+
+    def create_hub(self, rgroup, hub, sku):
+        raise NotImplementedError
+
+    def begin_create_hub(self, rgroup, hub, sku):
+        """Starts creating a hub and returns an Operation tracking it. By
+        default create_hub runs on a background thread."""
+        return iot_operations.ThreadOperation(self.create_hub, rgroup, hub, sku)
+
+    def list_devices(self, rgroup, hub):
+        raise NotImplementedError
+
+    def iter_device_ids(self, rgroup, hub):
+        """Yields the id of every device in a hub without holding the whole
+        registry in memory. Raises DeviceListError if the listing fails."""
+        devices, err = self.list_devices(rgroup, hub)
+        if err or devices is None:
+            raise DeviceListError(err)
+        for device in devices:
+            yield device['deviceId']
+
+    def show_device(self, rgroup, hub, device):
+        raise NotImplementedError
+
+    def create_device(self, rgroup, hub, device, edge_enabled=False):
+        raise NotImplementedError
+
+    def ensure_devices(self, rgroup, hub, devices, edge_enabled=False, max_workers=MAX_IDENTITY_WORKERS):
+        """Makes sure every device id in devices exists, creating the missing
+        ones. Returns a dict mapping each id to the (output, err) of
+        show_device or create_device. By default the registry is listed once
+        and the identities are then fetched or created concurrently."""
+        try:
+            missing = set(DeviceIndex(self, rgroup, hub).missing(devices))
+        except DeviceListError as e:
+            return dict((device, (None, str(e))) for device in devices)
+
+        def ensure(device):
+            if device in missing:
+                return self.create_device(rgroup, hub, device, edge_enabled)
+            return self.show_device(rgroup, hub, device)
+        return run_each(ensure, devices, max_workers)
+
+    def device_connection_string(self, rgroup, hub, device):
+        raise NotImplementedError
+
+    def hub_connection_string(self, rgroup, hub):
+        raise NotImplementedError
+
+    def update_device_tags(self, rgroup, hub, device, tags):
+        raise NotImplementedError
+
+    def update_devices_tags(self, rgroup, hub, tags, max_workers=MAX_IDENTITY_WORKERS):
+        """Sets the twin tags of many devices, given as a dict mapping each
+        device id to its tags. Returns a dict mapping each id to the (output,
+        err) of update_device_tags. By default the twins are updated
+        concurrently."""
+        return run_each(lambda device: self.update_device_tags(rgroup, hub, device, tags[device]),
+                        list(tags), max_workers)
+
+    def list_registries(self, rgroup):
+        raise NotImplementedError
+
+    def create_registry(self, rgroup, registry, sku):
+        raise NotImplementedError
+
+    def begin_create_registry(self, rgroup, registry, sku):
+        return iot_operations.ThreadOperation(self.create_registry, rgroup, registry, sku)
+
+    def registry_credentials(self, rgroup, registry):
+        raise NotImplementedError
+
+    def list_storage_accounts(self, rgroup):
+        raise NotImplementedError
+
+    def create_storage_account(self, rgroup, account):
+        raise NotImplementedError
+
+    def begin_create_storage_account(self, rgroup, account):
+        return iot_operations.ThreadOperation(self.create_storage_account, rgroup, account)
+
+
+class AzCliBackend(Backend):
+    """Runs every operation through the az CLI. run is the function used to
+    execute a command line, returning its parsed JSON output and stderr."""
+
+    name = 'az'
+
+    def __init__(self, run):
+        self.run = run
+
+    def group_exists(self, rgroup):
+        return self.run('az group exists -n %s' % rgroup)
+
+    def create_group(self, rgroup, location):
+        return self.run('az group create -n %s -l %s' % (rgroup, location))
+
+    def show_hub(self, rgroup, hub):
+        return self.run("az iot hub show --resource-group %s --name %s" % (rgroup, hub))
+
+    def create_hub(self, rgroup, hub, sku):
+        return self.run("az iot hub create --resource-group %s --name %s --sku %s" % (rgroup, hub, sku))
+
+    def list_devices(self, rgroup, hub):
+        return self.run("az iot hub device-identity list -g %s --hub-name %s" % (rgroup, hub))
+
+    def iter_device_ids(self, rgroup, hub):
+        # project the query down to the ids so az does not return every twin
+        devices, err = self.run('az iot hub query -g %s --hub-name %s -q "SELECT deviceId FROM devices" --top -1' %
+                                (rgroup, hub))
+        if err or devices is None:
+            raise DeviceListError(err)
+        for device in devices:
+            yield device['deviceId']
+
+    def show_device(self, rgroup, hub, device):
+        return self.run("az iot hub device-identity show --resource-group %s --hub-name %s --device-id %s " %
+                        (rgroup, hub, device))
+
+    def create_device(self, rgroup, hub, device, edge_enabled=False):
+        return self.run("az iot hub device-identity create %s --resource-group %s "
+                        "--hub-name %s --device-id %s" %
+                        ("--edge-enabled" if edge_enabled else "", rgroup, hub, device))
+
+    def device_connection_string(self, rgroup, hub, device):
+        return self.run('az iot hub device-identity show-connection-string --resource-group %s --hub-name %s '
+                        '--device-id %s' % (rgroup, hub, device))
+
+    def hub_connection_string(self, rgroup, hub):
+        return self.run('az iot hub show-connection-string --resource-group %s --hub-name %s' % (rgroup, hub))
+
+    def update_device_tags(self, rgroup, hub, device, tags):
+        # az expects the tags as a python style literal inside the double quotes
+        return self.run('az iot hub device-twin update --resource-group %s --hub-name %s --device-id %s --set tags="%s"' %
+                        (rgroup, hub, device, json.dumps(tags).replace('"', "'")))
+
+    def list_registries(self, rgroup):
+        return self.run("az acr list -g %s" % rgroup)
+
+    def create_registry(self, rgroup, registry, sku):
+        return self.run("az acr create --name %s --resource-group %s --sku %s --admin-enabled true" %
+                        (registry, rgroup, sku))
+
+    def registry_credentials(self, rgroup, registry):
+        return self.run("az acr credential show --name %s --resource-group %s" % (registry, rgroup))
+
+    def list_storage_accounts(self, rgroup):
+        return self.run("az storage account list -g %s" % rgroup)
+
+    def create_storage_account(self, rgroup, account):
+        return self.run("az storage account create --name %s --resource-group %s --sku Standard_LRS" %
+                        (account, rgroup))
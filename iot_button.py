@@ -0,0 +1,132 @@
+"""Configuring teXXmo IoT buttons through the HTTP API of their access point.
+
+A button in access point mode takes three JSON posts: its Wi-Fi settings,
+its IoT Hub identity and finally the switch to client mode, which it
+acknowledges by dropping the connection as it leaves access point mode.
+ButtonClient sends them over a pooled requests.Session with connect and read
+timeouts, so a wedged button fails the step instead of hanging the CLI,
+checks every answer, and retries the settings posts (which are idempotent)
+when a button does not answer or answers with a server error.
+"""
+import json
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import iot_profile
+import iot_reachability
+
+WIFI_PATH = '/config/wifi'
+IOTHUB_PATH = '/config/iothub'
+OPSMODE_PATH = '/config/opsmode'
+
+HEADERS = {'Content-type': 'application/json', 'Accept': 'application/json'}
+WIFI_PAYLOAD = '{"ssid":"%s","password":"%s"}'
+IOTHUB_PAYLOAD = '{"iothub":"%s","iotdevicename":"%s","iotdevicesecret":"%s"}'
+OPSMODE_PAYLOAD = "{'opsmode':'client'}"
+
+# Seconds to wait for a button to accept a connection / to answer a post
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 10
+
+# Seconds to wait for an answer to the switch to client mode, which buttons never send
+OPSMODE_READ_TIMEOUT = 3
+
+# Attempts per settings post, with RETRY_BACKOFF seconds before the second, doubling afterwards
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+
+
+class ButtonError(Exception):
+    """Raised when a button rejects or does not acknowledge a step"""
+
+
+def button_url(address, port=None):
+    """Base URL of the button access point at address"""
+    port = port or iot_reachability.HTTP_PORT
+    return 'http://%s' % address if port == 80 else 'http://%s:%d' % (address, port)
+
+
+def create_session(pool_size=1):
+    """A session keeping up to pool_size connections per button alive. Retries
+    are done by ButtonClient, which knows which posts are safe to repeat."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    return session
+
+
+def _payload(template, *values):
+    # escape the values as JSON strings so quotes in a password cannot break the document
+    return template % tuple(json.dumps(value)[1:-1] for value in values)
+
+
+class ButtonClient(object):
+    """The access point API of one button"""
+
+    def __init__(self, url, session=None, timeout=None, attempts=None):
+        self.url = url.rstrip('/')
+        self.session = session or create_session()
+        self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.attempts = attempts or MAX_ATTEMPTS
+
+    def _post(self, path, data, timeout=None):
+        with iot_profile.span('POST ' + path, iot_profile.HTTP, host=self.url) as span:
+            response = self.session.post(self.url + path, headers=HEADERS, data=data, timeout=timeout or self.timeout)
+            span['status'] = response.status_code
+        return response
+
+    def _post_setting(self, step, path, data):
+        delay = RETRY_BACKOFF
+        for attempt in range(1, self.attempts + 1):
+            try:
+                response = self._post(path, data)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = "the button did not answer (%s)" % e.__class__.__name__
+            else:
+                if response.status_code < 500:
+                    _check(step, response)
+                    return
+                error = "the button answered with HTTP %d" % response.status_code
+            if attempt < self.attempts:
+                time.sleep(delay)
+                delay *= 2
+        raise ButtonError("Setting the %s failed after %d attempts: %s" % (step, self.attempts, error))
+
+    def set_wifi(self, ssid, password):
+        self._post_setting('Wi-Fi network', WIFI_PATH, _payload(WIFI_PAYLOAD, ssid, password))
+
+    def set_iothub(self, hostname, device, key):
+        self._post_setting('IoT Hub device', IOTHUB_PATH, _payload(IOTHUB_PAYLOAD, hostname, device, key))
+
+    def set_client_mode(self):
+        """Switches the button to client mode. The button leaves access point
+        mode without answering, so a dropped connection or a read timeout
+        counts as success; a button that cannot be reached at all, or answers
+        with an HTTP error, fails the step."""
+        try:
+            response = self._post(OPSMODE_PATH, OPSMODE_PAYLOAD, (self.timeout[0], OPSMODE_READ_TIMEOUT))
+        except requests.ConnectTimeout as e:
+            raise ButtonError("Switching to client mode failed: %s" % e)
+        except (requests.ConnectionError, requests.Timeout):
+            return
+        _check('client mode', response)
+
+    def configure(self, wifi_ssid, wifi_password, hostname, device, key):
+        """Runs all three steps in order"""
+        self.set_wifi(wifi_ssid, wifi_password)
+        self.set_iothub(hostname, device, key)
+        self.set_client_mode()
+
+
+def _check(step, response):
+    """Raises ButtonError unless response accepted the step"""
+    if not 200 <= response.status_code < 300:
+        raise ButtonError("The button rejected the %s: HTTP %d %s" % (step, response.status_code, response.text.strip()))
+    try:
+        body = response.json() if response.content else {}
+    except ValueError:
+        body = {}
+    if isinstance(body, dict) and body.get('error'):
+        raise ButtonError("The button rejected the %s: %s" % (step, body['error']))
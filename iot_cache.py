@@ -0,0 +1,204 @@
+"""On-disk cache for read-only az queries.
+
+Entries are keyed by the full command line and tagged with the scope it
+touches (resource group, hub, device, ...). Whenever the tool itself runs a
+command that changes Azure state, every entry whose scope overlaps with that
+command is dropped. Commands whose output carries secrets are never cached.
+"""
+import hashlib
+import json
+import os
+import shlex
+import tempfile
+import time
+
+APP_NAME = 'azure-iot-starterkit-cli'
+
+# Seconds a cached query result stays valid
+CACHE_TTL = 300
+
+# Read-only subcommands whose results may be cached. The value is a function
+# that strips anything sensitive from the output before it is written to disk.
+CACHEABLE_QUERIES = {
+    'group exists': lambda out: out,
+    'iot hub show': lambda out: out,
+    'iot hub device-identity list': lambda out: [_without_keys(d) for d in out],
+    'acr list': lambda out: out,
+    'storage account list': lambda out: out,
+}
+
+# Last word of the subcommands that change Azure state
+MUTATING_VERBS = ('create', 'update', 'delete', 'set', 'config-zip', 'import', 'regenerate-key')
+
+# What '--name' refers to for each command family
+NAME_SCOPES = {
+    'group': 'rgroup',
+    'iot': 'iothub',
+    'acr': 'registry',
+    'storage': 'storage_account',
+    'functionapp': 'functionapp',
+}
+
+SCOPE_OPTIONS = {
+    '-g': 'rgroup',
+    '--resource-group': 'rgroup',
+    '--hub-name': 'iothub',
+    '-d': 'device',
+    '--device-id': 'device',
+}
+
+
+def cache_dir(*parts):
+    """Returns (and creates) the per-user cache directory for this tool"""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, APP_NAME, *parts)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            # another process created it first
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def replace_file(src, dst):
+    """Atomically moves src over dst"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def _without_keys(device):
+    if isinstance(device, dict) and 'authentication' in device:
+        device = dict(device)
+        device.pop('authentication')
+    return device
+
+
+def parse_command(command):
+    """Splits an az command line into its subcommand (e.g. 'iot hub show')
+    and the scope it applies to (e.g. {'rgroup': 'rg', 'iothub': 'hub'})"""
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return None, {}
+    if not args or args[0] != 'az':
+        return None, {}
+    args = args[1:]
+
+    words = []
+    while args and not args[0].startswith('-'):
+        words.append(args.pop(0))
+
+    scope = {}
+    name_scope = NAME_SCOPES.get(words[0]) if words else None
+    for option, value in zip(args, args[1:]):
+        if option in SCOPE_OPTIONS:
+            scope[SCOPE_OPTIONS[option]] = value.lower()
+        elif option in ('-n', '--name') and name_scope:
+            scope[name_scope] = value.lower()
+    return ' '.join(words), scope
+
+
+def _overlaps(a, b):
+    """Two scopes overlap unless they name different values for the same key"""
+    return all(a[k] == b[k] for k in a if k in b)
+
+
+class QueryCache(object):
+    """Persistent TTL cache of (stdout, stderr) results of read-only az queries."""
+
+    def __init__(self, path=None, ttl=CACHE_TTL, enabled=True):
+        self._path = path
+        self.ttl = ttl
+        self.enabled = enabled
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = cache_dir('queries')
+        return self._path
+
+    def _entry_path(self, command):
+        digest = hashlib.sha256(command.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.json')
+
+    def get(self, command):
+        """Returns the cached (out, err) for command, or None on a miss"""
+        if not self.enabled:
+            return None
+        subcommand, _ = parse_command(command)
+        if subcommand not in CACHEABLE_QUERIES:
+            return None
+        try:
+            with open(self._entry_path(command)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('command') != command or entry.get('expires', 0) < time.time():
+            return None
+        return entry['out'], entry['err']
+
+    def put(self, command, out, err):
+        """Stores the result of command if it is a cacheable query"""
+        if not self.enabled or out is None:
+            return
+        subcommand, scope = parse_command(command)
+        if subcommand not in CACHEABLE_QUERIES:
+            return
+        entry = {
+            'command': command,
+            'scope': scope,
+            'expires': time.time() + self.ttl,
+            'out': CACHEABLE_QUERIES[subcommand](out),
+            'err': err,
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            replace_file(tmp, self._entry_path(command))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def invalidate(self, command):
+        """Drops every entry whose scope overlaps with a mutating command.
+        Returns True if command was recognised as mutating."""
+        subcommand, scope = parse_command(command)
+        if not subcommand or subcommand.split()[-1] not in MUTATING_VERBS:
+            return False
+        if not os.path.isdir(self.path):
+            return True
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            entry_path = os.path.join(self.path, name)
+            try:
+                with open(entry_path) as f:
+                    entry_scope = json.load(f).get('scope', {})
+            except (IOError, OSError, ValueError):
+                entry_scope = {}
+            if _overlaps(scope, entry_scope):
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+        return True
+
+    def clear(self):
+        """Drops every cached entry"""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
@@ -0,0 +1,111 @@
+"""IoT Hub connection strings and shared access signatures, built locally.
+
+A device connection string only needs the hub hostname, the device id and
+the device's symmetric key, and a SAS token is an HMAC over the resource
+URI and an expiry time, so neither needs a round trip to Azure once the keys
+are known. SasTokenCache hands out the same token for a resource until it
+gets close to expiring, which keeps request signing off the hot path of
+commands that make many service API calls.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+try:
+    from urllib import quote_plus
+except ImportError:
+    from urllib.parse import quote_plus
+
+# Policy whose key grants full access to an IoT Hub's service API
+HUB_OWNER_POLICY = 'iothubowner'
+
+# Seconds a generated SAS token stays valid
+SAS_TOKEN_TTL = 3600
+
+# Seconds before expiry at which SasTokenCache replaces a token
+SAS_REFRESH_MARGIN = 300
+
+
+def generate_key():
+    """A new random symmetric key, base64 encoded as IoT Hub expects"""
+    return base64.b64encode(os.urandom(32)).decode('utf-8')
+
+
+def device_connection_string(hostname, device, key):
+    return 'HostName=%s;DeviceId=%s;SharedAccessKey=%s' % (hostname, device, key)
+
+
+def hub_connection_string(hostname, policy, key):
+    return 'HostName=%s;SharedAccessKeyName=%s;SharedAccessKey=%s' % (hostname, policy, key)
+
+
+def parse_connection_string(cs):
+    """Splits a connection string into a dict of its fields (HostName, DeviceId, ...)"""
+    fields = {}
+    for part in cs.split(';'):
+        if '=' in part:
+            name, value = part.split('=', 1)
+            fields[name.strip()] = value.strip()
+    return fields
+
+
+def device_resource_uri(hostname, device):
+    """The resource a device authenticates against"""
+    return '%s/devices/%s' % (hostname, device)
+
+
+def sign_sas_token(uri, key, expiry, policy=None):
+    """Builds an IoT Hub shared access signature for uri, signed with the
+    base64 encoded key and valid until expiry (seconds since the epoch)"""
+    resource = quote_plus(uri)
+    to_sign = ('%s\n%d' % (resource, expiry)).encode('utf-8')
+    signature = base64.b64encode(hmac.new(base64.b64decode(key), to_sign, hashlib.sha256).digest())
+    token = 'SharedAccessSignature sr=%s&sig=%s&se=%d' % (resource, quote_plus(signature), expiry)
+    if policy:
+        token += '&skn=%s' % policy
+    return token
+
+
+def generate_sas_token(uri, key, policy=None, ttl=SAS_TOKEN_TTL):
+    """Builds a SAS token for uri that is valid for ttl seconds"""
+    return sign_sas_token(uri, key, int(time.time() + ttl), policy)
+
+
+class SasTokenCache(object):
+    """Thread safe cache of SAS tokens per (uri, policy, key). A token is
+    reused until fewer than refresh_margin seconds of its ttl are left."""
+
+    def __init__(self, ttl=SAS_TOKEN_TTL, refresh_margin=SAS_REFRESH_MARGIN):
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl / 2.0)
+        self.generated = 0
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def token(self, uri, key, policy=None):
+        # keyed by a digest so the cache never holds the key itself
+        cache_key = (uri, policy, hashlib.sha256(key.encode('utf-8')).hexdigest())
+        now = time.time()
+        with self._lock:
+            cached = self._tokens.get(cache_key)
+            if cached and cached[1] - now > self.refresh_margin:
+                return cached[0]
+            expiry = int(now + self.ttl)
+            token = sign_sas_token(uri, key, expiry, policy)
+            self._tokens[cache_key] = (token, expiry)
+            self.generated += 1
+            return token
+
+    def device_token(self, hostname, device, key):
+        """Token a device presents to the hub, e.g. for MQTT or AMQP"""
+        return self.token(device_resource_uri(hostname, device), key)
+
+    def service_token(self, hostname, key, policy=HUB_OWNER_POLICY):
+        """Token for the hub's service API, signed with a shared access policy key"""
+        return self.token(hostname, key, policy)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
@@ -0,0 +1,246 @@
+"""Discovery of Grove Starter Kits and IoT buttons on a local network.
+
+Every address of a CIDR block is probed on the SSH and HTTP ports at the same
+time, with non-blocking sockets driven by a single event loop like the one in
+iot_reachability. An open SSH port is fingerprinted by the banner the server
+sends first (Raspbian's OpenSSH marks a Raspberry Pi), an open HTTP port by
+the page it serves for a GET of /: the button's access point answers with its
+configuration page, whose forms post to the button's /config/ endpoints.
+Nothing is ever posted to a scanned host. Any other web server is reported as
+a plain HTTP host.
+"""
+import socket
+import struct
+import time
+
+import iot_reachability
+
+# Seconds a host gets to accept a connection, and then to send its banner or response
+PROBE_TIMEOUT = 1.0
+
+# Sockets open at once, enough for both ports of a /24 in one go
+MAX_OPEN_PROBES = 512
+
+# Bytes of a banner or response read for fingerprinting
+MAX_RESPONSE = 16384
+
+# Largest block scanned is a /16
+MIN_PREFIX_LENGTH = 16
+
+# Page the button's access point serves its configuration forms on
+BUTTON_PAGE_PATH = '/'
+
+# Endpoint the configuration page posts the Wi-Fi settings to
+BUTTON_CONFIG_PATH = '/config/wifi'
+
+KIND_GROVE = 'grove'
+KIND_SSH = 'ssh'
+KIND_BUTTON = 'button'
+KIND_HTTP = 'http'
+
+class DiscoveryError(Exception):
+    """Raised for a CIDR block that cannot be scanned"""
+
+
+def _ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def _int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def parse_cidr(cidr):
+    """Returns the host addresses of an IPv4 block such as 192.168.1.0/24,
+    leaving out the network and broadcast addresses of blocks larger than /31"""
+    address, _, length = cidr.partition('/')
+    try:
+        length = int(length) if length else 32
+        if not 0 <= length <= 32 or address.count('.') != 3:
+            raise ValueError(cidr)
+        network = _ip_to_int(address)
+    except (ValueError, socket.error):
+        raise DiscoveryError("'%s' is not an IPv4 address or CIDR block" % cidr)
+    if length < MIN_PREFIX_LENGTH:
+        raise DiscoveryError("'%s' is too large, scan at most a /%d at a time" % (cidr, MIN_PREFIX_LENGTH))
+    mask = (0xffffffff << (32 - length)) & 0xffffffff
+    first = network & mask
+    last = first | (~mask & 0xffffffff)
+    if length < 31:
+        first, last = first + 1, last - 1
+    return [_int_to_ip(value) for value in range(first, last + 1)]
+
+
+class Host(object):
+    """What a scan found at one address"""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.ssh_banner = None
+        self.http_status = None
+        self.http_server = None
+        self.http_body = ''
+        self.open_ports = []
+
+    @property
+    def kind(self):
+        if self.ssh_banner is not None and 'raspbian' in self.ssh_banner.lower():
+            return KIND_GROVE
+        if self.serves_button_config:
+            return KIND_BUTTON
+        if iot_reachability.SSH_PORT in self.open_ports:
+            return KIND_SSH
+        return KIND_HTTP
+
+    @property
+    def serves_button_config(self):
+        """True if the HTTP port served the button's configuration page"""
+        return self.http_status == 200 and BUTTON_CONFIG_PATH in self.http_body
+
+    @property
+    def description(self):
+        if self.ssh_banner:
+            return self.ssh_banner
+        if self.http_status is not None:
+            return 'HTTP %d %s' % (self.http_status, self.http_server or '')
+        return 'ports %s open' % ', '.join(str(p) for p in self.open_ports)
+
+    def __repr__(self):
+        return '<Host %s %s ports=%r>' % (self.ip, self.kind, self.open_ports)
+
+
+class _Probe(object):
+
+    def __init__(self, ip, port, request):
+        self.ip = ip
+        self.port = port
+        self.request = request
+        self.sock = None
+        self.connected = False
+        self.deadline = None
+        self.response = b''
+
+    def connect(self, now, timeout):
+        self.deadline = now + timeout
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setblocking(False)
+            code = self.sock.connect_ex((self.ip, self.port))
+        except socket.error:
+            return False
+        if code == 0 or code in iot_reachability.IN_PROGRESS:
+            return True
+        return False
+
+    def finish_connect(self, now, timeout):
+        """Called once the socket is writable; True if the connection was made"""
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            return False
+        self.connected = True
+        self.deadline = now + timeout
+        if self.request:
+            try:
+                self.sock.send(self.request)
+            except socket.error:
+                pass
+        return True
+
+    def read(self):
+        """Reads what arrived; True once the response is complete enough to fingerprint"""
+        try:
+            chunk = self.sock.recv(MAX_RESPONSE)
+        except socket.error as e:
+            return e.args[0] not in iot_reachability.IN_PROGRESS
+        self.response += chunk
+        if not chunk or len(self.response) >= MAX_RESPONSE:
+            return True
+        if self.request:
+            return self._body_complete()
+        return b'\n' in self.response
+
+    def _body_complete(self):
+        """True once the headers and as many body bytes as they announce arrived"""
+        head, separator, body = self.response.partition(b'\r\n\r\n')
+        if not separator:
+            return False
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length' and value.strip().isdigit():
+                return len(body) >= int(value.strip())
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def _fingerprint(host, probe):
+    host.open_ports.append(probe.port)
+    text = probe.response.decode('latin-1')
+    if probe.port == iot_reachability.SSH_PORT:
+        if text.startswith('SSH-'):
+            host.ssh_banner = text.splitlines()[0].strip()
+        return
+    head, _, body = text.partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    status = lines[0].split()
+    if len(status) >= 2 and status[0].startswith('HTTP/') and status[1].isdigit():
+        host.http_status = int(status[1])
+        host.http_body = body
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'server':
+                host.http_server = value.strip()
+
+
+def scan(addresses, timeout=PROBE_TIMEOUT, max_open=MAX_OPEN_PROBES):
+    """Probes the SSH and HTTP ports of every address, at most max_open
+    connections at a time. Returns a Host for each address with an open
+    port, in address order."""
+    probes = []
+    for ip in addresses:
+        http_request = ('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (BUTTON_PAGE_PATH, ip)).encode('ascii')
+        probes.append(_Probe(ip, iot_reachability.SSH_PORT, None))
+        probes.append(_Probe(ip, iot_reachability.HTTP_PORT, http_request))
+    queued = list(reversed(probes))
+    running = []
+    found = {}
+
+    def done(probe):
+        if probe.connected:
+            _fingerprint(found.setdefault(probe.ip, Host(probe.ip)), probe)
+        probe.close()
+        running.remove(probe)
+
+    while queued or running:
+        now = time.time()
+        while queued and len(running) < max_open:
+            probe = queued.pop()
+            running.append(probe)
+            if not probe.connect(now, timeout):
+                done(probe)
+
+        for probe in [p for p in running if p.deadline <= now]:
+            done(probe)
+        if not running:
+            continue
+
+        connecting = [p.sock for p in running if not p.connected]
+        reading = [p.sock for p in running if p.connected]
+        wait = max(0, min(p.deadline for p in running) - now)
+        ready = iot_reachability.wait_ready(reading, connecting, wait)
+        now = time.time()
+        for probe in [p for p in running if p.sock in ready]:
+            if not probe.connected:
+                if not probe.finish_connect(now, timeout):
+                    done(probe)
+            elif probe.read():
+                done(probe)
+
+    return sorted(found.values(), key=lambda host: _ip_to_int(host.ip))
+
+
+def device_name(prefix, ip):
+    """Device id given to a discovered board, e.g. grove-192-168-1-20"""
+    return '%s-%s' % (prefix, ip.replace('.', '-'))
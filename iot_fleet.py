@@ -0,0 +1,147 @@
+"""Provisioning of many devices listed in an inventory file.
+
+An inventory is either a CSV file with a header row or a YAML file holding a
+list of entries (optionally under a 'devices' key). Every entry needs an
+'ip' and a 'device' (the IoT Hub device id); 'user', 'password',
+'wifi_ssid' and 'wifi_password' fall back to the values given on the
+command line.
+"""
+import csv
+import os
+import threading
+import time
+
+# Default number of devices provisioned at the same time
+MAX_FLEET_WORKERS = 8
+
+INVENTORY_FIELDS = ('ip', 'device', 'user', 'password', 'wifi_ssid', 'wifi_password')
+REQUIRED_FIELDS = ('ip', 'device')
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+
+class InventoryError(Exception):
+    """Raised when an inventory file cannot be used"""
+
+
+class ProvisioningError(Exception):
+    """Raised by a provisioning step to fail a single device"""
+
+
+def _is_yaml(path):
+    return os.path.splitext(path)[1].lower() in ('.yaml', '.yml')
+
+
+def _read_entries(path):
+    if _is_yaml(path):
+        try:
+            import yaml
+        except ImportError:
+            raise InventoryError("PyYAML is required to read YAML inventories (pip install pyyaml)")
+        with open(path) as f:
+            data = yaml.safe_load(f) or []
+        if isinstance(data, dict):
+            data = data.get('devices', [])
+        if not isinstance(data, list) or not all(isinstance(e, dict) for e in data):
+            raise InventoryError("'%s' must contain a list of devices" % path)
+        return data
+    with open(path) as f:
+        return [dict((k.strip(), (v or '').strip()) for k, v in row.items() if k) for row in csv.DictReader(f)]
+
+
+def load_inventory(path, defaults):
+    """Reads an inventory file and returns one dict per device with every
+    field in INVENTORY_FIELDS set, taking missing values from defaults"""
+    devices = []
+    seen = set()
+    for number, entry in enumerate(_read_entries(path), 1):
+        unknown = set(entry) - set(INVENTORY_FIELDS)
+        if unknown:
+            raise InventoryError("Entry %d has unknown fields: %s" % (number, ', '.join(sorted(unknown))))
+        device = dict((field, entry.get(field) or defaults.get(field, '')) for field in INVENTORY_FIELDS)
+        device = dict((k, str(v)) for k, v in device.items())
+        missing = [field for field in REQUIRED_FIELDS if not device[field]]
+        if missing:
+            raise InventoryError("Entry %d is missing: %s" % (number, ', '.join(missing)))
+        for field in REQUIRED_FIELDS:
+            if (field, device[field]) in seen:
+                raise InventoryError("Entry %d repeats %s '%s'" % (number, field, device[field]))
+            seen.add((field, device[field]))
+        devices.append(device)
+    if not devices:
+        raise InventoryError("'%s' does not list any devices" % path)
+    return devices
+
+
+def write_inventory(path, devices):
+    """Writes devices (dicts keyed by INVENTORY_FIELDS) as an inventory file
+    that load_inventory reads back. Fields no device sets are left out."""
+    fields = [field for field in INVENTORY_FIELDS if any(device.get(field) for device in devices)]
+    entries = [dict((field, device[field]) for field in fields if device.get(field)) for device in devices]
+    if _is_yaml(path):
+        try:
+            import yaml
+        except ImportError:
+            raise InventoryError("PyYAML is required to write YAML inventories (pip install pyyaml)")
+        with open(path, 'w') as f:
+            yaml.safe_dump({'devices': entries}, f, default_flow_style=False)
+        return
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(entries)
+
+
+def provision_fleet(devices, provision, max_workers=MAX_FLEET_WORKERS, report=None):
+    """Runs provision(device) for every device on a bounded thread pool.
+    provision signals failure by raising; report, if given, is called with
+    each result as soon as its device finishes. Returns the results in
+    inventory order, each a dict with device, ip, status, error and seconds."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    lock = threading.Lock()
+
+    def run(device):
+        start = time.time()
+        result = {'device': device['device'], 'ip': device['ip'], 'status': STATUS_OK, 'error': ''}
+        try:
+            provision(device)
+        except SystemExit as e:
+            result.update(status=STATUS_FAILED, error='exited with status %s' % e.code)
+        except Exception as e:
+            result.update(status=STATUS_FAILED, error=str(e) or e.__class__.__name__)
+        result['seconds'] = time.time() - start
+        if report:
+            with lock:
+                report(result)
+        return result
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(devices)))) as executor:
+        futures = dict((executor.submit(run, device), device['device']) for device in devices)
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return [results[device['device']] for device in devices]
+
+
+def format_summary(results):
+    """Renders provisioning results as a plain text table"""
+    header = ('DEVICE', 'IP', 'STATUS', 'TIME', 'ERROR')
+    rows = [(r['device'], r['ip'], r['status'], '%.1fs' % r['seconds'], r['error'].splitlines()[0] if r['error'] else '')
+            for r in results]
+    failed = len([r for r in results if r['status'] != STATUS_OK])
+    return format_table(header, rows, '%d of %d devices provisioned, %d failed' %
+                        (len(results) - failed, len(results), failed))
+
+
+def format_table(header, rows, footer):
+    """Renders rows of strings under header as columns padded to their widest
+    cell, the last column left ragged, followed by a blank line and footer"""
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header) - 1)]
+    lines = []
+    for row in [header] + rows:
+        lines.append('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) + '  ' + row[-1])
+    lines.append('')
+    lines.append(footer)
+    return '\n'.join(line.rstrip() for line in lines)
@@ -0,0 +1,190 @@
+"""Per-device record of completed provisioning steps, so that a rerun picks
+up where an interrupted run stopped.
+
+Every device has a small JSON journal under the per-user cache directory.
+When a step succeeds (confirming the resource group, resolving the IoT Hub,
+creating the device identity, tagging its twin, uploading the scripts,
+starting runner.sh) it is recorded with a fingerprint of its inputs and the
+few values later steps need. A rerun skips every step whose fingerprint
+still matches and redoes those whose inputs changed. The journal is
+rewritten atomically after each step, so a crash loses at most the step in
+flight, and a lock file keeps two runs from provisioning the same device at
+once while runs for different devices go ahead independently. The sample
+Function App keeps a journal of its own, so an unchanged function package is
+not deployed again.
+
+Secrets are never written to a journal: keys and connection strings are
+looked up again, and fingerprints are salted hashes.
+"""
+import binascii
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import iot_cache
+
+# Provisioning steps in the order a run completes them
+STEP_RESOURCE_GROUP = 'resource group'
+STEP_IOTHUB = 'iothub'
+STEP_IDENTITY = 'device identity'
+STEP_TWIN = 'device twin'
+STEP_SCRIPTS = 'scripts uploaded'
+STEP_RUNNER = 'runner launched'
+STEPS = (STEP_RESOURCE_GROUP, STEP_IOTHUB, STEP_IDENTITY, STEP_TWIN, STEP_SCRIPTS, STEP_RUNNER)
+
+# Deployment steps of the sample Function App, journaled per app
+STEP_FUNCTION_APP = 'function app'
+STEP_FUNCTION_SETTINGS = 'function app settings'
+STEP_FUNCTION_PACKAGE = 'function package'
+FUNCTION_APP_STEPS = (STEP_FUNCTION_APP, STEP_FUNCTION_SETTINGS, STEP_FUNCTION_PACKAGE)
+
+JOURNAL_VERSION = 1
+
+
+class JournalLocked(Exception):
+    """Raised when another run is provisioning the same device"""
+
+
+def journal_path(iothub, device):
+    """Returns the journal file of a device in an IoT Hub"""
+    key = '%s/%s' % (iothub.lower(), device)
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(iot_cache.cache_dir('journal'), digest + '.json')
+
+
+class Journal(object):
+    """The completed steps of one device. A journal without a path keeps its
+    steps in memory only; for_device() opens the persistent one."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.device = None
+        self.steps = {}
+        # inputs of the steps recorded by this run, kept in memory only
+        self._inputs = {}
+        self.salt = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self._lock = threading.Lock()
+        self._lock_file = None
+        if path:
+            self._acquire()
+            self._load()
+
+    @classmethod
+    def for_device(cls, iothub, device):
+        """Opens (and locks) the journal of a device. Raises JournalLocked if
+        another run holds it."""
+        journal = cls(journal_path(iothub, device))
+        journal.device = '%s/%s' % (iothub, device)
+        return journal
+
+    @classmethod
+    def for_function_app(cls, rgroup, app):
+        """Opens (and locks) the journal of a Function App in a resource
+        group. Raises JournalLocked if another run holds it."""
+        journal = cls(journal_path('functionapp:%s' % rgroup, app))
+        journal.device = 'functionapp:%s/%s' % (rgroup, app)
+        return journal
+
+    def _acquire(self):
+        self._lock_file = open(self.path + '.lock', 'a+')
+        try:
+            try:
+                import fcntl
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except ImportError:
+                import msvcrt
+                msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            self._lock_file.close()
+            self._lock_file = None
+            raise JournalLocked("Another run is already provisioning this device (lock file '%s.lock')" % self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != JOURNAL_VERSION:
+            return
+        self.salt = data.get('salt', self.salt)
+        self.steps = data.get('steps', {})
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {'version': JOURNAL_VERSION, 'device': self.device, 'salt': self.salt, 'steps': self.steps}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            iot_cache.replace_file(tmp, self.path)
+        except (IOError, OSError):
+            # the step is simply redone by the next run
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def fingerprint(self, inputs):
+        """Returns a salted digest of a step's inputs, any JSON-serialisable value"""
+        text = self.salt + json.dumps(inputs, sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def done(self, step, inputs):
+        """Returns the values recorded with step (a dict) if it was completed
+        with the same inputs, or None if it has to run"""
+        with self._lock:
+            entry = self.steps.get(step)
+        if entry and entry.get('fingerprint') == self.fingerprint(inputs):
+            return dict(entry.get('result') or {})
+        return None
+
+    def recorded(self, step):
+        """True if step was completed at all, whatever its inputs were"""
+        with self._lock:
+            return step in self.steps
+
+    def record(self, step, inputs, result=None):
+        """Marks step as completed with inputs and writes the journal. result
+        holds values (no secrets) a rerun restores instead of redoing step."""
+        entry = {'fingerprint': self.fingerprint(inputs), 'completed': time.time(), 'result': result or {}}
+        with self._lock:
+            self.steps[step] = entry
+            self._inputs[step] = inputs
+            self._save()
+
+    def adopt(self, other):
+        """Takes over the steps an in-memory journal recorded before this one was opened"""
+        with self._lock:
+            for step, inputs in other._inputs.items():
+                self.steps[step] = dict(other.steps[step], fingerprint=self.fingerprint(inputs))
+                self._inputs[step] = inputs
+            self._save()
+
+    def resume_point(self):
+        """Returns the first step not completed yet, or None if all are"""
+        with self._lock:
+            for step in STEPS:
+                if step not in self.steps:
+                    return step
+        return None
+
+    def reset(self):
+        """Forgets every completed step"""
+        with self._lock:
+            self.steps = {}
+            self._inputs = {}
+            self._save()
+
+    def close(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,186 @@
+"""Long running Azure operations, such as creating an IoT Hub, a container
+registry or a storage account, that are started without waiting for them.
+
+A backend returns an Operation from its begin_create_* methods. Operations
+are polled with exponential backoff until they finish; several can be
+waited for together with complete(), which shows one live status line per
+resource so that a fresh environment's resources are created side by side
+instead of one after another.
+"""
+import sys
+import threading
+import time
+
+# Seconds between polls start at INITIAL_POLL_INTERVAL and double up to MAX_POLL_INTERVAL
+INITIAL_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 15
+
+# Seconds between polls of operations running on a local thread, which are free to check
+LOCAL_POLL_INTERVAL = 0.2
+
+# Seconds between redraws of the status display
+DISPLAY_REFRESH = 1
+
+STATUS_RUNNING = 'creating'
+STATUS_DONE = 'ready'
+STATUS_FAILED = 'failed'
+
+
+class Operation(object):
+    """An operation in progress. Subclasses implement _check(), which returns
+    the (output, err) result once the operation has finished and None while it
+    is still running."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.output = None
+        self.err = None
+        self.polls = 0
+        self._interval = INITIAL_POLL_INTERVAL
+        self._next_check = self.started
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def status(self):
+        if not self.done:
+            return STATUS_RUNNING
+        return STATUS_FAILED if self.err else STATUS_DONE
+
+    def _check(self):
+        raise NotImplementedError
+
+    def _next_interval(self):
+        interval = self._interval
+        self._interval = min(self._interval * 2, MAX_POLL_INTERVAL)
+        return interval
+
+    def poll(self):
+        """Checks on the operation if a check is due. Returns True once it finished."""
+        now = time.time()
+        if self.done or now < self._next_check:
+            return self.done
+        self.polls += 1
+        result = self._check()
+        if result is None:
+            self._next_check = now + self._next_interval()
+        else:
+            self.output, self.err = result
+            self.finished = time.time()
+        return self.done
+
+    def seconds_until_due(self):
+        return max(0, self._next_check - time.time())
+
+    def wait(self):
+        """Blocks until the operation finished and returns its (output, err)"""
+        while not self.poll():
+            time.sleep(self.seconds_until_due())
+        return self.output, self.err
+
+
+class Finished(Operation):
+    """An operation that completed (or failed) as soon as it was started"""
+
+    def __init__(self, output, err):
+        super(Finished, self).__init__()
+        self.output, self.err = output, err
+        self.finished = self.started
+
+    def _check(self):
+        return self.output, self.err
+
+
+class ThreadOperation(Operation):
+    """Runs a blocking fn(*args), which returns (output, err), on a background thread"""
+
+    def __init__(self, fn, *args):
+        super(ThreadOperation, self).__init__()
+        self._result = []
+        self._thread = threading.Thread(target=self._run, args=(fn,) + args)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, fn, *args):
+        try:
+            self._result.append(fn(*args))
+        except Exception as e:
+            self._result.append((None, str(e) or e.__class__.__name__))
+
+    def _check(self):
+        return self._result[0] if self._result else None
+
+    def _next_interval(self):
+        return LOCAL_POLL_INTERVAL
+
+
+class Pending(object):
+    """A resource being created. Once its operation finished, finish(output,
+    err) is called and may return another Pending to wait for, e.g. after
+    asking the user for a different name."""
+
+    def __init__(self, label, operation, finish):
+        self.label = label
+        self.operation = operation
+        self.finish = finish
+
+
+class StatusDisplay(object):
+    """One status line per resource. On a terminal the lines are redrawn in
+    place; otherwise a line is printed whenever a resource changes status."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._drawn = 0
+        self._shown = {}
+
+    def update(self, pending):
+        now = time.time()
+        lines = []
+        for p in pending:
+            operation = p.operation
+            elapsed = (operation.finished or now) - operation.started
+            lines.append('%s: %s (%ds)' % (p.label, operation.status, elapsed))
+            if not self.tty and self._shown.get(p) != operation.status:
+                self._shown[p] = operation.status
+                self.stream.write(lines[-1] + '\n')
+        if self.tty:
+            if self._drawn:
+                # move back up to the first line drawn last time
+                self.stream.write('\x1b[%dA' % self._drawn)
+            for line in lines:
+                self.stream.write('\x1b[2K' + line + '\n')
+            self._drawn = len(lines)
+        self.stream.flush()
+
+    def close(self):
+        self._drawn = 0
+
+
+def wait_all(pending, display=None):
+    """Polls the operations of every Pending until all of them finished"""
+    while True:
+        finished = [p.operation.poll() for p in pending]
+        if display:
+            display.update(pending)
+        if all(finished):
+            return
+        time.sleep(min([DISPLAY_REFRESH] + [p.operation.seconds_until_due() for p in pending
+                                            if not p.operation.done]))
+
+
+def complete(pending, display=None):
+    """Waits for every Pending (None entries are skipped), then calls their
+    finish callbacks in order on the calling thread. Follow-ups returned by
+    the callbacks are waited for the same way until nothing is left."""
+    display = display or StatusDisplay()
+    pending = [p for p in pending if p is not None]
+    while pending:
+        wait_all(pending, display)
+        display.close()
+        pending = [p.finish(p.operation.output, p.operation.err) for p in pending]
+        pending = [p for p in pending if p is not None]
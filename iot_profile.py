@@ -0,0 +1,161 @@
+"""Lightweight timing of the phases of a CLI run.
+
+Code marks a phase with `with span('name'):` or the `timed()` decorator.
+Spans are only recorded while the profiler is enabled (iot --profile PATH),
+so instrumented code costs next to nothing otherwise. At the end of the run
+the spans are printed as a summary and written to PATH in the Chrome trace
+event format, which chrome://tracing and https://ui.perfetto.dev can load.
+Spans carry the thread they ran on, so concurrent lookups show up side by
+side.
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Span categories
+PHASE = 'phase'
+SUBPROCESS = 'subprocess'
+SSH = 'ssh'
+HTTP = 'http'
+WAIT = 'wait'
+CACHE = 'cache'
+
+# Categories listed call by call in the summary, rather than aggregated
+CALL_CATEGORIES = (SUBPROCESS, SSH, HTTP)
+
+# Widest span name shown in the summary
+SUMMARY_NAME_WIDTH = 56
+
+
+class Span(object):
+    """One timed phase: when it started, how long it took, and on which thread"""
+
+    def __init__(self, name, category, start, duration, thread, args):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.duration = duration
+        self.thread = thread
+        self.args = args
+
+    def __repr__(self):
+        return '<Span %s %r %.3fs>' % (self.category, self.name, self.duration)
+
+
+class Profiler(object):
+    """Collects spans from any thread while enabled"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.origin = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, name, category, start, duration, **args):
+        span = Span(name, category, start, duration, threading.current_thread().name, args)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, category=PHASE, **args):
+        """Times the body of a with statement as a span called name"""
+        if not self.enabled:
+            yield args
+            return
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = '%s: %s' % (e.__class__.__name__, e)
+            raise
+        finally:
+            self.record(name, category, start, time.time() - start, **args)
+
+    def timed(self, name=None, category=PHASE):
+        """Decorator that records every call of a function as a span"""
+        def decorate(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with self.span(name or f.__name__, category):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def summary(self):
+        """Renders the recorded spans as a plain text report: the total time
+        per phase, then every subprocess, SSH and HTTP call in start order"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+
+        totals = {}
+        for span in spans:
+            if span.category not in CALL_CATEGORIES:
+                calls, total, longest = totals.get((span.category, span.name), (0, 0.0, 0.0))
+                totals[(span.category, span.name)] = (calls + 1, total + span.duration, max(longest, span.duration))
+
+        lines = ['%-*s %-10s %5s %9s %9s' % (SUMMARY_NAME_WIDTH, 'PHASE', 'CATEGORY', 'CALLS', 'TOTAL', 'MAX')]
+        for (category, name), (calls, total, longest) in sorted(totals.items(), key=lambda i: -i[1][1]):
+            lines.append('%-*s %-10s %5d %8.3fs %8.3fs' % (SUMMARY_NAME_WIDTH, _shorten(name), category,
+                                                          calls, total, longest))
+
+        calls = [s for s in spans if s.category in CALL_CATEGORIES]
+        if calls:
+            lines.append('')
+            lines.append('%-*s %-10s %9s %9s' % (SUMMARY_NAME_WIDTH, 'CALL', 'CATEGORY', 'START', 'TIME'))
+            for span in calls:
+                lines.append('%-*s %-10s %8.3fs %8.3fs' % (SUMMARY_NAME_WIDTH, _shorten(span.name), span.category,
+                                                          span.start - self.origin, span.duration))
+            by_category = {}
+            for span in calls:
+                count, total = by_category.get(span.category, (0, 0.0))
+                by_category[span.category] = (count + 1, total + span.duration)
+            lines.append('')
+            lines.append(', '.join('%d %s calls (%.3fs)' % (count, category, total)
+                                   for category, (count, total) in sorted(by_category.items())))
+        return '\n'.join(line.rstrip() for line in lines)
+
+    def trace_events(self):
+        """Returns the spans as Chrome trace 'complete' events"""
+        with self._lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for span in spans:
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int((span.start - self.origin) * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': span.args,
+            })
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': thread}})
+        return events
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f, indent=1, default=str)
+
+
+def _shorten(name):
+    name = ' '.join(name.split())
+    if len(name) <= SUMMARY_NAME_WIDTH:
+        return name
+    return name[:SUMMARY_NAME_WIDTH - 3] + '...'
+
+
+# Profiler shared by the CLI and the modules it uses
+profiler = Profiler()
+span = profiler.span
+timed = profiler.timed
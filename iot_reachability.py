@@ -0,0 +1,162 @@
+"""Reachability probes for devices and services.
+
+Instead of forking ping in a loop, hosts are probed by opening a TCP
+connection to the port that will actually be used (22 for a Raspberry Pi, 80
+for the button access point). Connects are non-blocking and driven by a
+single loop waiting in poll() (or select() where there is no poll()), so any
+number of hosts can be probed at once without threads. Failed attempts are retried with jittered exponential backoff until
+an overall deadline passes.
+"""
+import errno
+import random
+import select
+import socket
+import time
+
+SSH_PORT = 22
+HTTP_PORT = 80
+
+# Seconds to wait for a host before giving up
+DEFAULT_DEADLINE = 60
+
+# Seconds a single connection attempt may take
+ATTEMPT_TIMEOUT = 2
+
+# Backoff between attempts starts at INITIAL_BACKOFF and doubles up to MAX_BACKOFF
+INITIAL_BACKOFF = 0.25
+MAX_BACKOFF = 5
+
+# Errors of a non-blocking connect that is still under way
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1))
+
+
+class ProbeResult(object):
+    """Outcome of probing one host: whether it became reachable, after how
+    many seconds and connection attempts, and the last error seen"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reachable = False
+        self.elapsed = None
+        self.attempts = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<ProbeResult %s:%d reachable=%r elapsed=%r attempts=%d>' % (
+            self.host, self.port, self.reachable, self.elapsed, self.attempts)
+
+
+class _Target(object):
+
+    def __init__(self, host, port, start):
+        self.result = ProbeResult(host, port)
+        self.start = start
+        self.sock = None
+        self.attempt_deadline = None
+        self.next_attempt = 0
+        self.backoff = INITIAL_BACKOFF
+
+    def connect(self, now):
+        self.result.attempts += 1
+        try:
+            address = socket.getaddrinfo(self.result.host, self.result.port, 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(address[0], address[1], address[2])
+            self.sock.setblocking(False)
+            code = self.sock.connect_ex(address[4])
+        except (socket.error, socket.gaierror) as e:
+            return self.fail(now, e)
+        if code == 0:
+            return self.succeed(now)
+        if code not in IN_PROGRESS:
+            return self.fail(now, socket.error(code, errno.errorcode.get(code, 'connect failed')))
+        self.attempt_deadline = now + ATTEMPT_TIMEOUT
+
+    def check(self, now):
+        code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code == 0:
+            self.succeed(now)
+        else:
+            self.fail(now, socket.error(code, errno.errorcode.get(code, 'connect failed')))
+
+    def succeed(self, now):
+        self.close()
+        self.result.reachable = True
+        self.result.elapsed = now - self.start
+
+    def fail(self, now, error):
+        self.close()
+        self.result.error = error
+        self.next_attempt = now + self.backoff * random.uniform(0.5, 1.0)
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def wait_ready(reading, writing, timeout):
+    """Waits up to timeout seconds (None for no limit) for any of reading to
+    have data or any of writing to be writable, and returns the set of those
+    that are ready or have failed. Both hold sockets or anything else with a
+    fileno(), such as paramiko channels. poll() is used where available, as
+    select() cannot watch descriptors numbered 1024 or higher."""
+    if not hasattr(select, 'poll'):
+        readable, writable, errored = select.select(reading, writing, writing, timeout)
+        return set(readable) | set(writable) | set(errored)
+    poller = select.poll()
+    events = {}
+    watched = {}
+    for objects, event in ((reading, select.POLLIN), (writing, select.POLLOUT)):
+        for watch in objects:
+            fd = watch.fileno()
+            events[fd] = events.get(fd, 0) | event | select.POLLERR | select.POLLHUP
+            watched[fd] = watch
+    for fd, mask in events.items():
+        poller.register(fd, mask)
+    return set(watched[fd] for fd, _ in poller.poll(None if timeout is None else timeout * 1000))
+
+
+def wait_all(targets, deadline=DEFAULT_DEADLINE):
+    """Probes every (host, port) in targets concurrently until each one
+    accepts a TCP connection or deadline seconds pass. Returns a ProbeResult
+    per target, in order."""
+    start = time.time()
+    end = start + deadline
+    pending = [_Target(host, port, start) for host, port in targets]
+    results = [t.result for t in pending]
+
+    while True:
+        pending = [t for t in pending if not t.result.reachable]
+        now = time.time()
+        if not pending or now >= end:
+            break
+
+        for target in pending:
+            if target.sock is None and target.next_attempt <= now:
+                target.connect(now)
+            elif target.sock is not None and target.attempt_deadline <= now:
+                target.fail(now, socket.timeout('timed out'))
+
+        connecting = [t for t in pending if t.sock is not None]
+        waiting = [t.next_attempt for t in pending if t.sock is None and not t.result.reachable]
+        wake = min([end] + [t.attempt_deadline for t in connecting] + waiting)
+        timeout = max(0, wake - now)
+        if connecting:
+            sockets = [t.sock for t in connecting]
+            ready = wait_ready([], sockets, timeout)
+            for target in connecting:
+                if target.sock in ready:
+                    target.check(time.time())
+        elif timeout and not any(t.result.reachable for t in pending):
+            time.sleep(timeout)
+
+    for target in pending:
+        target.close()
+    return results
+
+
+def wait_until_reachable(host, port, deadline=DEFAULT_DEADLINE):
+    """Waits for a single host to accept connections on port. Returns its ProbeResult."""
+    return wait_all([(host, port)], deadline)[0]
@@ -0,0 +1,411 @@
+"""Backend that calls Azure Resource Manager and the IoT Hub service API
+directly instead of spawning az. Kept apart from iot_backends so that requests
+is only imported when this backend is selected.
+"""
+import json
+import os
+import subprocess
+import threading
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import iot_operations
+import iot_profile
+import iot_scheduler
+from iot_backends import Backend, DeviceIndex, DeviceListError, run_each
+from iot_credentials import (HUB_OWNER_POLICY, SasTokenCache, device_connection_string, generate_key,
+                             hub_connection_string)
+
+ARM_ENDPOINT = 'https://management.azure.com'
+ARM_RESOURCES_API_VERSION = '2018-05-01'
+ARM_IOTHUB_API_VERSION = '2018-04-01'
+ARM_CONTAINER_REGISTRY_API_VERSION = '2017-10-01'
+ARM_STORAGE_API_VERSION = '2018-07-01'
+IOTHUB_SERVICE_API_VERSION = '2018-06-30'
+
+# Seconds before the first poll of a long running create, doubling afterwards
+PROVISIONING_POLL_INTERVAL = iot_operations.INITIAL_POLL_INTERVAL
+
+STORAGE_SKU = 'Standard_LRS'
+
+# Devices requested per page when streaming a device registry
+DEVICE_PAGE_SIZE = 1000
+
+# Identities created per bulk registry request, the most IoT Hub accepts
+BULK_REGISTRY_BATCH_SIZE = 100
+
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = (10, 60)
+
+
+class RestBackend(Backend):
+    """Talks to Azure Resource Manager and the IoT Hub service API over a
+    single keep-alive requests.Session.
+
+    The ARM bearer token and subscription are taken from the arguments, then
+    from AZURE_ACCESS_TOKEN / AZURE_SUBSCRIPTION_ID, and finally from a single
+    'az account get-access-token' call. hub_endpoint replaces
+    https://<hub hostname> for service API calls, which lets a local stand-in
+    serve both planes."""
+
+    name = 'rest'
+
+    def __init__(self, subscription=None, token=None, arm_endpoint=ARM_ENDPOINT, hub_endpoint=None,
+                 poll_interval=PROVISIONING_POLL_INTERVAL, scheduler=None):
+        self.subscription = subscription or os.environ.get('AZURE_SUBSCRIPTION_ID')
+        self.token = token or os.environ.get('AZURE_ACCESS_TOKEN')
+        self.arm_endpoint = arm_endpoint.rstrip('/')
+        self.hub_endpoint = hub_endpoint.rstrip('/') if hub_endpoint else None
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler or iot_scheduler.scheduler
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._hubs = {}
+        self._tokens = SasTokenCache()
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def _credentials(self):
+        with self._lock:
+            if not self.token or not self.subscription:
+                with iot_profile.span('az account get-access-token', iot_profile.SUBPROCESS):
+                    p = subprocess.Popen('az account get-access-token', stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, shell=True)
+                    out, err = p.communicate()
+                if p.returncode != 0:
+                    raise requests.RequestException(err.decode('utf-8') or 'az account get-access-token failed')
+                account = json.loads(out)
+                self.token = self.token or account['accessToken']
+                self.subscription = self.subscription or account['subscription']
+        return self.token, self.subscription
+
+    def _group_url(self, rgroup):
+        _, subscription = self._credentials()
+        return '%s/subscriptions/%s/resourceGroups/%s' % (self.arm_endpoint, subscription, rgroup)
+
+    def _hub_url(self, rgroup, hub):
+        return '%s/providers/Microsoft.Devices/IotHubs/%s' % (self._group_url(rgroup), hub)
+
+    def _registry_url(self, rgroup, registry=None):
+        url = '%s/providers/Microsoft.ContainerRegistry/registries' % self._group_url(rgroup)
+        return '%s/%s' % (url, registry) if registry else url
+
+    def _arm(self, method, url, api_version, body=None):
+        token, _ = self._credentials()
+        # nextLink urls already carry their api-version
+        params = None if 'api-version=' in url else {'api-version': api_version}
+        return self._request(iot_scheduler.FAMILY_ARM, method, url, params=params, json=body,
+                             headers={'Authorization': 'Bearer ' + token})
+
+    def _service(self, rgroup, hub, method, path, body=None, headers=None):
+        hostname, key = self._hub_owner(rgroup, hub)
+        base = self.hub_endpoint or 'https://' + hostname
+        all_headers = {'Authorization': self._tokens.service_token(hostname, key)}
+        all_headers.update(headers or {})
+        return self._request(iot_scheduler.service_family(path), method, base + path,
+                             params={'api-version': IOTHUB_SERVICE_API_VERSION}, json=body, headers=all_headers)
+
+    def _request(self, family, method, url, **kwargs):
+        """Sends a request through the scheduler, which rate limits it and
+        retries throttled answers, server errors and dropped connections.
+        Every request this backend makes is safe to repeat: its PUTs and
+        PATCHes set absolute state, and its POSTs either read or (bulk
+        creates) report duplicates that ensure_devices reads back."""
+        def send():
+            with iot_profile.span('%s %s' % (method, urlsplit(url).path), iot_profile.HTTP) as span:
+                response = self.session.request(method, url, timeout=HTTP_TIMEOUT, **kwargs)
+                span['status'] = response.status_code
+            return response
+        return self.scheduler.call(family, send, _classify)
+
+    def _hub_owner(self, rgroup, hub):
+        """Returns the hostname and iothubowner key of a hub, fetching them once"""
+        cache_key = (rgroup.lower(), hub.lower())
+        if cache_key not in self._hubs:
+            hub_info, err = self.show_hub(rgroup, hub)
+            if err:
+                raise requests.RequestException(err)
+            r = self._arm('POST', self._hub_url(rgroup, hub) + '/listkeys', ARM_IOTHUB_API_VERSION)
+            r.raise_for_status()
+            keys = [k for k in r.json()['value'] if k['keyName'] == HUB_OWNER_POLICY]
+            if not keys:
+                raise requests.RequestException("IoT Hub '%s' has no '%s' policy" % (hub, HUB_OWNER_POLICY))
+            self._hubs[cache_key] = (hub_info['properties']['hostName'], keys[0]['primaryKey'])
+        return self._hubs[cache_key]
+
+    @staticmethod
+    def _result(response):
+        """Converts a response into the (output, err) convention"""
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            return None, '%s\n%s' % (e, response.text)
+        if not response.content:
+            return {}, ''
+        return response.json(), ''
+
+    def _call(self, fn, *args):
+        try:
+            return fn(*args)
+        except (requests.RequestException, DeviceListError, KeyError, ValueError) as e:
+            return None, str(e)
+
+    def _begin_create(self, rgroup, url, api_version, body):
+        """PUTs a new resource in the resource group's location and returns a
+        ProvisioningOperation that polls it until provisioning finished"""
+        def put():
+            group, err = self._result(self._arm('GET', self._group_url(rgroup), ARM_RESOURCES_API_VERSION))
+            if err:
+                return None, err
+            body['location'] = group['location']
+            return self._result(self._arm('PUT', url, api_version, body))
+        output, err = self._call(put)
+        if err:
+            return iot_operations.Finished(None, err)
+        if (output or {}).get('properties', {}).get('provisioningState') == 'Succeeded':
+            return iot_operations.Finished(output, '')
+        return ProvisioningOperation(self, url, api_version)
+
+    def group_exists(self, rgroup):
+        def head():
+            r = self._arm('HEAD', self._group_url(rgroup), ARM_RESOURCES_API_VERSION)
+            if r.status_code == 404:
+                return False, ''
+            r.raise_for_status()
+            return True, ''
+        return self._call(head)
+
+    def create_group(self, rgroup, location):
+        return self._call(lambda: self._result(
+            self._arm('PUT', self._group_url(rgroup), ARM_RESOURCES_API_VERSION, {'location': location})))
+
+    def show_hub(self, rgroup, hub):
+        return self._call(lambda: self._result(
+            self._arm('GET', self._hub_url(rgroup, hub), ARM_IOTHUB_API_VERSION)))
+
+    def create_hub(self, rgroup, hub, sku):
+        return self.begin_create_hub(rgroup, hub, sku).wait()
+
+    def begin_create_hub(self, rgroup, hub, sku):
+        return self._begin_create(rgroup, self._hub_url(rgroup, hub), ARM_IOTHUB_API_VERSION,
+                                  {'sku': {'name': sku, 'capacity': 1}, 'properties': {}})
+
+    def _query_pages(self, rgroup, hub, query):
+        """Yields the pages of a device registry query one at a time"""
+        continuation = None
+        while True:
+            headers = {'x-ms-max-item-count': str(DEVICE_PAGE_SIZE)}
+            if continuation:
+                headers['x-ms-continuation'] = continuation
+            r = self._service(rgroup, hub, 'POST', '/devices/query', {'query': query}, headers)
+            page, err = self._result(r)
+            if err:
+                raise DeviceListError(err)
+            yield page
+            continuation = r.headers.get('x-ms-continuation')
+            if not continuation:
+                return
+
+    def list_devices(self, rgroup, hub):
+        def query():
+            devices = []
+            for page in self._query_pages(rgroup, hub, 'SELECT * FROM devices'):
+                devices.extend(page)
+            return devices, ''
+        return self._call(query)
+
+    def iter_device_ids(self, rgroup, hub):
+        try:
+            for page in self._query_pages(rgroup, hub, 'SELECT deviceId FROM devices'):
+                for device in page:
+                    yield device['deviceId']
+        except requests.RequestException as e:
+            raise DeviceListError(str(e))
+
+    def show_device(self, rgroup, hub, device):
+        return self._call(lambda: self._result(self._service(rgroup, hub, 'GET', '/devices/%s' % device)))
+
+    def create_device(self, rgroup, hub, device, edge_enabled=False):
+        body = _new_identity(device, edge_enabled)
+        return self._call(lambda: self._result(self._service(rgroup, hub, 'PUT', '/devices/%s' % device, body)))
+
+    def ensure_devices(self, rgroup, hub, devices, edge_enabled=False, max_workers=HTTP_POOL_SIZE):
+        """Creates the missing identities with the bulk registry API, up to
+        BULK_REGISTRY_BATCH_SIZE per request. Their keys are generated here, so
+        only devices that already existed are read back."""
+        try:
+            missing = DeviceIndex(self, rgroup, hub).missing(devices)
+        except DeviceListError as e:
+            return dict((device, (None, str(e))) for device in devices)
+
+        identities = dict((device, _new_identity(device, edge_enabled)) for device in missing)
+        batches = [tuple(missing[i:i + BULK_REGISTRY_BATCH_SIZE])
+                   for i in range(0, len(missing), BULK_REGISTRY_BATCH_SIZE)]
+        imported = run_each(lambda batch: self._import_identities(rgroup, hub, [identities[d] for d in batch]),
+                            batches, max_workers)
+        results = {}
+        for batch in batches:
+            errors, err = imported[batch]
+            for device in batch:
+                if err or errors is None:
+                    results[device] = (None, err)
+                elif device in errors:
+                    # created by someone else since the registry was listed, read back below
+                    if errors[device]['errorCode'] != 'DeviceAlreadyExists':
+                        results[device] = (None, '%(errorCode)s: %(errorStatus)s' % errors[device])
+                else:
+                    results[device] = (identities[device], '')
+
+        existing = [device for device in devices if device not in results]
+        results.update(run_each(lambda device: self.show_device(rgroup, hub, device), existing, max_workers))
+        return results
+
+    def _import_identities(self, rgroup, hub, identities):
+        """Creates identities in one bulk registry request. Returns the errors
+        reported for single devices as a dict keyed by device id, and the
+        error text if the whole request failed."""
+        def post():
+            body = []
+            for identity in identities:
+                entry = dict(identity, id=identity['deviceId'], importMode='create')
+                del entry['deviceId']
+                body.append(entry)
+            r = self._service(rgroup, hub, 'POST', '/devices', body)
+            try:
+                result = r.json() if r.content else {}
+            except ValueError:
+                result = {}
+            # a partial failure is answered with 400 and the errors per device
+            if r.ok or (isinstance(result, dict) and result.get('errors')):
+                return dict((e['deviceId'], e) for e in result.get('errors') or []), ''
+            return self._result(r)
+        return self._call(post)
+
+    def device_connection_string(self, rgroup, hub, device):
+        def build():
+            hostname, _ = self._hub_owner(rgroup, hub)
+            existing, err = self.show_device(rgroup, hub, device)
+            if err:
+                return None, err
+            key = existing['authentication']['symmetricKey']['primaryKey']
+            return {'cs': device_connection_string(hostname, device, key)}, ''
+        return self._call(build)
+
+    def hub_connection_string(self, rgroup, hub):
+        def build():
+            hostname, key = self._hub_owner(rgroup, hub)
+            return {'cs': hub_connection_string(hostname, HUB_OWNER_POLICY, key)}, ''
+        return self._call(build)
+
+    def update_device_tags(self, rgroup, hub, device, tags):
+        return self._call(lambda: self._result(
+            self._service(rgroup, hub, 'PATCH', '/twins/%s' % device, {'tags': tags})))
+
+    def update_devices_tags(self, rgroup, hub, tags, max_workers=HTTP_POOL_SIZE):
+        """Patches the twins concurrently, one pooled keep-alive connection per
+        worker. Every twin carries its own id and credentials, so a single
+        scheduled twin update job cannot apply them."""
+        return Backend.update_devices_tags(self, rgroup, hub, tags, max_workers)
+
+    def list_registries(self, rgroup):
+        def list_all():
+            registries = []
+            url = self._registry_url(rgroup)
+            while url:
+                page, err = self._result(self._arm('GET', url, ARM_CONTAINER_REGISTRY_API_VERSION))
+                if err:
+                    return None, err
+                registries.extend(page.get('value', []))
+                url = page.get('nextLink')
+            return registries, ''
+        return self._call(list_all)
+
+    def create_registry(self, rgroup, registry, sku):
+        return self.begin_create_registry(rgroup, registry, sku).wait()
+
+    def begin_create_registry(self, rgroup, registry, sku):
+        return self._begin_create(rgroup, self._registry_url(rgroup, registry), ARM_CONTAINER_REGISTRY_API_VERSION,
+                                  {'sku': {'name': sku}, 'properties': {'adminUserEnabled': True}})
+
+    def registry_credentials(self, rgroup, registry):
+        return self._call(lambda: self._result(self._arm(
+            'POST', self._registry_url(rgroup, registry) + '/listCredentials', ARM_CONTAINER_REGISTRY_API_VERSION)))
+
+    def _storage_url(self, rgroup, account=None):
+        url = '%s/providers/Microsoft.Storage/storageAccounts' % self._group_url(rgroup)
+        return '%s/%s' % (url, account) if account else url
+
+    def list_storage_accounts(self, rgroup):
+        def list_all():
+            output, err = self._result(self._arm('GET', self._storage_url(rgroup), ARM_STORAGE_API_VERSION))
+            return (None, err) if err else (output.get('value', []), '')
+        return self._call(list_all)
+
+    def create_storage_account(self, rgroup, account):
+        return self.begin_create_storage_account(rgroup, account).wait()
+
+    def begin_create_storage_account(self, rgroup, account):
+        return self._begin_create(rgroup, self._storage_url(rgroup, account), ARM_STORAGE_API_VERSION,
+                                  {'sku': {'name': STORAGE_SKU}, 'kind': 'Storage', 'properties': {}})
+
+
+def _classify(response, error):
+    if error is not None:
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return iot_scheduler.Retry(error.__class__.__name__)
+        return None
+    return iot_scheduler.classify_status(response.status_code, response.headers)
+
+
+def _new_identity(device, edge_enabled):
+    """A device identity with freshly generated symmetric keys"""
+    return {
+        'deviceId': device,
+        'authentication': {'type': 'sas', 'symmetricKey': {
+            'primaryKey': generate_key(),
+            'secondaryKey': generate_key()}},
+        'capabilities': {'iotEdge': edge_enabled},
+        'status': 'enabled',
+    }
+
+
+class ProvisioningOperation(iot_operations.Operation):
+    """Polls an ARM resource until its provisioningState is final. The
+    resource may not be readable yet right after an asynchronous create
+    (ARM answers 202), so a 404 counts as still in progress."""
+
+    def __init__(self, backend, url, api_version):
+        super(ProvisioningOperation, self).__init__()
+        self.backend = backend
+        self.url = url
+        self.api_version = api_version
+        self._interval = backend.poll_interval
+        self._next_check = self.started + self._next_interval()
+
+    def _check(self):
+        def get():
+            response = self.backend._arm('GET', self.url, self.api_version)
+            if response.status_code == 404:
+                return None
+            return self.backend._result(response)
+        result = self.backend._call(get)
+        if result is None:
+            return None
+        output, err = result
+        if err:
+            return None, err
+        state = output.get('properties', {}).get('provisioningState', 'Succeeded')
+        if state == 'Succeeded':
+            return output, ''
+        if state in ('Failed', 'Canceled'):
+            return None, "Provisioning of '%s' ended in state '%s'" % (output.get('name'), state)
+        return None
@@ -0,0 +1,277 @@
+"""Rate limiting and retries for every call the CLI makes to Azure.
+
+Calls are grouped into the API families Azure throttles separately: Azure
+Resource Manager, and the identity registry, twin and query operations of the
+IoT Hub service API. Each family draws from a token bucket sized after the
+documented limits (per subscription for ARM, per unit of an S1 hub for IoT
+Hub), so concurrent calls are spread out instead of drawing 429 responses.
+
+A call that is throttled anyway, or fails in a way another attempt may fix (a
+5xx answer, a dropped connection), is retried with jittered exponential
+backoff. A Retry-After sent by the service pauses the whole family for that
+long. Retries are limited per call and by a budget shared by all calls, so an
+outage does not multiply the load on the service, and errors no retry can fix
+(bad requests, missing resources, failed authentication) are returned at once.
+Counters of waits, throttles and retries per family are kept for the report
+printed at the end of a run.
+"""
+import random
+import re
+import threading
+import time
+
+import iot_profile
+
+FAMILY_ARM = 'arm'
+FAMILY_REGISTRY = 'iothub registry'
+FAMILY_TWIN = 'iothub twin'
+FAMILY_QUERY = 'iothub query'
+
+# Sustained calls per second and burst size per family
+RATE_LIMITS = {
+    # ARM reads per subscription and hour
+    FAMILY_ARM: (12000 / 3600.0, 100),
+    # per unit of an S1 hub: identity operations and queries per minute, twin updates per second
+    FAMILY_REGISTRY: (100 / 60.0, 100),
+    FAMILY_TWIN: (50.0, 50),
+    FAMILY_QUERY: (20 / 60.0, 20),
+}
+
+# Attempts per call, with a backoff starting at INITIAL_BACKOFF seconds and doubling up to MAX_BACKOFF
+MAX_ATTEMPTS = 5
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+# A call asked to wait longer than this many seconds fails instead
+MAX_RETRY_AFTER = 120
+
+# Retries allowed across all calls: RETRY_BUDGET_RATIO per call made, at most RETRY_BUDGET_MINIMUM banked
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MINIMUM = 10
+
+# HTTP status codes that are worth retrying. 429 and 503 mean the request was
+# not processed; after the others only idempotent requests are repeated.
+THROTTLED_STATUS = (429, 503)
+TRANSIENT_STATUS = (408, 500, 502, 504)
+
+# Counters kept per family
+CALLS = 'calls'
+WAITED = 'waited'
+THROTTLED = 'throttled'
+RETRIES = 'retries'
+GAVE_UP = 'gave up'
+COUNTERS = (CALLS, WAITED, THROTTLED, RETRIES, GAVE_UP)
+
+_AZ_THROTTLED = re.compile(r'\b(429|503)\b|too ?many ?requests|throttl|server ?busy|service ?unavailable', re.I)
+_AZ_TRANSIENT = re.compile(r'\b50[024]\b|internal ?server ?error|bad ?gateway|gateway ?time-?out|timed out|'
+                           r'connection (aborted|reset|refused)|temporarily unavailable', re.I)
+
+
+class Retry(object):
+    """Returned by a classify function for a result worth another attempt.
+    after is the delay in seconds the service asked for, if it gave one."""
+
+    def __init__(self, reason, throttled=False, after=None):
+        self.reason = reason
+        self.throttled = throttled
+        self.after = after
+
+    def __repr__(self):
+        return '<Retry %s throttled=%r after=%r>' % (self.reason, self.throttled, self.after)
+
+
+class TokenBucket(object):
+    """Allows rate calls per second on average and bursts of up to burst calls"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns the seconds to wait before the call may
+        go ahead. Tokens are handed out in order, so waiting callers get
+        consecutive slots instead of racing for the next one."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        """Holds back every call for seconds, e.g. after a 429"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class RetryBudget(object):
+    """Every call adds ratio to the budget and every retry takes one from it.
+    minimum retries are available up front, and no more than that are banked."""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MINIMUM):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.balance = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.minimum, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Takes a retry from the budget; False if it is exhausted"""
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class Scheduler(object):
+    """Runs calls under their family's rate limit and retries them as their
+    classify function decides. limits maps families to (rate, burst); a family
+    without a limit is not rate limited."""
+
+    def __init__(self, limits=None, max_attempts=MAX_ATTEMPTS, budget=None):
+        limits = RATE_LIMITS if limits is None else limits
+        self.buckets = dict((family, TokenBucket(*limit)) for family, limit in limits.items())
+        self.max_attempts = max_attempts
+        self.budget = budget or RetryBudget()
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _count(self, family, counter, amount=1):
+        with self._lock:
+            counters = self.counters.setdefault(family, dict((c, 0) for c in COUNTERS))
+            counters[counter] += amount
+
+    def _wait(self, family, bucket):
+        wait = bucket.reserve() if bucket else 0
+        if wait > 0:
+            self._count(family, WAITED, wait)
+            with iot_profile.span('rate limit %s' % family, iot_profile.WAIT):
+                time.sleep(wait)
+
+    def call(self, family, fn, classify):
+        """Calls fn() and returns its result, or raises what it raised.
+        classify(result, error) gets the result (or the exception, with result
+        None) and returns a Retry for another attempt, or None to finish."""
+        bucket = self.buckets.get(family)
+        self.budget.deposit()
+        self._count(family, CALLS)
+        backoff = INITIAL_BACKOFF
+        attempt = 1
+        while True:
+            self._wait(family, bucket)
+            try:
+                result, error = fn(), None
+            except Exception as e:
+                result, error = None, e
+            retry = classify(result, error)
+            if retry is not None and retry.throttled:
+                self._count(family, THROTTLED)
+            if retry is not None and (attempt >= self.max_attempts or (retry.after or 0) > MAX_RETRY_AFTER or
+                                      not self.budget.withdraw()):
+                self._count(family, GAVE_UP)
+                retry = None
+            if retry is None:
+                if error is not None:
+                    raise error
+                return result
+
+            # somewhere between half and all of the backoff, so that concurrent callers spread out
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+            if retry.after is not None:
+                delay = max(retry.after, delay)
+            self._count(family, RETRIES)
+            if retry.throttled and bucket:
+                # everyone calling the family waits, not just this caller
+                bucket.pause(delay)
+            else:
+                with iot_profile.span('backoff %s' % family, iot_profile.WAIT, reason=retry.reason):
+                    time.sleep(delay)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            attempt += 1
+
+    def total(self, counter):
+        with self._lock:
+            return sum(counters[counter] for counters in self.counters.values())
+
+    def summary(self):
+        """The counters as a table, one line per family"""
+        with self._lock:
+            counters = sorted(self.counters.items())
+        lines = ['%-16s %6s %8s %9s %7s %7s' % ('API', 'CALLS', 'WAITED', 'THROTTLED', 'RETRIES', 'GAVE UP')]
+        for family, c in counters:
+            lines.append('%-16s %6d %7.1fs %9d %7d %7d' % (family, c[CALLS], c[WAITED], c[THROTTLED], c[RETRIES],
+                                                         c[GAVE_UP]))
+        return '\n'.join(lines)
+
+
+def retry_after(value):
+    """Seconds to wait according to a Retry-After header, which holds either
+    a number of seconds or an HTTP date. None if there is no usable value."""
+    import email.utils
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def classify_status(status, headers, idempotent=True):
+    """Retry for an HTTP response worth repeating, None otherwise"""
+    if status in THROTTLED_STATUS:
+        return Retry('HTTP %d' % status, throttled=True, after=retry_after(headers.get('Retry-After')))
+    if status in TRANSIENT_STATUS and idempotent:
+        return Retry('HTTP %d' % status, after=retry_after(headers.get('Retry-After')))
+    return None
+
+
+def classify_az(result, error, idempotent=True):
+    """Retry for a failed az command whose error output reports throttling
+    or (for commands that are safe to repeat) a transient failure"""
+    if error is not None or result[0]:
+        return None
+    text = result[1].decode('utf-8', 'replace') if isinstance(result[1], bytes) else result[1]
+    if _AZ_THROTTLED.search(text):
+        return Retry('az throttled', throttled=True)
+    if idempotent and _AZ_TRANSIENT.search(text):
+        return Retry('az transient error')
+    return None
+
+
+def az_family(subcommand):
+    """The API family an az subcommand (e.g. 'iot hub device-twin update') calls"""
+    subcommand = subcommand or ''
+    if subcommand.startswith('iot hub device-twin'):
+        return FAMILY_TWIN
+    if subcommand.startswith('iot hub query') or subcommand == 'iot hub device-identity list':
+        return FAMILY_QUERY
+    if subcommand.startswith('iot hub device-identity'):
+        return FAMILY_REGISTRY
+    return FAMILY_ARM
+
+
+def service_family(path):
+    """The API family of an IoT Hub service API path"""
+    if path.startswith('/devices/query'):
+        return FAMILY_QUERY
+    if path.startswith('/twins'):
+        return FAMILY_TWIN
+    return FAMILY_REGISTRY
+
+
+# Scheduler shared by every backend in the process
+scheduler = Scheduler()
@@ -0,0 +1,753 @@
+"""Provisioning Grove Starter Kits and IoT buttons from Python.
+
+A Session carries the settings of a provisioning run (the names of the
+resource group, IoT Hub and container registry, device credentials, WiFi
+settings) in its config dict, together with the clients every step shares:
+the Azure backend and its pooled HTTP session, one SSH transport per device,
+the scripts archive, and the hub's host name, connection strings and registry
+credentials once they were looked up. The iot command line tool is a thin
+layer over it that prompts for what was not given on the command line, so a
+long running service can do what the commands do without starting the CLI
+for every device:
+
+    import iot_session
+
+    with iot_session.Session(rgroup='myrg', iothub='myhub', container_registry='myacr',
+                             wifi_ssid='lab', wifi_password='secret') as session:
+        session.ensure_resource_group(location='westus')
+        session.ensure_iothub()
+        session.ensure_container_registry()
+        session.registry_credentials()
+        results = session.provision_fleet([{'device': 'grove-1', 'ip': '10.0.0.21'}])
+
+Nothing here prompts or exits. A step that cannot go on raises
+iot_fleet.ProvisioningError, and InputRequired when it needs a setting it was
+not given or cannot use the one it was given (e.g. a hub name that is
+taken). for_device() returns a session for one board that shares the clients
+and resolved settings of its parent, with the board's own journal, so that
+boards can be provisioned concurrently and a rerun skips what they already
+completed.
+"""
+import threading
+import time
+
+import iot_backends
+import iot_credentials
+import iot_fleet
+import iot_journal
+import iot_operations
+import iot_profile
+import iot_reachability
+import iot_ssh
+import iot_watch
+
+# paramiko, concurrent.futures, iot_artifacts, iot_button and iot_rest are imported by the
+# methods that need them
+
+SCRIPTS_ZIP_URI = 'http://iotcompanionapp.blob.core.windows.net/scripts/scripts.zip'
+
+# Directory on the device (relative to the user's home) the scripts archive is synced to
+DEVICE_SCRIPTS_DIR = 'scripts'
+
+DEVICE_DESCRIPTION = 'Raspberry Pi 3'
+
+# Upper bound on concurrent Azure lookups for a single device
+MAX_CONCURRENT_LOOKUPS = 4
+
+# Seconds a board gets to accept SSH connections when provisioned without prompting
+DEVICE_SSH_TIMEOUT = 120
+
+# Seconds a button gets to answer on its access point
+BUTTON_PROBE_TIMEOUT = 30
+
+DEFAULT_CONFIG = {
+    'rgroup': None,
+    'iothub': None,
+    'iothub_sku': 'F1',
+    'device': None,
+    'container_registry': None,
+    'container_registry_sku': 'Basic',
+    'ip': None,
+    'username': 'pi',
+    'password': 'raspberry',
+    'wifi_ssid': '',
+    'wifi_password': '',
+    'scripts_path': None,
+    'no_cache': False,
+    'restart': False,
+}
+
+
+class InputRequired(iot_fleet.ProvisioningError):
+    """Raised when a step needs a setting it was not given, or cannot use the
+    value it was given (e.g. a name that is taken). key is the config key to
+    set before trying the step again, and reason what was wrong with the
+    value given, if anything."""
+
+    def __init__(self, key, reason=''):
+        super(InputRequired, self).__init__(reason or "No value given for '%s'" % key)
+        self.key = key
+        self.reason = reason
+
+
+def create_ssh_client(server, port, user, password):
+    """Helper function to wrap paramiko's SSHClient"""
+    import paramiko
+
+    try:
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(server, port, user, password)
+    except paramiko.AuthenticationException:
+        return None
+    return client
+
+
+def run_concurrently(calls, max_workers=MAX_CONCURRENT_LOOKUPS):
+    """Runs independent callables on a bounded thread pool.
+    Takes a list of (name, callable) pairs and returns a dict mapping each name
+    to its result, or to the exception instance if the callable raised."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = {}
+    if not calls:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calls)))) as executor:
+        futures = dict((name, executor.submit(fn)) for name, fn in calls)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+    return results
+
+
+def _hub_cs_or_none(out, err):
+    # stderr actually contains something here on success so check the output instead
+    if out and "cs" in out:
+        return out["cs"]
+    return None
+
+
+def _quiet(message):
+    pass
+
+
+class _Shared(object):
+    """What a session shares with the sessions of its devices"""
+
+    def __init__(self):
+        self.scripts = None
+        self.journals = []
+        self.lock = threading.Lock()
+
+
+class Session(object):
+    """Settings and shared clients of a provisioning run. backend defaults to
+    an iot_rest.RestBackend, ssh to a pool of paramiko clients of its own, and
+    log, which is called with every progress message, to printing nothing.
+    Keyword arguments set config entries (see DEFAULT_CONFIG)."""
+
+    def __init__(self, backend=None, ssh=None, log=None, **config):
+        if backend is None:
+            import iot_rest
+            backend = iot_rest.RestBackend()
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.backend = backend
+        self.ssh = ssh or iot_ssh.SSHConnections(create_ssh_client)
+        self.log = log or _quiet
+        # steps completed by earlier runs; replaced by the device's persistent journal once it is known
+        self.journal = iot_journal.Journal()
+        self._shared = _Shared()
+
+    def set_config(self, key, value):
+        self.config[key] = value
+
+    def require(self, key):
+        """The config value of key, raising InputRequired if it is not set"""
+        if not self.config.get(key):
+            raise InputRequired(key)
+        return self.config[key]
+
+    def _given(self, **values):
+        for key, value in values.items():
+            if value is not None:
+                self.config[key] = value
+
+    def close(self):
+        """Closes the device journals opened by for_device, the SSH transports
+        and the backend's HTTP session"""
+        with self._shared.lock:
+            journals, self._shared.journals = self._shared.journals, []
+        for journal in journals:
+            journal.close()
+        self.ssh.close_all()
+        if hasattr(self.backend, 'close'):
+            self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return '<IoT %r>' % self.config
+
+    def for_device(self, device, ip, user=None, password=None, wifi_ssid=None, wifi_password=None, journal=None):
+        """Returns a session for one board that shares this session's clients
+        and resolved settings. Its progress messages are prefixed with the
+        device id. Unless journal is given, the device's persistent journal is
+        opened (and reset with the restart setting) and closed along with this
+        session."""
+        session = Session(self.backend, self.ssh, lambda message: self.log("[%s] %s" % (device, message.strip())))
+        session.config = dict(self.config, device=device, ip=ip,
+                              username=user or self.config['username'],
+                              password=password or self.config['password'],
+                              wifi_ssid=wifi_ssid or self.config['wifi_ssid'],
+                              wifi_password=wifi_password or self.config['wifi_password'])
+        session.config.pop('key', None)
+        session.config.pop('cs', None)
+        session._shared = self._shared
+        if journal is None:
+            try:
+                journal = iot_journal.Journal.for_device(self.require('iothub'), device)
+            except iot_journal.JournalLocked as e:
+                raise iot_fleet.ProvisioningError(str(e))
+            with self._shared.lock:
+                self._shared.journals.append(journal)
+            if self.config.get('restart'):
+                journal.reset()
+        session.journal = journal
+        return session
+
+    # Azure resources
+
+    def ensure_resource_group(self, name=None, location=None):
+        """Uses the resource group in config, creating it in location if it
+        does not exist"""
+        self._given(rgroup=name, location=location)
+        name = self.require('rgroup')
+        inputs = {'rgroup': name}
+        previous = self.journal.done(iot_journal.STEP_RESOURCE_GROUP, inputs)
+        if previous is not None:
+            self.log("Using Resource Group '%s' confirmed by an earlier run." % name)
+            self.config.update(previous)
+            return
+
+        self.log("Checking for Resource Group with name '%s'" % name)
+        exists, err = self.backend.group_exists(name)
+        result = {}
+        if exists is False:
+            self.log("Resource Group with name '%s' does not exist. Creating a new Resource Group..." % name)
+            location = self.require('location')
+            _, err = self.backend.create_group(name, location)
+            if err:
+                raise iot_fleet.ProvisioningError(err)
+            result['location'] = location
+            self.log("Created a new Resource Group '%s'" % name)
+        elif exists is True:
+            self.log("Using existing Resource Group with name '%s'." % name)
+        else:
+            raise iot_fleet.ProvisioningError(err or "Error checking for resource group existence")
+        self.journal.record(iot_journal.STEP_RESOURCE_GROUP, inputs, result)
+
+    def _iothub_inputs(self, name):
+        return {'rgroup': self.config['rgroup'], 'iothub': name}
+
+    def _iothub_resolved(self, name, hub):
+        """Keeps the hostname and Event Hub-compatible endpoint of a hub, so later
+        steps (e.g. the sample function) need not look the hub up again"""
+        result = {'hostname': hub["properties"]["hostName"]}
+        events = hub["properties"].get("eventHubEndpoints", {}).get("events", {})
+        if events.get("endpoint") and events.get("path"):
+            result['eventhub_endpoint'] = events["endpoint"]
+            result['eventhub_path'] = events["path"]
+        self.config.update(result)
+        self.journal.record(iot_journal.STEP_IOTHUB, self._iothub_inputs(name), result)
+
+    def begin_iothub(self, name=None, sku=None):
+        """Uses the IoT Hub in config if it exists. A new hub is only started,
+        and the returned iot_operations.Pending is to be completed (e.g. with
+        iot_operations.complete) alongside other new resources."""
+        #TODO: deal with clashes both in terms of globally unique names, sku clashes etc
+        # throttling and transient errors are retried by the backend, anything else but a missing hub fails
+        self._given(iothub=name, iothub_sku=sku)
+        name = self.require('iothub')
+        previous = self.journal.done(iot_journal.STEP_IOTHUB, self._iothub_inputs(name))
+        if previous is not None:
+            self.log("Using IoT Hub '%s' resolved by an earlier run" % name)
+            self.config.update(previous)
+            return None
+
+        self.log("Checking for IoT Hub with name '%s'" % name)
+        hub, err = self.backend.show_hub(self.require('rgroup'), name)
+        if not hub and err and not iot_backends.is_not_found(err):
+            raise iot_fleet.ProvisioningError(err)
+        if not hub:
+            self.log("IoT Hub with name '%s' does not exist. Creating a new IoT Hub..." % name)
+            operation = self.backend.begin_create_hub(self.config['rgroup'], name, self.config['iothub_sku'])
+            return iot_operations.Pending("IoT Hub '%s'" % name, operation,
+                                          lambda output, err: self._iothub_created(name, output, err))
+        if "hostName" in hub.get("properties", {}):
+            self.log("Using existing IoT Hub with name '%s'" % name)
+            self._iothub_resolved(name, hub)
+            return None
+        raise iot_fleet.ProvisioningError("IoT Hub '%s' has no host name yet, it may still be provisioning. "
+                                          "Please try again later." % name)
+
+    def _iothub_created(self, name, output, err):
+        if output and "hostName" in output.get("properties", {}):
+            self.log("Created a new IoTHub '%s'" % name)
+            self._iothub_resolved(name, output)
+            return None
+        err = err or "IoT Hub '%s' was not created" % name
+        if 'Bad Request' in err and '400 Client Error' in err and self.config['iothub_sku'] == 'F1':
+            raise InputRequired('iothub_sku', 'Unable to use the Free Tier (F1) IoT Hub SKU.')
+        raise InputRequired('iothub', err)
+
+    def ensure_iothub(self, name=None, sku=None):
+        """Uses the IoT Hub in config, creating it if it does not exist and
+        waiting until it is ready"""
+        iot_operations.complete([self.begin_iothub(name, sku)], iot_operations.StatusDisplay(_NullStream()))
+
+    def begin_container_registry(self, name=None, sku=None):
+        """Like begin_iothub, for the container registry in config"""
+        self._given(container_registry=name, container_registry_sku=sku)
+        name = self.require('container_registry')
+        self.log("Checking for Container Registry " + name)
+        registries, err = self.backend.list_registries(self.require('rgroup'))
+        if err and registries is None:
+            raise iot_fleet.ProvisioningError(err)
+        if name.lower() in set(r["name"].lower() for r in registries or []):
+            self.log("Using existing Container Registry with name '%s'" % name)
+            return None
+
+        self.log("Container Registry with name '%s' does not exist. Creating a new Container Registry..." % name)
+        operation = self.backend.begin_create_registry(self.config['rgroup'], name,
+                                                       self.require('container_registry_sku'))
+        return iot_operations.Pending("Container Registry '%s'" % name, operation,
+                                      lambda output, err: self._container_registry_created(name, err))
+
+    def _container_registry_created(self, name, err):
+        if err:
+            raise InputRequired('container_registry', err)
+        self.log("Created a new Container Registry '%s'" % name)
+        return None
+
+    def ensure_container_registry(self, name=None, sku=None):
+        """Like ensure_iothub, for the container registry in config"""
+        iot_operations.complete([self.begin_container_registry(name, sku)],
+                                iot_operations.StatusDisplay(_NullStream()))
+
+    def registry_credentials(self):
+        """Looks up the admin credentials of the container registry in config,
+        once per session. Returns the user name and password."""
+        if 'cr_user' not in self.config:
+            self.log("Checking for Azure Container Registry credential")
+            creds, err = self.backend.registry_credentials(self.require('rgroup'), self.require('container_registry'))
+            if err:
+                raise iot_fleet.ProvisioningError(err)
+            self.config['cr_pwd'] = creds["passwords"][0]['value']
+            self.config['cr_user'] = creds["username"]
+        return self.config['cr_user'], self.config['cr_pwd']
+
+    def hostname(self):
+        """The host name of the IoT Hub in config, looked up unless the hub was resolved"""
+        if 'hostname' not in self.config:
+            hub, err = self.backend.show_hub(self.require('rgroup'), self.require('iothub'))
+            if not hub or "hostName" not in hub.get("properties", {}):
+                raise iot_fleet.ProvisioningError(err or "IoT Hub '%s' has no host name yet" % self.config['iothub'])
+            self.config['hostname'] = hub["properties"]["hostName"]
+        return self.config['hostname']
+
+    def hub_connection_string(self):
+        """The connection string of the IoT Hub in config, looked up once per session"""
+        if 'hub_cs' not in self.config:
+            out, err = self.backend.hub_connection_string(self.require('rgroup'), self.require('iothub'))
+            hub_cs = _hub_cs_or_none(out, err)
+            if hub_cs is None:
+                raise iot_fleet.ProvisioningError(err or "No connection string for IoT Hub '%s'" %
+                                                  self.config['iothub'])
+            self.config['hub_cs'] = hub_cs
+        return self.config['hub_cs']
+
+    def event_hub_settings(self):
+        """Returns the Event Hub-compatible endpoint and path of the IoT Hub,
+        kept in config when the hub was resolved and looked up otherwise"""
+        if 'eventhub_endpoint' not in self.config:
+            hub, err = self.backend.show_hub(self.require('rgroup'), self.require('iothub'))
+            if hub is None:
+                raise iot_fleet.ProvisioningError(err)
+            events = hub["properties"]["eventHubEndpoints"]["events"]
+            self.config['eventhub_endpoint'] = events["endpoint"]
+            self.config['eventhub_path'] = events["path"]
+        return self.config['eventhub_endpoint'], self.config['eventhub_path']
+
+    # Device identities
+
+    def _identity_inputs(self, name, edge_enabled):
+        return {'rgroup': self.config['rgroup'], 'iothub': self.config['iothub'], 'device': name, 'edge': edge_enabled}
+
+    def ensure_device(self, name=None, edge_enabled=True):
+        """Uses the device identity in config, creating it if it does not
+        exist, and keeps its key"""
+        self._given(device=name)
+        name = self.require('device')
+        inputs = self._identity_inputs(name, edge_enabled)
+        if self.journal.done(iot_journal.STEP_IDENTITY, inputs) is not None:
+            # the key is not journaled, resolve_connection_strings looks it up with the connection strings
+            self.log("Using IoT Hub Edge Device '%s' created by an earlier run" % name)
+            return
+
+        self.log("Checking for IoT Hub Edge Device with name '%s'" % name)
+        # look the device up by id rather than listing the whole registry
+        existing, err = self.backend.show_device(self.require('rgroup'), self.require('iothub'), name)
+        if not existing and err and not iot_backends.is_not_found(err):
+            raise iot_fleet.ProvisioningError(err)
+        if existing:
+            self.log("Using existing IoT Hub Edge Device with name '%s'" % name)
+        else:
+            self.log("IoT Hub Edge Device with name '%s' does not exist. Creating a new IoT Hub Edge Device..." % name)
+            existing, err = self.backend.create_device(self.config['rgroup'], self.config['iothub'], name,
+                                                       edge_enabled=edge_enabled)
+            if err or not existing:
+                raise InputRequired('device', err or "Device identity '%s' was not created" % name)
+        self.config['key'] = existing["authentication"]["symmetricKey"]["primaryKey"]
+        self.journal.record(iot_journal.STEP_IDENTITY, inputs)
+
+    def resolve_connection_strings(self, max_workers=MAX_CONCURRENT_LOOKUPS):
+        """Queries Azure for mising parameters like iothub hostname, keys,
+        and the hub connection string. The lookups are independent of each other
+        so they are dispatched concurrently and merged into config once all
+        complete. The device connection string is then built from the hostname
+        and key without asking Azure."""
+        rgroup, hub, device = self.require('rgroup'), self.require('iothub'), self.require('device')
+        lookups = []
+        if 'hostname' not in self.config:
+            self.log("Checking for IoT Hub Host Name")
+            lookups.append((
+                "hostname",
+                lambda: self.backend.show_hub(rgroup, hub),
+                lambda out, err: None if err else out["properties"]["hostName"]))
+
+        if 'key' not in self.config:
+            self.log("Checking for Device Identity with name '%s'" % device)
+            lookups.append((
+                "key",
+                lambda: self.backend.show_device(rgroup, hub, device),
+                lambda out, err: None if err else out["authentication"]["symmetricKey"]["primaryKey"]))
+
+        if 'hub_cs' not in self.config:
+            self.log("Checking for Connection string for IoT Hub with name '%s'" % hub)
+            lookups.append((
+                "hub_cs",
+                lambda: self.backend.hub_connection_string(rgroup, hub),
+                _hub_cs_or_none))
+
+        results = run_concurrently([(key, lookup) for key, lookup, _ in lookups], max_workers)
+
+        errors = []
+        for key, _, extract in lookups:
+            result = results[key]
+            if isinstance(result, Exception):
+                errors.append("Lookup of '%s' failed: %s" % (key, result))
+                continue
+            out, err = result
+            try:
+                value = extract(out, err)
+            except (KeyError, TypeError):
+                value = None
+            if value is None:
+                errors.append(err or "Unexpected response while looking up '%s'" % key)
+            else:
+                self.config[key] = value
+        if errors:
+            raise iot_fleet.ProvisioningError('\n'.join(errors))
+
+        if 'cs' not in self.config:
+            self.config['cs'] = iot_credentials.device_connection_string(self.config['hostname'], device,
+                                                                         self.config['key'])
+        return self.config['hub_cs'], self.config['cs']
+
+    def device_tags(self):
+        """Returns the device twin tags describing the device in config"""
+        return {
+            'id': self.config['device'],
+            'description': DEVICE_DESCRIPTION,
+            'credentials': {'user': self.config['username'], 'password': self.config['password']}
+        }
+
+    def tag_device(self):
+        """Tags the device twin with the device's description and credentials"""
+        inputs = dict(self._identity_inputs(self.require('device'), True), tags=self.device_tags())
+        del inputs['edge']
+        if self.journal.done(iot_journal.STEP_TWIN, inputs) is not None:
+            self.log("Device twin was tagged by an earlier run")
+            return
+        _, err = self.backend.update_device_tags(self.config['rgroup'], self.config['iothub'],
+                                                 self.config['device'], inputs['tags'])
+        if err:
+            raise iot_fleet.ProvisioningError(err)
+        self.journal.record(iot_journal.STEP_TWIN, inputs)
+
+    @iot_profile.timed()
+    def register_devices(self, sessions, edge_enabled=True):
+        """Creates the identities and tags the twins of the devices of sessions
+        (see for_device) in one go: the backend creates the missing identities
+        in bulk and updates the twins concurrently, and each device's journal
+        records both steps. The keys are set in each session's config. Returns
+        a dict of error messages keyed by the device ids that failed."""
+        rgroup, hub = self.require('rgroup'), self.require('iothub')
+        self.log("\nRegistering %d IoT Hub Edge Devices" % len(sessions))
+        start = time.time()
+        identities = self.backend.ensure_devices(rgroup, hub, [s.config['device'] for s in sessions],
+                                                 edge_enabled=edge_enabled)
+
+        failures = {}
+        twins = {}
+        for session in sessions:
+            device = session.config['device']
+            identity, err = identities[device]
+            if err or not identity:
+                failures[device] = err or "Device identity '%s' was not created" % device
+                continue
+            session.config['key'] = identity["authentication"]["symmetricKey"]["primaryKey"]
+            inputs = session._identity_inputs(device, edge_enabled)
+            session.journal.record(iot_journal.STEP_IDENTITY, inputs)
+            twin = dict(inputs, tags=session.device_tags())
+            del twin['edge']
+            if session.journal.done(iot_journal.STEP_TWIN, twin) is None:
+                twins[device] = (session, twin)
+
+        registered = len(sessions) - len(failures)
+        tagged = 0
+        results = self.backend.update_devices_tags(rgroup, hub,
+                                                   dict((d, twin['tags']) for d, (_, twin) in twins.items()))
+        for device, (session, twin) in twins.items():
+            _, err = results[device]
+            if err:
+                failures[device] = err
+            else:
+                session.journal.record(iot_journal.STEP_TWIN, twin)
+                tagged += 1
+
+        elapsed = time.time() - start
+        self.log("Registered %d devices and tagged %d twins in %.1fs (%.1f devices/second)" %
+                 (registered, tagged, elapsed, len(sessions) / max(elapsed, 0.001)))
+        return failures
+
+    # Grove Starter Kits
+
+    def scripts(self):
+        """Returns the scripts archive to install on devices, loaded into memory
+        once for the session and its devices: the scripts_path file if one was
+        given, otherwise the cached download, or with no_cache a download that
+        is never written to disk"""
+        import iot_artifacts
+
+        with self._shared.lock:
+            if self._shared.scripts is not None:
+                return self._shared.scripts
+            self.log("\nDownloading script file : " + (self.config.get('scripts_path') or SCRIPTS_ZIP_URI))
+            # TODO: Scripts need to be updated to detect hostmanager vs hostapd on target device
+            # (and update workflow accordingly)
+            try:
+                with iot_profile.span('get_scripts'):
+                    if self.config.get('scripts_path'):
+                        scripts = iot_artifacts.Archive.from_file(self.config['scripts_path'])
+                    elif self.config.get('no_cache'):
+                        scripts = iot_artifacts.download_archive(SCRIPTS_ZIP_URI)
+                    else:
+                        scripts = iot_artifacts.Archive.from_file(iot_artifacts.ArtifactCache().fetch(SCRIPTS_ZIP_URI))
+            except Exception as e:
+                raise iot_fleet.ProvisioningError("Error in downloading scripts. Error message: " + str(e))
+            self._shared.scripts = scripts
+            return scripts
+
+    def runner_command(self):
+        """Returns the command line that starts runner.sh on the device, logging
+        to connect.log between the markers iot watch looks for"""
+        return (
+            "sudo nohup sh -c '%s' runner.sh '%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s' </dev/null >%s 2>&1 &" %
+            (iot_watch.marked_command('./scripts/runner.sh'), self.config['wifi_ssid'], self.config['wifi_password'],
+             self.config['hub_cs'], self.config['device'], self.config['cs'], self.config['container_registry'],
+             self.config['cr_user'], self.config['cr_pwd'], iot_watch.LOG_PATH))
+
+    def wait_until_reachable(self, timeout=DEVICE_SSH_TIMEOUT):
+        """Waits up to timeout seconds for the device to accept SSH connections"""
+        ip = self.require('ip')
+        self.log("Waiting for %s to accept SSH connections" % ip)
+        with iot_profile.span('wait for device', iot_profile.WAIT, host=ip):
+            probe = iot_reachability.wait_until_reachable(ip, iot_reachability.SSH_PORT, timeout)
+        if not probe.reachable:
+            raise iot_fleet.ProvisioningError("%s is not reachable on port %d: %s" %
+                                              (ip, iot_reachability.SSH_PORT, probe.error))
+        self.log("Reachable after %.1fs" % probe.elapsed)
+
+    @iot_profile.timed()
+    def install_scripts(self, scripts=None, wait=None):
+        """Syncs the files of the scripts archive to the device at config['ip']
+        and starts runner.sh, skipping either step if an earlier run already did
+        it with the same inputs. wait, if given, is called before connecting to
+        the device."""
+        scripts = scripts or self.scripts()
+        ip = self.require('ip')
+        # a new board comes up at the same default address as the last one, the device id tells them apart
+        scripts_inputs = {'ip': ip, 'device': self.config['device'], 'user': self.config['username'],
+                          'dir': DEVICE_SCRIPTS_DIR, 'archive': scripts.sha256}
+        runner_inputs = {'ip': ip, 'command': self.runner_command()}
+        synced = self.journal.done(iot_journal.STEP_SCRIPTS, scripts_inputs) is not None
+        started = synced and self.journal.done(iot_journal.STEP_RUNNER, runner_inputs) is not None
+        if started:
+            self.log("\nThe scripts were copied to the device and started by an earlier run")
+            return
+        if wait:
+            wait()
+
+        # Copy scripts to device, only sending files that differ from what is already there
+        try:
+            ssh = self.ssh.get(ip, iot_reachability.SSH_PORT, self.config['username'], self.config['password'])
+            if not ssh:
+                raise iot_fleet.ProvisioningError("Failed to SSH to the Device. Please check the device-user and "
+                                                  "device-password and try again")
+            if synced:
+                self.log("\nScripts were copied to the Raspberry Pi by an earlier run (Step 1 of 2)")
+            else:
+                self.log("\nCopying scripts to Raspberry Pi (Step 1 of 2)")
+                with iot_profile.span('sync scripts', iot_profile.SSH, host=ip) as span:
+                    result = iot_ssh.sync_archive(ssh, scripts, DEVICE_SCRIPTS_DIR)
+                    span.update(uploaded=len(result.uploaded), bytes_sent=result.bytes_sent)
+                self.log("Copied %d changed files (%d bytes), %d already up to date" %
+                         (len(result.uploaded), result.bytes_sent, len(result.unchanged) + len(result.chmoded)))
+                self.journal.record(iot_journal.STEP_SCRIPTS, scripts_inputs)
+        except iot_fleet.ProvisioningError:
+            raise
+        except Exception as e:
+            raise iot_fleet.ProvisioningError("Error in copying scripts to device. Error message: " + str(e))
+        try:
+            self.log("Installing the required software now (Step 2 of 2). This script will exit shortly, but setup on "
+                     "your ")
+            self.log("device will take several minutes. Run 'iot watch' (or 'tail -f ~/connect.log' on the device) to "
+                     "view setup progress.")
+            with iot_profile.span('start runner.sh', iot_profile.SSH, host=ip):
+                result = iot_ssh.run_command(ssh, self.runner_command())
+        except Exception as e:
+            raise iot_fleet.ProvisioningError("Failed to SSH to the Device. Please check the device-user and "
+                                              "device-password and try again. Error message: " + str(e))
+        if not result.ok:
+            raise iot_fleet.ProvisioningError("Starting runner.sh on the device failed with exit status %d: %s" %
+                                              (result.exit_status, result.stderr.decode("utf-8", "replace").strip()))
+        self.journal.record(iot_journal.STEP_RUNNER, runner_inputs)
+
+    @iot_profile.timed()
+    def provision_device(self, scripts=None, ssh_timeout=DEVICE_SSH_TIMEOUT):
+        """Provisions the board in config: looks up or creates its IoT Edge
+        identity, tags its twin, and once it accepts SSH connections syncs the
+        scripts to it and starts runner.sh. The hub connection string and
+        registry credentials are looked up unless they are in config already."""
+        self.ensure_device(edge_enabled=True)
+        self.registry_credentials()
+        self.resolve_connection_strings()
+        self.tag_device()
+        self.install_scripts(scripts, lambda: self.wait_until_reachable(ssh_timeout))
+
+    def provision_fleet(self, devices, max_workers=iot_fleet.MAX_FLEET_WORKERS, ssh_timeout=DEVICE_SSH_TIMEOUT,
+                        report=None):
+        """Provisions many boards, each a dict with an 'ip' and 'device' and
+        optionally 'user', 'password', 'wifi_ssid' and 'wifi_password' (e.g.
+        from iot_fleet.load_inventory). Their identities are registered and
+        tagged in bulk, then up to max_workers boards are provisioned at the
+        same time. A board whose journal another run holds fails on its own.
+        Returns the results of iot_fleet.provision_fleet."""
+        scripts = self.scripts()
+        self.registry_credentials()
+        self.hub_connection_string()
+        sessions = {}
+        failures = {}
+        for device in devices:
+            try:
+                sessions[device['device']] = self.for_device(**device)
+            except iot_fleet.ProvisioningError as e:
+                failures[device['device']] = str(e)
+        failures.update(self.register_devices([sessions[device['device']] for device in devices
+                                               if device['device'] in sessions]))
+
+        def provision(device):
+            if device['device'] in failures:
+                raise iot_fleet.ProvisioningError(failures[device['device']])
+            sessions[device['device']].provision_device(scripts, ssh_timeout)
+
+        self.log("\nProvisioning %d devices with %d workers\n" % (len(devices), max_workers))
+        return iot_fleet.provision_fleet(devices, provision, max_workers, report)
+
+    # IoT buttons
+
+    def configure_button(self, address, http_session=None):
+        """Sets the WiFi settings and the IoT Hub device in config on the
+        button whose access point is at address, then puts it into client mode"""
+        import iot_button
+
+        button = iot_button.ButtonClient(iot_button.button_url(address), http_session)
+        try:
+            button.configure(self.config['wifi_ssid'], self.config['wifi_password'],
+                             self.hostname(), self.require('device'), self.require('key'))
+        except iot_button.ButtonError as e:
+            raise iot_fleet.ProvisioningError(str(e))
+        finally:
+            if http_session is None:
+                button.session.close()
+
+    def configure_buttons(self, buttons, max_workers, report=None, probe_timeout=BUTTON_PROBE_TIMEOUT):
+        """Configures many buttons, each a dict with the 'ip' at which this
+        machine reaches the button's access point, its 'device' and optionally
+        'wifi_ssid' and 'wifi_password'. The device identities are looked up or
+        created together, then buttons on distinct addresses (e.g. each behind
+        its own WiFi adapter) are configured concurrently over one pooled HTTP
+        session. Returns the results of iot_fleet.provision_fleet."""
+        import iot_button
+
+        hostname = self.hostname()
+        self.log("\nChecking for %d IoT Hub devices" % len(buttons))
+        start = time.time()
+        identities = self.backend.ensure_devices(self.require('rgroup'), self.require('iothub'),
+                                                 [button['device'] for button in buttons])
+        elapsed = time.time() - start
+        self.log("Registered %d devices in %.1fs (%.1f devices/second)" %
+                 (len([i for i, err in identities.values() if i and not err]), elapsed,
+                  len(buttons) / max(elapsed, 0.001)))
+        http_session = iot_button.create_session(max_workers)
+
+        def provision(button):
+            identity, err = identities[button['device']]
+            if err or not identity:
+                raise iot_fleet.ProvisioningError(err or "Device identity '%s' was not created" % button['device'])
+            wifi_ssid = button.get('wifi_ssid') or self.config['wifi_ssid']
+            if not wifi_ssid:
+                raise iot_fleet.ProvisioningError("No wifi_ssid given for the button "
+                                                  "(use --wifi-ssid or the inventory)")
+            probe = iot_reachability.wait_until_reachable(button['ip'], iot_reachability.HTTP_PORT, probe_timeout)
+            if not probe.reachable:
+                raise iot_fleet.ProvisioningError("%s is not reachable on port %d: %s" %
+                                                  (button['ip'], iot_reachability.HTTP_PORT, probe.error))
+            client = iot_button.ButtonClient(iot_button.button_url(button['ip']), http_session)
+            client.configure(wifi_ssid, button.get('wifi_password') or self.config['wifi_password'],
+                             hostname, button['device'],
+                             identity['authentication']['symmetricKey']['primaryKey'])
+
+        self.log("\nConfiguring %d buttons with %d workers\n" % (len(buttons), max_workers))
+        try:
+            return iot_fleet.provision_fleet(buttons, provision, max_workers, report)
+        finally:
+            http_session.close()
+
+
+class _NullStream(object):
+    """Swallows the status display of resources created without a terminal"""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
@@ -0,0 +1,487 @@
+"""Load testing the path from IoT buttons to the sample Function App.
+
+Many virtual devices connect to the IoT Hub over MQTT (the protocol of the
+device SDKs), authenticating with SAS tokens for their own identities, and
+send telemetry at a given rate. Everything runs on one asyncio event loop:
+each device is a pair of tasks, one sending on schedule and one reading the
+hub's acknowledgements, so thousands of devices need no thread each. A
+message counts as sent once the hub acknowledged it (QoS 1), and the time
+until then is its send latency. Connections are opened at a bounded rate, as
+IoT Hub throttles new connections per unit.
+
+LocalHub is an MQTT stand-in for IoT Hub that checks each device's SAS token
+against its key and acknowledges its messages, so a load test can run
+without Azure. Only the parts of MQTT 3.1.1 IoT Hub uses for device to cloud
+messages are implemented, on both sides.
+
+This module needs Python 3.5 or later, and is imported by the simulate
+command only.
+"""
+import asyncio
+import hmac
+import json
+import random
+import ssl
+import struct
+import time
+
+import iot_credentials
+
+MQTT_PORT = 8883
+API_VERSION = '2018-06-30'
+TELEMETRY_TOPIC = 'devices/%s/messages/events/'
+
+# Connections opened per second (an S1 unit accepts 100) and TLS handshakes in flight at once
+CONNECT_RATE = 100
+MAX_CONNECTING = 200
+
+# Seconds a connection attempt, and an unacknowledged message, may take
+CONNECT_TIMEOUT = 30
+SEND_TIMEOUT = 30
+
+# Seconds of silence after which a device pings the hub; the hub drops it after 1.5 times as long
+KEEPALIVE = 240
+
+# Send latencies kept for the percentiles; a run sending more keeps a uniform sample of them
+MAX_LATENCY_SAMPLES = 100000
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 5
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PINGREQ, PINGRESP, DISCONNECT = 1, 2, 3, 4, 12, 13, 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_NOT_AUTHORIZED = 5
+
+# Largest packet either side accepts (IoT Hub limits messages to 256 KB)
+MAX_PACKET = 262144 + 1024
+
+
+class MqttError(Exception):
+    """Raised when the hub refuses a device or breaks the protocol"""
+
+
+def _string(value):
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def _packet(kind, body, flags=0):
+    header = bytearray([kind << 4 | flags])
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def connect_packet(client_id, username, password, keepalive=KEEPALIVE):
+    # protocol level 4 (MQTT 3.1.1) with a user name, a password and a clean session
+    return _packet(CONNECT, _string('MQTT') + struct.pack('!BBH', 4, 0xC2, keepalive) +
+                   _string(client_id) + _string(username) + _string(password))
+
+
+def publish_packet(topic, packet_id, payload):
+    return _packet(PUBLISH, _string(topic) + struct.pack('!H', packet_id) + payload, flags=0x02)
+
+
+async def read_packet(reader):
+    """Returns the (type, flags, body) of the next packet. Raises
+    asyncio.IncompleteReadError at the end of the stream."""
+    first = await reader.readexactly(1)
+    length, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+        if shift > 21:
+            raise MqttError("Malformed packet length")
+    if length > MAX_PACKET:
+        raise MqttError("Packet of %d bytes is too large" % length)
+    body = await reader.readexactly(length)
+    return first[0] >> 4, first[0] & 0x0F, body
+
+
+def _read_string(body, offset):
+    length = struct.unpack_from('!H', body, offset)[0]
+    offset += 2
+    return body[offset:offset + length].decode('utf-8'), offset + length
+
+
+class DeviceConnection(object):
+    """The MQTT connection of one virtual device"""
+
+    def __init__(self, device, reader, writer):
+        self.device = device
+        self.reader = reader
+        self.writer = writer
+        self.closed = None
+        self._next_id = 0
+        self._pending = {}
+        self._last_sent = time.time()
+        self._reading = None
+
+    @classmethod
+    async def open(cls, hostname, device, key, host=None, port=MQTT_PORT, ssl_context=None):
+        """Connects device to the hub at hostname (or to host:port, e.g. a
+        LocalHub) and authenticates it with a SAS token signed with key"""
+        reader, writer = await asyncio.open_connection(host or hostname, port, ssl=ssl_context,
+                                                       server_hostname=hostname if ssl_context else None)
+        connection = cls(device, reader, writer)
+        try:
+            username = '%s/%s/?api-version=%s' % (hostname, device, API_VERSION)
+            password = iot_credentials.generate_sas_token(iot_credentials.device_resource_uri(hostname, device), key)
+            writer.write(connect_packet(device, username, password))
+            kind, _, body = await read_packet(reader)
+            if kind != CONNACK or len(body) != 2:
+                raise MqttError("The hub answered CONNECT with packet type %d" % kind)
+            if body[1] != CONNACK_ACCEPTED:
+                raise MqttError("The hub refused the connection (return code %d)" % body[1])
+        except BaseException:
+            writer.close()
+            raise
+        connection._reading = asyncio.ensure_future(connection._read())
+        return connection
+
+    async def _read(self):
+        try:
+            while True:
+                kind, _, body = await read_packet(self.reader)
+                if kind == PUBACK:
+                    future = self._pending.pop(struct.unpack('!H', body[:2])[0], None)
+                    if future is not None and not future.done():
+                        future.set_result(time.time())
+        except asyncio.IncompleteReadError:
+            self.closed = 'the hub closed the connection'
+        except (ConnectionError, OSError, MqttError) as e:
+            self.closed = str(e) or e.__class__.__name__
+        except asyncio.CancelledError:
+            self.closed = 'closed'
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(MqttError(self.closed))
+        self._pending.clear()
+
+    async def publish(self, payload, timeout=SEND_TIMEOUT):
+        """Sends a telemetry message and waits for the hub to acknowledge it.
+        Returns the send latency in seconds."""
+        if self.closed:
+            raise MqttError(self.closed)
+        self._next_id = self._next_id % 65535 + 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending[self._next_id] = future
+        start = self._last_sent = time.time()
+        self.writer.write(publish_packet(TELEMETRY_TOPIC % self.device, self._next_id, payload))
+        try:
+            acknowledged = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(self._next_id, None)
+            raise MqttError("No acknowledgement within %d seconds" % timeout)
+        return acknowledged - start
+
+    def ping_if_idle(self):
+        if not self.closed and time.time() - self._last_sent > KEEPALIVE / 2:
+            self._last_sent = time.time()
+            self.writer.write(_packet(PINGREQ, b''))
+
+    def close(self):
+        if not self.closed:
+            self.writer.write(_packet(DISCONNECT, b''))
+        if self._reading is not None:
+            self._reading.cancel()
+        self.writer.close()
+
+
+class Stats(object):
+    """Counts of a run, with a uniform sample of at most max_samples latencies"""
+
+    def __init__(self, max_samples=MAX_LATENCY_SAMPLES):
+        self.sent = 0
+        self.failed = 0
+        self.errors = {}
+        self.latencies = []
+        self.max_samples = max_samples
+
+    def success(self, latency):
+        self.sent += 1
+        if len(self.latencies) < self.max_samples:
+            self.latencies.append(latency)
+        else:
+            # reservoir sampling
+            slot = random.randrange(self.sent)
+            if slot < self.max_samples:
+                self.latencies[slot] = latency
+
+    def failure(self, error):
+        self.failed += 1
+        message = str(error) or error.__class__.__name__
+        self.errors[message] = self.errors.get(message, 0) + 1
+
+    def percentile(self, p):
+        """The latency p percent of the sampled messages were sent within"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+class Report(object):
+    """What a simulation achieved"""
+
+    def __init__(self, devices, rate, duration):
+        self.devices = devices
+        self.target_rate = devices * rate
+        self.duration = duration
+        self.connected = 0
+        self.connect_seconds = 0.0
+        self.connect_errors = Stats()
+        self.send_seconds = 0.0
+        self.stats = Stats()
+        self.hub = None
+
+    @property
+    def rate(self):
+        return self.stats.sent / self.send_seconds if self.send_seconds else 0.0
+
+
+class LocalHub(object):
+    """MQTT stand-in for IoT Hub on a local port. Accepts devices whose SAS
+    token was signed with their key in keys and acknowledges their telemetry
+    after latency seconds."""
+
+    def __init__(self, hostname, keys, latency=0.0):
+        self.hostname = hostname
+        self.keys = keys
+        self.latency = latency
+        self.server = None
+        self.counters = {'connections': 0, 'refused': 0, 'messages': 0, 'bytes': 0}
+        self._sessions = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._serve, host, port, backlog=1024)
+        return self
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self, timeout=5):
+        """Stops accepting devices and waits for the sessions still open to end"""
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self._sessions):
+            writer.close()
+        deadline = time.time() + timeout
+        while self._sessions and time.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    def _authorized(self, body):
+        try:
+            # the client id follows the protocol name, level, flags and keep alive
+            offset = 10
+            client_id, offset = _read_string(body, offset)
+            username, offset = _read_string(body, offset)
+            password, offset = _read_string(body, offset)
+        except (struct.error, UnicodeDecodeError):
+            return None
+        key = self.keys.get(client_id)
+        if key is None or username != '%s/%s/?api-version=%s' % (self.hostname, client_id, API_VERSION):
+            return None
+        fields = dict(part.split('=', 1) for part in password.partition(' ')[2].split('&') if '=' in part)
+        try:
+            expiry = int(fields.get('se', ''))
+        except ValueError:
+            return None
+        expected = iot_credentials.sign_sas_token(iot_credentials.device_resource_uri(self.hostname, client_id),
+                                                  key, expiry)
+        if expiry < time.time() or not hmac.compare_digest(expected.encode('utf-8'), password.encode('utf-8')):
+            return None
+        return client_id
+
+    async def _serve(self, reader, writer):
+        self.counters['connections'] += 1
+        self._sessions.add(writer)
+        try:
+            kind, _, body = await read_packet(reader)
+            device = self._authorized(body) if kind == CONNECT and body[:6] == _string('MQTT') else None
+            if device is None:
+                self.counters['refused'] += 1
+                writer.write(_packet(CONNACK, bytes([0, CONNACK_NOT_AUTHORIZED])))
+                return
+            writer.write(_packet(CONNACK, bytes([0, CONNACK_ACCEPTED])))
+            topic = TELEMETRY_TOPIC % device
+            while True:
+                kind, flags, body = await read_packet(reader)
+                if kind == PUBLISH:
+                    name, offset = _read_string(body, 0)
+                    if name != topic or flags & 0x06 != 0x02:
+                        return
+                    packet_id = body[offset:offset + 2]
+                    self.counters['messages'] += 1
+                    self.counters['bytes'] += len(body) - offset - 2
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    writer.write(_packet(PUBACK, packet_id))
+                elif kind == PINGREQ:
+                    writer.write(_packet(PINGRESP, b''))
+                else:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, MqttError, struct.error):
+            return
+        finally:
+            self._sessions.discard(writer)
+            writer.close()
+
+
+def telemetry(device, number):
+    """A message like the one an IoT button sends when pressed"""
+    return json.dumps({'deviceId': device, 'messageId': number, 'action': 'pressed',
+                       'timestamp': time.time()}).encode('utf-8')
+
+
+async def _connect_all(report, keys, hostname, host, port, ssl_context, connect_rate):
+    connecting = asyncio.Semaphore(MAX_CONNECTING)
+    start = time.time()
+
+    async def connect(number, device):
+        await asyncio.sleep(number / float(connect_rate))
+        async with connecting:
+            try:
+                connection = await asyncio.wait_for(
+                    DeviceConnection.open(hostname, device, keys[device], host, port, ssl_context), CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                report.connect_errors.failure(MqttError("Connecting took longer than %d seconds" % CONNECT_TIMEOUT))
+                return None
+            except (MqttError, asyncio.IncompleteReadError, ConnectionError, OSError, ssl.SSLError) as e:
+                report.connect_errors.failure(e)
+                return None
+        report.connected += 1
+        return connection
+
+    connections = await asyncio.gather(*[connect(number, device) for number, device in enumerate(sorted(keys))])
+    report.connect_seconds = time.time() - start
+    return [c for c in connections if c is not None]
+
+
+async def _send(connection, stats, rate, start, end):
+    interval = 1.0 / rate
+    # spread the devices' first messages over one interval
+    due = start + random.uniform(0, interval)
+    number = 0
+    while True:
+        now = time.time()
+        while due > now:
+            if due >= end:
+                return
+            await asyncio.sleep(min(due - now, KEEPALIVE / 2))
+            connection.ping_if_idle()
+            now = time.time()
+        if now >= end:
+            return
+        number += 1
+        try:
+            latency = await connection.publish(telemetry(connection.device, number))
+        except MqttError as e:
+            stats.failure(e)
+            if connection.closed:
+                return
+        else:
+            stats.success(latency)
+        # a device falling behind sends its next message right away, but does not catch up with a burst
+        due = max(due + interval, time.time())
+
+
+async def _progress(report, start, on_progress):
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        elapsed = time.time() - start
+        on_progress(elapsed, report.stats.sent, report.stats.failed, report.stats.sent / elapsed)
+
+
+async def _simulate(report, keys, hostname, rate, duration, host, port, ssl_context, connect_rate, local,
+                    local_latency, on_connected, on_progress):
+    hub = None
+    if local:
+        hub = await LocalHub(hostname, keys, local_latency).start()
+        host, port = '127.0.0.1', hub.port
+        report.hub = hub.counters
+    try:
+        connections = await _connect_all(report, keys, hostname, host, port, ssl_context, connect_rate)
+        if on_connected:
+            on_connected(report)
+        start = time.time()
+        progress = asyncio.ensure_future(_progress(report, start, on_progress)) if on_progress else None
+        try:
+            await asyncio.gather(*[_send(c, report.stats, rate, start, start + duration) for c in connections])
+        finally:
+            if progress:
+                progress.cancel()
+            report.send_seconds = time.time() - start
+            for connection in connections:
+                connection.close()
+    finally:
+        if hub is not None:
+            await hub.close()
+    return report
+
+
+def run(keys, hostname, rate, duration, host=None, port=MQTT_PORT, local=False, local_latency=0.0,
+        connect_rate=CONNECT_RATE, on_connected=None, on_progress=None):
+    """Simulates a device per entry of keys ({device id: primary key}), each
+    sending rate messages per second for duration seconds to the hub at
+    hostname (reached at host, if given). local runs a LocalHub to send to
+    instead, adding local_latency seconds to every acknowledgement.
+    on_connected(report) is called once every device has connected (or
+    failed to), then on_progress(elapsed, sent, failed, rate) every
+    PROGRESS_INTERVAL seconds. Returns a Report."""
+    raise_open_file_limit(len(keys) * (2 if local else 1) + 100)
+    ssl_context = None if local else ssl.create_default_context()
+    report = Report(len(keys), rate, duration)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(_simulate(report, keys, hostname, rate, duration, host, port, ssl_context,
+                                                 connect_rate, local, local_latency, on_connected, on_progress))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def raise_open_file_limit(needed):
+    """Raises the soft limit of open files towards needed, as far as the hard limit allows"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def _milliseconds(seconds):
+    return '-' if seconds is None else '%.1fms' % (seconds * 1000)
+
+
+def format_report(report):
+    """Renders a Report as plain text"""
+    stats = report.stats
+    lines = [
+        'Connected %d of %d devices in %.1fs' % (report.connected, report.devices, report.connect_seconds),
+        'Sent %d messages in %.1fs: %.1f messages/second (target %.1f), %d failed' %
+        (stats.sent, report.send_seconds, report.rate, report.target_rate, stats.failed),
+        'Send latency: p50 %s  p90 %s  p99 %s  max %s' %
+        (_milliseconds(stats.percentile(50)), _milliseconds(stats.percentile(90)),
+         _milliseconds(stats.percentile(99)), _milliseconds(stats.percentile(100))),
+    ]
+    if report.hub is not None:
+        lines.append('Local hub: %(connections)d connections, %(refused)d refused, %(messages)d messages received'
+                     % report.hub)
+    errors = list(report.connect_errors.errors.items()) + list(stats.errors.items())
+    for message, count in sorted(errors, key=lambda error: -error[1])[:5]:
+        lines.append('  %6d x %s' % (count, message))
+    return '\n'.join(lines)
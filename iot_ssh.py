@@ -0,0 +1,285 @@
+"""Running commands on devices over SSH.
+
+Commands run on a channel of an existing paramiko transport. Rather than
+checking the channel in a sleep loop, the caller blocks on its descriptor
+(iot_reachability.wait_ready) until output or the exit status arrives; output
+is handed to a callback as it comes in and only a bounded tail of each stream
+is kept. SSHConnections keeps one authenticated
+client per device so that every command for a device shares its transport.
+
+sync_archive mirrors the files of a zip archive into a directory on the
+device over SFTP, transferring only files whose hash differs. Files are
+streamed from the archive in memory to the device in READ_SIZE chunks.
+"""
+import codecs
+import hashlib
+import posixpath
+import stat
+import threading
+
+import iot_reachability
+
+# Bytes read from a channel at a time
+READ_SIZE = 32768
+
+# Bytes of stdout / stderr kept in a CommandResult
+MAX_CAPTURED_OUTPUT = 65536
+
+# Seconds between keepalive packets on device transports
+KEEPALIVE_INTERVAL = 30
+
+# Lists "<mode> <path>" for every file under a directory, then "<sha256>  <path>"
+REMOTE_MANIFEST_COMMAND = ("mkdir -p '%(dir)s' && cd '%(dir)s' && find . -type f -printf '%%m %%p\\n' && echo -- && "
+                           "find . -type f -exec sha256sum {} +")
+
+
+class CommandResult(object):
+    """Exit status of a remote command plus the tail of its stdout and stderr"""
+
+    def __init__(self, command, exit_status, stdout, stderr):
+        self.command = command
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+    def __repr__(self):
+        return '<CommandResult %r exit_status=%r>' % (self.command, self.exit_status)
+
+
+class _Tail(object):
+    """Keeps the last `limit` bytes written to it"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b''
+
+    def write(self, chunk):
+        self.data = (self.data + chunk)[-self.limit:]
+
+
+def run_command(client, command, on_output=None, timeout=None, max_output=MAX_CAPTURED_OUTPUT):
+    """Runs command on a connected paramiko SSHClient and waits for it to exit.
+    on_output(stream, text) is called with each decoded chunk as it arrives,
+    stream being 'stdout' or 'stderr'. timeout is the longest the command may
+    go without producing output or exiting. Returns a CommandResult."""
+    channel = client.get_transport().open_session()
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+        streams = {
+            'stdout': (channel.recv_ready, channel.recv, _Tail(max_output),
+                       codecs.getincrementaldecoder('utf-8')(errors='replace')),
+            'stderr': (channel.recv_stderr_ready, channel.recv_stderr, _Tail(max_output),
+                       codecs.getincrementaldecoder('utf-8')(errors='replace')),
+        }
+
+        def drain():
+            """Reads whatever output is buffered on both streams. Returns True if there was any."""
+            received = False
+            for name, (ready, recv, tail, decoder) in streams.items():
+                while ready():
+                    chunk = recv(READ_SIZE)
+                    if not chunk:
+                        break
+                    received = True
+                    tail.write(chunk)
+                    if on_output:
+                        text = decoder.decode(chunk)
+                        if text:
+                            on_output(name, text)
+            return received
+
+        while True:
+            if drain():
+                continue
+            if channel.eof_received or channel.exit_status_ready():
+                # output that arrived since the streams were last read comes before the EOF or exit
+                # status, so it is buffered by now; recv_exit_status() below waits for the status itself
+                while drain():
+                    pass
+                break
+            # the channel's file descriptor becomes readable on new data, EOF or exit status
+            if not iot_reachability.wait_ready([channel], [], timeout):
+                raise IOError("'%s' produced no output for %s seconds" % (command, timeout))
+
+        if on_output:
+            for name, (_, _, _, decoder) in streams.items():
+                text = decoder.decode(b'', final=True)
+                if text:
+                    on_output(name, text)
+        return CommandResult(command, channel.recv_exit_status(),
+                             streams['stdout'][2].data, streams['stderr'][2].data)
+    finally:
+        channel.close()
+
+
+class SSHConnections(object):
+    """One authenticated SSH client per (host, port, user), created on first
+    use with connect(host, port, user, password) and reused afterwards."""
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port, user, password):
+        """Returns a connected client, or None if authentication failed"""
+        key = (host, port, user)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+                client.close()
+                del self._clients[key]
+        client = self._connect(host, port, user, password)
+        if client is None:
+            return None
+        client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+        with self._lock:
+            existing = self._clients.get(key)
+            if existing is not None:
+                # another thread connected first
+                client.close()
+                return existing
+            self._clients[key] = client
+        return client
+
+    def close(self, host, port, user):
+        with self._lock:
+            client = self._clients.pop((host, port, user), None)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+class SyncResult(object):
+    """Files of an archive that were uploaded, re-moded or already up to date"""
+
+    def __init__(self):
+        self.uploaded = []
+        self.chmoded = []
+        self.unchanged = []
+        self.bytes_sent = 0
+
+    def __repr__(self):
+        return '<SyncResult uploaded=%d chmoded=%d unchanged=%d bytes_sent=%d>' % (
+            len(self.uploaded), len(self.chmoded), len(self.unchanged), self.bytes_sent)
+
+
+def archive_manifest(archive):
+    """Returns {path: (sha256, mode)} for the files in an open ZipFile.
+    Shell scripts are always executable, as 'chmod +x *.sh' used to ensure."""
+    manifest = {}
+    for info in archive.infolist():
+        if info.filename.endswith('/'):
+            continue
+        digest = hashlib.sha256()
+        with archive.open(info) as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(chunk)
+        mode = (info.external_attr >> 16) & 0o777 or 0o644
+        if info.filename.endswith('.sh'):
+            mode |= 0o755
+        manifest[posixpath.normpath(info.filename)] = (digest.hexdigest(), mode)
+    return manifest
+
+
+def remote_manifest(client, remote_dir):
+    """Returns {path: (sha256, mode)} for the files under remote_dir on the device"""
+    result = run_command(client, REMOTE_MANIFEST_COMMAND % {'dir': remote_dir})
+    if not result.ok:
+        return {}
+    modes, _, hashes = ('\n' + result.stdout.decode('utf-8', 'replace')).partition('\n--\n')
+    manifest = {}
+    mode_of = {}
+    for line in modes.splitlines():
+        mode, _, path = line.partition(' ')
+        if path:
+            mode_of[posixpath.normpath(path)] = int(mode, 8)
+    for line in hashes.splitlines():
+        sha256, _, path = line.partition('  ')
+        if not path:
+            continue
+        path = posixpath.normpath(path)
+        manifest[path] = (sha256, mode_of.get(path))
+    return manifest
+
+
+def _makedirs(sftp, path, known):
+    if not path or path in known:
+        return
+    _makedirs(sftp, posixpath.dirname(path), known)
+    try:
+        if not stat.S_ISDIR(sftp.stat(path).st_mode):
+            raise IOError("'%s' exists on the device and is not a directory" % path)
+    except IOError as e:
+        if getattr(e, 'errno', None) is None:
+            raise
+        sftp.mkdir(path)
+    known.add(path)
+
+
+def _upload(sftp, source, remote_path, result):
+    """Writes source to remote_path via a temporary name so an interrupted
+    transfer never leaves a truncated file in place"""
+    partial = remote_path + '.part'
+    with sftp.open(partial, 'wb') as target:
+        target.set_pipelined(True)
+        for chunk in iter(lambda: source.read(READ_SIZE), b''):
+            target.write(chunk)
+            result.bytes_sent += len(chunk)
+    try:
+        sftp.posix_rename(partial, remote_path)
+    except IOError:
+        # servers without the posix-rename extension refuse to overwrite
+        try:
+            sftp.remove(remote_path)
+        except IOError:
+            pass
+        sftp.rename(partial, remote_path)
+
+
+def sync_archive(client, scripts, remote_dir):
+    """Makes remote_dir on the device hold the files of scripts, an
+    iot_artifacts.Archive, uploading only files that are missing or differ and
+    fixing modes in place. The archive's manifest is computed once, however
+    many devices it is synced to. Returns a SyncResult."""
+    result = SyncResult()
+    local = scripts.manifest(archive_manifest)
+    with scripts.open() as archive:
+        members = dict((posixpath.normpath(name), name) for name in archive.namelist())
+        remote = remote_manifest(client, remote_dir)
+        sftp = client.open_sftp()
+        try:
+            directories = set()
+            for path in sorted(local):
+                sha256, mode = local[path]
+                remote_path = posixpath.join(remote_dir, path)
+                remote_sha256, remote_mode = remote.get(path, (None, None))
+                if remote_sha256 != sha256:
+                    _makedirs(sftp, posixpath.dirname(remote_path), directories)
+                    with archive.open(members[path]) as source:
+                        _upload(sftp, source, remote_path, result)
+                    sftp.chmod(remote_path, mode)
+                    result.uploaded.append(path)
+                elif remote_mode != mode:
+                    sftp.chmod(remote_path, mode)
+                    result.chmoded.append(path)
+                else:
+                    result.unchanged.append(path)
+        finally:
+            sftp.close()
+    return result
+
@@ -0,0 +1,118 @@
+"""Running independent provisioning steps concurrently.
+
+A command describes its steps as Tasks, each naming the tasks it requires.
+run_tasks starts every task as soon as the tasks it requires have finished,
+so the total time approaches the longest chain of dependent steps instead of
+the sum of all of them. Tasks that interact with the user can be pinned to
+the calling thread, the others run on a small thread pool.
+"""
+import threading
+
+import iot_profile
+
+# Upper bound on the number of tasks running on worker threads at once
+MAX_TASK_WORKERS = 4
+
+
+class Task(object):
+    """A step called as fn(results), where results maps the name of every
+    finished task to its return value. Tasks in requires finish first."""
+
+    def __init__(self, name, fn, requires=(), main_thread=False):
+        self.name = name
+        self.fn = fn
+        self.requires = tuple(requires)
+        self.main_thread = main_thread
+
+    def __repr__(self):
+        return '<Task %s requires=%r>' % (self.name, self.requires)
+
+
+def _check(tasks):
+    names = set()
+    for task in tasks:
+        if task.name in names:
+            raise ValueError("Task '%s' is defined twice" % task.name)
+        names.add(task.name)
+    for task in tasks:
+        unknown = [name for name in task.requires if name not in names]
+        if unknown:
+            raise ValueError("Task '%s' requires unknown tasks: %s" % (task.name, ', '.join(unknown)))
+
+    # depth first search for cycles
+    requires = dict((task.name, task.requires) for task in tasks)
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError("Tasks depend on each other: %s" % ' -> '.join(path + [name]))
+        state[name] = 'visiting'
+        for required in requires[name]:
+            visit(required, path + [name])
+        state[name] = 'done'
+
+    for task in tasks:
+        visit(task.name, [])
+
+
+def run_tasks(tasks, max_workers=MAX_TASK_WORKERS):
+    """Runs tasks in dependency order, overlapping those that do not depend
+    on each other, and returns the dict of their results. If a task raises
+    (SystemExit included), no further tasks are started and the exception is
+    re-raised once the tasks already running have finished."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    _check(tasks)
+    results = {}
+    pending = list(tasks)
+    running = set()
+    failures = []
+    changed = threading.Condition()
+
+    def run(task):
+        try:
+            with iot_profile.span(task.name, iot_profile.PHASE, task=True):
+                value = task.fn(results)
+        except BaseException as e:
+            with changed:
+                failures.append(e)
+        else:
+            with changed:
+                results[task.name] = value
+        finally:
+            with changed:
+                running.discard(task.name)
+                changed.notify_all()
+
+    def ready():
+        return [t for t in pending if all(name in results for name in t.requires)]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while True:
+            with changed:
+                while not failures and pending and not ready() and running:
+                    changed.wait()
+                if failures or not pending:
+                    break
+                startable = ready()
+                if not startable:
+                    # nothing running and nothing can start: a required task failed
+                    break
+                for task in startable:
+                    pending.remove(task)
+                    running.add(task.name)
+                on_main = [t for t in startable if t.main_thread]
+            for task in startable:
+                if not task.main_thread:
+                    executor.submit(run, task)
+            for task in on_main:
+                run(task)
+        with changed:
+            while running:
+                changed.wait()
+
+    if failures:
+        raise failures[0]
+    return results
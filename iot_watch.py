@@ -0,0 +1,213 @@
+"""Following the setup log of many Grove Starter Kits at once.
+
+configure-device starts runner.sh in the background with its output going to
+/home/pi/connect.log, framed by a line marking the start and one carrying
+the exit status (see marked_command). follow() runs `tail -F` of that log on
+one channel of each device's SSH transport and reads all of the channels
+from a single loop that waits in poll() (or select()) for whichever has
+output, so a rack of boards takes no thread per device. Output is split into
+lines handed on with their device as they complete. A channel is read no
+faster than its lines are handed on, and the unfinished line kept per device
+is capped at MAX_LINE characters, dropping what a carriage return would
+overwrite on a terminal (curl's progress meter), so a chatty device cannot
+grow a buffer without bound. A device is finished once its exit marker
+arrives, and its setup time is measured between the two markers.
+"""
+import codecs
+import re
+import socket
+import time
+
+import iot_fleet
+import iot_reachability
+
+LOG_PATH = '/home/pi/connect.log'
+
+# Prints the whole log, then follows it, also across the log being created or replaced by a new run
+TAIL_COMMAND = "tail -n +1 -F '%s' 2>/dev/null"
+
+# Lines runner.sh is framed by, each followed by the device's clock in seconds since the epoch
+STARTED_MARKER = '[iot] runner.sh started at'
+EXITED_MARKER = '[iot] runner.sh exited with status'
+_STARTED = re.compile(r'^\[iot\] runner\.sh started at (\d+)\s*$')
+_EXITED = re.compile(r'^\[iot\] runner\.sh exited with status (\d+) at (\d+)\s*$')
+
+# Bytes read from a channel at a time, and characters kept of a line that has not ended yet
+READ_SIZE = 4096
+MAX_LINE = 4096
+
+STATUS_WAITING = 'waiting'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_DISCONNECTED = 'disconnected'
+FINISHED = (STATUS_DONE, STATUS_FAILED, STATUS_DISCONNECTED)
+
+
+def marked_command(script):
+    """Shell commands that run script with the arguments given to `sh -c`,
+    printing the start and exit markers around it. They contain no single
+    quotes, so they can be passed to `sh -c` in single quotes."""
+    return ('echo "%s $(date +%%s)"; %s "$@"; echo "%s $? at $(date +%%s)"' %
+            (STARTED_MARKER, script, EXITED_MARKER))
+
+
+class DeviceLog(object):
+    """The log of one device as read so far"""
+
+    def __init__(self, name, channel=None):
+        self.name = name
+        self.channel = channel
+        self.status = STATUS_WAITING if channel is not None else STATUS_DISCONNECTED
+        self.error = None
+        self.started = None
+        self.started_seen = None
+        self.exited = None
+        self.exit_status = None
+        self.finished = None
+        self._partial = u''
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    @property
+    def duration(self):
+        """Seconds runner.sh took by the device's clock, or since it started
+        if it is still running; None if its start was not logged"""
+        if self.started is None:
+            return None
+        if self.exited is not None and self.exited >= self.started:
+            return self.exited - self.started
+        if self.exited is None and self.status == STATUS_RUNNING:
+            # the device clock is only compared with itself, so count from when the marker arrived
+            return time.time() - self.started_seen
+        return None
+
+    def feed(self, data, final=False):
+        """Returns the lines completed by data, without line endings"""
+        text = self._partial + self._decoder.decode(data, final)
+        lines = text.split('\n')
+        self._partial = lines.pop()
+        if final and self._partial:
+            lines.append(self._partial)
+            self._partial = u''
+        # a terminal shows what follows the last carriage return of a line (one
+        # at the very end may still turn out to be part of a CRLF)
+        if self._partial.endswith('\r'):
+            self._partial = self._partial[:-1].rsplit('\r', 1)[-1] + '\r'
+        else:
+            self._partial = self._partial.rsplit('\r', 1)[-1]
+        while len(self._partial) > MAX_LINE:
+            lines.append(self._partial[:MAX_LINE])
+            self._partial = self._partial[MAX_LINE:]
+        lines = [line.rstrip('\r').rsplit('\r', 1)[-1] for line in lines]
+        for line in lines:
+            self._observe(line)
+        return lines
+
+    def _observe(self, line):
+        started = _STARTED.match(line)
+        if started:
+            # a new run of runner.sh replaced the log
+            self.started, self.started_seen = int(started.group(1)), time.time()
+            self.exited = self.exit_status = None
+            self.status = STATUS_RUNNING
+            return
+        exited = _EXITED.match(line)
+        if exited:
+            self.exit_status, self.exited = int(exited.group(1)), int(exited.group(2))
+            self.status = STATUS_DONE if self.exit_status == 0 else STATUS_FAILED
+            self.finished = time.time()
+
+    def disconnected(self, error):
+        self.status = STATUS_DISCONNECTED
+        self.error = error
+        self.finished = time.time()
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def __repr__(self):
+        return '<DeviceLog %s %s>' % (self.name, self.status)
+
+
+def open_log(name, client, path=LOG_PATH):
+    """Starts following path on a new channel of a connected paramiko SSHClient"""
+    channel = client.get_transport().open_session()
+    channel.exec_command(TAIL_COMMAND % path)
+    channel.settimeout(0.0)
+    return DeviceLog(name, channel)
+
+
+def _read(log, on_line):
+    try:
+        data = log.channel.recv(READ_SIZE)
+    except socket.timeout:
+        # the descriptor was signalled for data on stderr, which tail does not write to
+        return
+    except (socket.error, EOFError) as e:
+        data, error = b'', str(e) or e.__class__.__name__
+    else:
+        error = "tail exited" if not data else None
+    for line in log.feed(data, final=not data):
+        on_line(log, line)
+    if error and not log.done:
+        log.disconnected(error)
+
+
+def follow(logs, on_line, on_finished=None, timeout=None):
+    """Reads the logs until every device finished, calling on_line(log, line)
+    for each line and on_finished(log) when a device is done, failed or
+    disconnects. timeout, if given, is the most seconds to follow them for.
+    Channels are closed as their device finishes. Returns the logs."""
+    deadline = time.time() + timeout if timeout is not None else None
+    following = []
+    for log in logs:
+        if log.done:
+            log.close()
+            if on_finished:
+                on_finished(log)
+        else:
+            following.append(log)
+
+    try:
+        while following:
+            wait = None if deadline is None else max(0, deadline - time.time())
+            if wait == 0:
+                break
+            ready = iot_reachability.wait_ready([log.channel for log in following], [], wait)
+            for log in [log for log in following if log.channel in ready]:
+                _read(log, on_line)
+                if log.done:
+                    log.close()
+                    following.remove(log)
+                    if on_finished:
+                        on_finished(log)
+    finally:
+        for log in following:
+            log.close()
+    return logs
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    minutes, seconds = divmod(int(seconds), 60)
+    return '%dm%02ds' % (minutes, seconds) if minutes else '%ds' % seconds
+
+
+def format_summary(logs):
+    """Renders the state of every device as a plain text table"""
+    header = ('DEVICE', 'STATUS', 'SETUP TIME', 'DETAIL')
+    rows = []
+    for log in logs:
+        detail = log.error or ('exit status %d' % log.exit_status if log.exit_status else '')
+        rows.append((log.name, log.status, format_duration(log.duration), detail))
+    done = len([log for log in logs if log.status == STATUS_DONE])
+    failed = len([log for log in logs if log.status in (STATUS_FAILED, STATUS_DISCONNECTED)])
+    return iot_fleet.format_table(header, rows, '%d of %d devices set up, %d failed, %d still running' %
+                                  (done, len(logs), failed, len(logs) - done - failed))
@@ -5,6 +5,8 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # --------------------------------------------------------------------------------------------
 
+import sys
+
 from setuptools import setup
 
 VERSION = "1.1.0"
@@ -17,17 +19,24 @@ CLASSIFIERS = [
     'Programming Language :: Python :: 2',
     'Programming Language :: Python :: 2.7',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.4',
     'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: 3.6',
     'License :: OSI Approved :: MIT License',
 ]
 
+MODULES = ['iot', 'iot_artifacts', 'iot_backends', 'iot_button', 'iot_cache', 'iot_credentials', 'iot_discovery',
+           'iot_fleet', 'iot_journal', 'iot_operations', 'iot_profile', 'iot_reachability', 'iot_rest', 'iot_scheduler',
+           'iot_session', 'iot_ssh', 'iot_tasks', 'iot_watch']
+
+# simulate is written with async/await, which Python 2 cannot even compile
+if sys.version_info >= (3, 5):
+    MODULES.append('iot_simulate')
+
 DEPENDENCIES = [
     'click',
     'requests',
     'paramiko',
-    'scp'
+    'futures; python_version < "3"'
 ]
 
 setup(
@@ -42,9 +51,13 @@ setup(
     download_url = 'https://github.com/Azure-Samples/azure-iot-starterkit-cli/archive/1.1.0.tar.gz',
     keywords = ['Azure', 'IoT', 'Microsoft', 'StarterKit', 'CLI', 'teXXmo', 'grove'],
     classifiers=CLASSIFIERS,
-    py_modules=['iot'],
+    py_modules=MODULES,
+    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*',
     include_package_data=True,
     install_requires=DEPENDENCIES,
+    extras_require={
+        'yaml': ['pyyaml']
+    },
     entry_points='''
         [console_scripts]
         iot=iot:cli
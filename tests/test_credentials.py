@@ -0,0 +1,101 @@
+"""Checks of the locally built IoT Hub connection strings and SAS tokens.
+
+The expected tokens were signed independently of iot_credentials, following
+the algorithm in the IoT Hub security documentation:
+
+    printf 'myhub.azure-devices.net%2Fdevices%2Fmydevice\n1500000000' |
+        openssl dgst -sha256 -mac HMAC -macopt hexkey:000102...1f -binary | base64
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iot_credentials
+
+HOSTNAME = 'myhub.azure-devices.net'
+DEVICE = 'mydevice'
+# bytes 0 to 31, base64 encoded
+KEY = 'AAECAwQFBgcICQoLDA0ODxAREhMUFRYXGBkaGxwdHh8='
+EXPIRY = 1500000000
+
+DEVICE_TOKEN = ('SharedAccessSignature sr=myhub.azure-devices.net%2Fdevices%2Fmydevice'
+                '&sig=%2FCMmsu6ncA%2BLVhZw1CzkXnlWYFZ64yolReinEUQvy%2FU%3D&se=1500000000')
+SERVICE_TOKEN = ('SharedAccessSignature sr=myhub.azure-devices.net'
+                 '&sig=bQh9DCaoHZCFwYby1gtKa2tpK1aTr%2FiWDo0wZBaCoQ8%3D&se=1500000000&skn=iothubowner')
+
+
+class Clock(object):
+    """Stands in for the time module in iot_credentials"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class SignSasTokenTest(unittest.TestCase):
+
+    def test_device_token(self):
+        uri = iot_credentials.device_resource_uri(HOSTNAME, DEVICE)
+        self.assertEqual(iot_credentials.sign_sas_token(uri, KEY, EXPIRY), DEVICE_TOKEN)
+
+    def test_service_token_names_the_policy(self):
+        token = iot_credentials.sign_sas_token(HOSTNAME, KEY, EXPIRY, iot_credentials.HUB_OWNER_POLICY)
+        self.assertEqual(token, SERVICE_TOKEN)
+
+    def test_connection_strings_round_trip(self):
+        cs = iot_credentials.device_connection_string(HOSTNAME, DEVICE, KEY)
+        self.assertEqual(cs, 'HostName=%s;DeviceId=%s;SharedAccessKey=%s' % (HOSTNAME, DEVICE, KEY))
+        self.assertEqual(iot_credentials.parse_connection_string(cs),
+                         {'HostName': HOSTNAME, 'DeviceId': DEVICE, 'SharedAccessKey': KEY})
+
+
+class SasTokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock(EXPIRY - 3600)
+        self.saved_time = iot_credentials.time
+        iot_credentials.time = self.clock
+
+    def tearDown(self):
+        iot_credentials.time = self.saved_time
+
+    def test_token_is_signed_for_the_ttl(self):
+        cache = iot_credentials.SasTokenCache(ttl=3600, refresh_margin=300)
+        self.assertEqual(cache.device_token(HOSTNAME, DEVICE, KEY), DEVICE_TOKEN)
+        self.assertEqual(cache.service_token(HOSTNAME, KEY), SERVICE_TOKEN)
+
+    def test_token_is_reused_until_the_refresh_margin(self):
+        cache = iot_credentials.SasTokenCache(ttl=3600, refresh_margin=300)
+        first = cache.device_token(HOSTNAME, DEVICE, KEY)
+        self.clock.now += 3600 - 301
+        self.assertEqual(cache.device_token(HOSTNAME, DEVICE, KEY), first)
+        self.assertEqual(cache.generated, 1)
+
+        self.clock.now += 1
+        self.assertNotEqual(cache.device_token(HOSTNAME, DEVICE, KEY), first)
+        self.assertEqual(cache.generated, 2)
+
+    def test_margin_is_at_most_half_the_ttl(self):
+        cache = iot_credentials.SasTokenCache(ttl=100, refresh_margin=300)
+        cache.device_token(HOSTNAME, DEVICE, KEY)
+        self.clock.now += 49
+        cache.device_token(HOSTNAME, DEVICE, KEY)
+        self.assertEqual(cache.generated, 1)
+        self.clock.now += 1
+        cache.device_token(HOSTNAME, DEVICE, KEY)
+        self.assertEqual(cache.generated, 2)
+
+    def test_tokens_are_kept_per_key_and_policy(self):
+        cache = iot_credentials.SasTokenCache()
+        cache.token(HOSTNAME, KEY)
+        cache.token(HOSTNAME, KEY, iot_credentials.HUB_OWNER_POLICY)
+        cache.token(HOSTNAME, iot_credentials.generate_key())
+        self.assertEqual(cache.generated, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Checks of the per-device provisioning journal: step fingerprints, the salt
+they are hashed with, and how a journal survives being reopened."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iot_journal
+
+INPUTS = {'ip': '192.168.4.1', 'device': 'grove-1', 'archive': 'abc123'}
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.tmp
+
+    def tearDown(self):
+        if self.saved_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.saved_cache_home
+        shutil.rmtree(self.tmp)
+
+    def test_fingerprint_ignores_key_order(self):
+        journal = iot_journal.Journal()
+        reordered = dict(reversed(list(INPUTS.items())))
+        self.assertEqual(journal.fingerprint(INPUTS), journal.fingerprint(reordered))
+
+    def test_fingerprint_is_salted(self):
+        first, second = iot_journal.Journal(), iot_journal.Journal()
+        self.assertNotEqual(first.salt, second.salt)
+        self.assertNotEqual(first.fingerprint(INPUTS), second.fingerprint(INPUTS))
+        second.salt = first.salt
+        self.assertEqual(first.fingerprint(INPUTS), second.fingerprint(INPUTS))
+
+    def test_step_is_done_only_with_the_same_inputs(self):
+        journal = iot_journal.Journal()
+        self.assertIsNone(journal.done(iot_journal.STEP_SCRIPTS, INPUTS))
+        journal.record(iot_journal.STEP_SCRIPTS, INPUTS, {'files': 3})
+        self.assertEqual(journal.done(iot_journal.STEP_SCRIPTS, dict(INPUTS)), {'files': 3})
+        self.assertIsNone(journal.done(iot_journal.STEP_SCRIPTS, dict(INPUTS, device='grove-2')))
+        self.assertTrue(journal.recorded(iot_journal.STEP_SCRIPTS))
+
+    def test_reopened_journal_keeps_salt_and_steps(self):
+        with iot_journal.Journal.for_device('Hub', 'grove-1') as journal:
+            journal.record(iot_journal.STEP_RESOURCE_GROUP, {'rgroup': 'rg'})
+            salt = journal.salt
+        with iot_journal.Journal.for_device('hub', 'grove-1') as journal:
+            self.assertEqual(journal.salt, salt)
+            self.assertEqual(journal.done(iot_journal.STEP_RESOURCE_GROUP, {'rgroup': 'rg'}), {})
+            self.assertEqual(journal.resume_point(), iot_journal.STEP_IOTHUB)
+            self.assertEqual(journal.device, 'hub/grove-1')
+
+    def test_journal_is_kept_per_device(self):
+        self.assertNotEqual(iot_journal.journal_path('hub', 'grove-1'), iot_journal.journal_path('hub', 'grove-2'))
+        with iot_journal.Journal.for_device('hub', 'grove-1') as journal:
+            journal.record(iot_journal.STEP_RESOURCE_GROUP, {'rgroup': 'rg'})
+        with iot_journal.Journal.for_device('hub', 'grove-2') as journal:
+            self.assertFalse(journal.recorded(iot_journal.STEP_RESOURCE_GROUP))
+
+    def test_second_run_is_locked_out(self):
+        with iot_journal.Journal.for_device('hub', 'grove-1'):
+            self.assertRaises(iot_journal.JournalLocked, iot_journal.Journal.for_device, 'hub', 'grove-1')
+
+    def test_adopt_refingerprints_with_the_new_salt(self):
+        memory = iot_journal.Journal()
+        memory.record(iot_journal.STEP_IOTHUB, {'iothub': 'hub'})
+        with iot_journal.Journal.for_device('hub', 'grove-1') as journal:
+            journal.adopt(memory)
+            self.assertEqual(journal.done(iot_journal.STEP_IOTHUB, {'iothub': 'hub'}), {})
+
+    def test_reset_forgets_every_step(self):
+        journal = iot_journal.Journal()
+        journal.record(iot_journal.STEP_RESOURCE_GROUP, {'rgroup': 'rg'})
+        journal.reset()
+        self.assertEqual(journal.resume_point(), iot_journal.STEP_RESOURCE_GROUP)
+
+
+if __name__ == '__main__':
+    unittest.main()
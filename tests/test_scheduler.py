@@ -0,0 +1,77 @@
+"""Checks of which Azure failures the scheduler retries, and how."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import iot_scheduler
+
+
+class ClassifyStatusTest(unittest.TestCase):
+
+    def test_success_and_client_errors_are_final(self):
+        for status in (200, 201, 204, 400, 401, 404, 409, 412):
+            self.assertIsNone(iot_scheduler.classify_status(status, {}))
+
+    def test_throttling_is_retried_even_if_not_idempotent(self):
+        for status in (429, 503):
+            retry = iot_scheduler.classify_status(status, {}, idempotent=False)
+            self.assertTrue(retry.throttled)
+            self.assertIsNone(retry.after)
+
+    def test_retry_after_seconds_are_honored(self):
+        self.assertEqual(iot_scheduler.classify_status(429, {'Retry-After': '7'}).after, 7.0)
+        self.assertEqual(iot_scheduler.classify_status(500, {'Retry-After': '2'}).after, 2.0)
+
+    def test_retry_after_date_in_the_past_means_no_wait(self):
+        retry = iot_scheduler.classify_status(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(retry.after, 0.0)
+
+    def test_unusable_retry_after_is_ignored(self):
+        self.assertIsNone(iot_scheduler.classify_status(429, {'Retry-After': 'soon'}).after)
+
+    def test_transient_errors_are_retried_only_if_idempotent(self):
+        for status in (408, 500, 502, 504):
+            retry = iot_scheduler.classify_status(status, {})
+            self.assertFalse(retry.throttled)
+            self.assertIsNone(iot_scheduler.classify_status(status, {}, idempotent=False))
+
+
+class ClassifyAzTest(unittest.TestCase):
+
+    def test_output_or_exception_is_final(self):
+        self.assertIsNone(iot_scheduler.classify_az((b'{"id": 1}', b'429 too many requests'), None))
+        self.assertIsNone(iot_scheduler.classify_az(None, OSError('az not found')))
+
+    def test_throttling_is_retried_even_if_not_idempotent(self):
+        for stderr in (b'Operation returned an invalid status code 429', 'Too Many Requests',
+                       b'The request is being throttled.', b'ServerBusy: the server is busy'):
+            retry = iot_scheduler.classify_az((b'', stderr), None, idempotent=False)
+            self.assertTrue(retry.throttled, stderr)
+
+    def test_transient_errors_are_retried_only_if_idempotent(self):
+        for stderr in (b'Internal Server Error', b'502 Bad Gateway', b'Connection reset by peer',
+                       b'The operation timed out'):
+            retry = iot_scheduler.classify_az((b'', stderr), None)
+            self.assertFalse(retry.throttled, stderr)
+            self.assertIsNone(iot_scheduler.classify_az((b'', stderr), None, idempotent=False))
+
+    def test_other_errors_are_final(self):
+        for stderr in (b"ResourceNotFound: device 'grove-1' not found", b'AuthorizationFailed', b'5000 devices'):
+            self.assertIsNone(iot_scheduler.classify_az((b'', stderr), None), stderr)
+
+
+class FamilyTest(unittest.TestCase):
+
+    def test_az_family(self):
+        self.assertEqual(iot_scheduler.az_family('iot hub device-twin update'), iot_scheduler.FAMILY_TWIN)
+        self.assertEqual(iot_scheduler.az_family('iot hub query'), iot_scheduler.FAMILY_QUERY)
+        self.assertEqual(iot_scheduler.az_family('iot hub device-identity list'), iot_scheduler.FAMILY_QUERY)
+        self.assertEqual(iot_scheduler.az_family('iot hub device-identity create'), iot_scheduler.FAMILY_REGISTRY)
+        self.assertEqual(iot_scheduler.az_family('group show'), iot_scheduler.FAMILY_ARM)
+        self.assertEqual(iot_scheduler.az_family(None), iot_scheduler.FAMILY_ARM)
+
+
+if __name__ == '__main__':
+    unittest.main()